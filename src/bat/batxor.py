@@ -37,7 +37,7 @@ signatures = { 'splashtop': ['\x51', '\x57', '\x45', '\x52']
 def unpackXOR(filename, sig, tempdir=None):
 	tmpdir = fwunpack.unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	fwunpack.unpackFile(filename, 0, tmpfile[1], tmpdir, modify=True)
 	datafile = open(filename)
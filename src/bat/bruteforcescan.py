@@ -54,7 +54,7 @@ from multiprocessing.sharedctypes import Value, Array
 import magic
 
 ## import the PostgreSQL connection module
-import psycopg2
+import psycopg2, psycopg2.extensions
 
 ## finally import a few BAT specific modules
 import extractor, prerun, fsmagic
@@ -233,7 +233,7 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 			## be able to handle.
 			if not os.path.islink(filetoscan):
 				tmpmagic = tempfile.mkstemp()
-				os.fdopen(tmpmagic[0]).close()
+				os.close(tmpmagic[0])
 				shutil.copy(filetoscan, tmpmagic[1])
 				magic = ms.file(tmpmagic[1])
 				os.unlink(tmpmagic[1])
@@ -355,6 +355,7 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 
 				## make a copy before changing the environment
 				newenv = copy.deepcopy(unpackscan['environment'])
+				newenv['BAT_FILESIZE'] = filesize
 
 				if template != None:
 					templen = len(re.findall('%s', template))
@@ -498,10 +499,10 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 				if ignore:
 					continue
 				if prerunscan['name'] in prerunignore:
-					if set(tags).intersection(set(prerunignore[prerunscan['name']])) != set():
+					if not prerunignore[prerunscan['name']].isdisjoint(tags):
 						continue
 				if prerunscan['name'] in prerunmagic:
-					if set(prerunmagic[prerunscan['name']]).intersection(filterscans) == set():
+					if prerunmagic[prerunscan['name']].isdisjoint(filterscans):
 						continue
 				module = prerunscan['module']
 				method = prerunscan['method']
@@ -600,6 +601,7 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 				## make a copy before changing the environment
 				newenv = copy.deepcopy(unpackscan['environment'])
 				newenv['BAT_UNPACKED'] = unpacked
+				newenv['BAT_FILESIZE'] = filesize
 
 				if template != None:
 					templen = len(re.findall('%s', template))
@@ -787,7 +789,7 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 				os.stat('%s/filereports/%s-filereport.pickle' % (topleveldir,filehash))
 			except Exception, e:
 				picklefile = open('%s/filereports/%s-filereport.pickle' % (topleveldir,filehash), 'wb')
-				cPickle.dump(reports, picklefile)
+				cPickle.dump(reports, picklefile, cPickle.HIGHEST_PROTOCOL)
 				picklefile.close()
 			reportqueue.put({relfiletoscan: unpackreports})
 		if debug:
@@ -839,7 +841,7 @@ def aggregatescan(unpackreports, aggregatescans, processors, scantempdir, toplev
 					leafreports['tags'].append(reskey)
 
 				leaf_file = open(leaf_file_path, 'wb')
-				leafreports = cPickle.dump(leafreports, leaf_file)
+				cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 				leaf_file.close()
 		endtime = datetime.datetime.utcnow()
 		if debug:
@@ -1283,7 +1285,7 @@ def readconfig(config):
 			else:
 				try:
 					testfile = tempfile.mkstemp(dir=unpackdir)
-					os.fdopen(testfile[0]).close()
+					os.close(testfile[0])
 					os.unlink(testfile[1])
 					## store it in the environment
 					batconf['environment']['UNPACK_TEMPDIR'] = unpackdir
@@ -1575,7 +1577,7 @@ def writeDumpfile(unpackreports, scans, processamount, outputfile, configfile, t
 						if sc == scrubsplits[0].strip():
 							scrubline = "%s = *****\n" % sc
 				os.write(tmpscrub[0], scrubline)
-			os.fdopen(tmpscrub[0]).close()
+			os.close(tmpscrub[0])
 			scrubfile = tmpscrub[1]
 			shutil.copy(scrubfile, os.path.basename(configfile))
 			os.unlink(scrubfile)
@@ -1648,7 +1650,7 @@ def runscan(scans, binaries, batversion):
 		if 'noscan' in prerunscan:
 			if not prerunscan['noscan'] == None:
 				noscans = prerunscan['noscan'].split(':')
-				prerunignore[prerunscan['name']] = noscans
+				prerunignore[prerunscan['name']] = set(noscans)
 		if 'magic' in prerunscan:
 			if not prerunscan['magic'] == None:
 				magics = prerunscan['magic'].split(':')
@@ -1663,6 +1665,10 @@ def runscan(scans, binaries, batversion):
 					prerunmagic[prerunscan['name']] = magics
 				else:
 					prerunmagic[prerunscan['name']] = prerunmagic[prerunscan['name']] + magics
+	## the tags and markers are checked for every prerun scan for every
+	## file, so store them as sets once instead of creating sets every time
+	for prerunscan in prerunmagic:
+		prerunmagic[prerunscan] = set(prerunmagic[prerunscan])
 
 	magicscans = list(set(magicscans))
 	optmagicscans = list(set(optmagicscans))
@@ -1719,6 +1725,13 @@ def runscan(scans, binaries, batversion):
 		for i in range(0,processamount):
 			try:
 				c = psycopg2.connect(database=scanenv['POSTGRESQL_DB'], user=scanenv['POSTGRESQL_USER'], password=scanenv['POSTGRESQL_PASSWORD'], host=scanenv.get('POSTGRESQL_HOST', None), port=scanenv.get('POSTGRESQL_PORT', None))
+				## the database is only read from, so there is no need to
+				## wrap every query in a transaction: with autocommit the
+				## many conn.commit() calls in the scans no longer cause a
+				## BEGIN/COMMIT round trip to the server. This is used instead
+				## of the 'autocommit' attribute, which is not available in
+				## older versions of psycopg2.
+				c.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
 				cursor = c.cursor()
 				batcons.append(c)
 				batcursors.append(cursor)
@@ -1925,10 +1938,17 @@ def runscan(scans, binaries, batversion):
 		## this can save quite a bit of time.
 		if not knownextension:
 			offsetcutoff = scans['batconfig']['markersearchminimum']
-			if os.stat(scan_binary).st_size > offsetcutoff:
+			scan_binary_size = os.stat(scan_binary).st_size
+			if scan_binary_size > offsetcutoff:
+				## Split the file in regions. Use a few regions per process
+				## to spread the work evenly, but keep the regions between
+				## 100000 bytes and the 2000000 bytes blocks that
+				## genericMarkerSearch uses, as every region has some overhead
+				## (mapping the file, sending back the results).
+				regionsize = min(2000000, max(100000, scan_binary_size/(processamount*4)))
 				offsettasks = []
-				for i in range(0, os.stat(scan_binary).st_size, 100000):
-					offsettasks.append((scantempdir, scan_binary_basename, magicscans, optmagicscans, max(i-50, 0), 100000+50))
+				for i in xrange(0, scan_binary_size, regionsize):
+					offsettasks.append((scantempdir, scan_binary_basename, magicscans, optmagicscans, max(i-50, 0), regionsize+50))
 				pool = multiprocessing.Pool(processes=processamount)
 				res = pool.map(paralleloffsetsearch, offsettasks)
 				pool.terminate()
@@ -2053,7 +2073,7 @@ def runscan(scans, binaries, batversion):
 			leafreports['tags'].append('toplevel')
 
 			leaf_file = open(leaf_file_path, 'wb')
-			leafreports = cPickle.dump(leafreports, leaf_file)
+			cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 			leaf_file.close()
 
 		## LEGACY: Now the next phase starts, namely scanning each individual
@@ -2121,7 +2141,8 @@ def runscan(scans, binaries, batversion):
 				if not parallel:
 					postrunprocessamount = 1
 				else:
-					postrunprocessamount = processamount
+					## no need to start more processes than there are files
+					postrunprocessamount = min(processamount, len(postruntasks))
 				for i in range(0,postrunprocessamount):
 					if usedatabase:
 						cursor = batcursors[i]
@@ -41,7 +41,7 @@ def busybox_version(filename, tags, cursor, conn, blacklist=[], scanenv={}, scan
 					data = datafile.read(i[0] - lastindex)
 					tmpfile = tempfile.mkstemp()
 					os.write(tmpfile[0], data)
-					os.fdopen(tmpfile[0]).close()
+					os.close(tmpfile[0])
 					bbres = busybox.extract_version(tmpfile[1])
 					os.unlink(tmpfile[1])
 					## set lastindex to the next
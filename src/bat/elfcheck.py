@@ -724,7 +724,7 @@ def parseELF(filename, debug=False):
 	## First process the program header table
 	brokenelf = False
 	maxendofprogramsegments = 0
-	for i in range(0,numberprogramheaders):
+	for i in xrange(0,numberprogramheaders):
 		elffile.seek(offset + startprogramheader + i*programheadersize)
 		elfbytes = elffile.read(programheadersize)
 		if len(elfbytes) != programheadersize:
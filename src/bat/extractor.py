@@ -8,11 +8,14 @@
 This file contains a few convenience functions that are used throughout the code.
 '''
 
-import string, re, subprocess, sys
+import string, re, subprocess, sys, bisect
 from xml.dom import minidom
 
+## check if all characters are printable. Deleting all printable characters
+## with translate() is done in C and is a lot faster than checking every
+## character in Python: if anything is left there are non-printable characters.
 def isPrintables(lines):
-	return len(lines) == len(filter(lambda x: x in string.printable, lines))
+	return lines.translate(None, string.printable) == ''
 
 ## check if a word is surrounded by NUL characters
 def check_null(lines, offset, word):
@@ -38,6 +41,39 @@ def inblacklist(offset, blacklist):
 		if offset >= bl[0] and offset < bl[1]:
 			return bl[1]
 
+## convenience method to build an index of a blacklist that can be searched
+## with a binary search, instead of walking the entire blacklist like
+## inblacklist() does. The regions in the blacklist are sorted and
+## overlapping regions are merged. The index has to be rebuilt if the
+## blacklist changes.
+def blacklistindex(blacklist):
+	regions = []
+	for bl in sorted(blacklist):
+		if regions != [] and bl[0] <= regions[-1][1]:
+			if bl[1] > regions[-1][1]:
+				regions[-1][1] = bl[1]
+		else:
+			regions.append([bl[0], bl[1]])
+	lowerbounds = map(lambda x: x[0], regions)
+	return (lowerbounds, regions)
+
+## same as inblacklist(), but using an index made by blacklistindex(). Please
+## note that the upperbound of the merged region is returned.
+def inblacklistindex(offset, blindex):
+	(lowerbounds, regions) = blindex
+	regionindex = bisect.bisect_right(lowerbounds, offset) - 1
+	if regionindex >= 0 and offset < regions[regionindex][1]:
+		return regions[regionindex][1]
+	return None
+
+## convenience method to remove all offsets that are in the blacklist in
+## one go.
+def filterblacklist(offsets, blacklist):
+	if blacklist == []:
+		return offsets
+	blindex = blacklistindex(blacklist)
+	return filter(lambda x: inblacklistindex(x, blindex) == None, offsets)
+
 ## convenience method to find the next lowest entry in the blacklist
 def lowestnextblacklist(offset, blacklist):
 	lowest = sys.maxint
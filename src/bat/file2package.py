@@ -94,7 +94,7 @@ def filename2package(unpackreports, scantempdir, topleveldir, processors, scanen
 		leafreports['tags'].append('file2package')
 		unpackreports[filename]['tags'].append('file2package')
 		leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-		cPickle.dump(leafreports, leaf_file)
+		cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 		leaf_file.close()
 
 	returnres = res
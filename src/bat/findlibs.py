@@ -840,7 +840,7 @@ def findlibs(unpackreports, scantempdir, topleveldir, processors, scanenv, batcu
 				leafreports['tags'].append('plugin')
 
 			leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-			leafreports = cPickle.dump(leafreports, leaf_file)
+			cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 			leaf_file.close()
 
 
@@ -15,11 +15,20 @@ Optionally return a range of bytes that should be excluded in same cases
 to prevent other scans from (re)scanning (part of) the data.
 '''
 
-import sys, os, subprocess, os.path, shutil, stat, array, struct, binascii, json, math
-import tempfile, bz2, re, magic, tarfile, zlib, copy, uu, hashlib, StringIO, zipfile
+import sys, os, subprocess, os.path, shutil, stat, array, struct, binascii, json, math, mmap
+import tempfile, bz2, re, magic, tarfile, zlib, copy, uu, hashlib, cStringIO, zipfile
 import fsmagic, extractor, ext2, jffs2, prerun, javacheck
 from collections import deque
-import xml.dom
+import xml.dom, bisect, multiprocessing.pool
+
+## Select the CRC32 implementation once, at import time. zlib's crc32 is
+## considerably faster than the table driven one in binascii (and is further
+## optimised by some zlib builds), but both compute the same CRC32 as used
+## by gzip, so binascii is kept as a fallback.
+try:
+	from zlib import crc32 as _crc32
+except ImportError:
+	from binascii import crc32 as _crc32
 
 ## generic method to create temporary directories, with the correct filenames
 ## which is used throughout the code.
@@ -41,6 +50,13 @@ def unpacksetup(tempdir):
 		tmpdir = tempdir
 	return tmpdir
 
+## the size of the file that is scanned is passed by the scan driver in
+## the environment, so not every scan has to stat the file again
+def getfilesize(filename, scanenv):
+	if 'BAT_FILESIZE' in scanenv:
+		return scanenv['BAT_FILESIZE']
+	return os.stat(filename).st_size
+
 ## Carve a file from a larger file, or copy a file.
 def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpacktempdir=None, blacklist=[]):
 	if blacklist != []:
@@ -56,9 +72,10 @@ def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpack
 	if filesize == length:
 		length = 0
 
-	## don't use dd for stuff that is less than 50 million bytes
+	## the maximum amount of bytes that is read into memory at once
+	## when carving a file
 	## TODO: make configurable
-	unpackcutoff = 50000000
+	unpackchunksize = 10485760
 
 	## If the while file needs to be scanned, then either copy it, or hardlink it.
 	## Hardlinking is only possible if the file resides on the same file system
@@ -69,7 +86,7 @@ def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpack
 		## scans.
 		## just use mkstemp() to get the name of a temporary file
 		templink = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(templink[0]).close()
+		os.close(templink[0])
 		os.unlink(templink[1])
 		if not modify:
 			try:
@@ -82,88 +99,25 @@ def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpack
 			shutil.copy(filename, templink[1])
 		shutil.move(templink[1], tmpfile)
 	else:
+		## Copy the data in chunks instead of starting 'tail', 'dd' and
+		## sometimes 'truncate' to carve the file. The scanning process can
+		## be quite big and forking it is expensive, plus it needs a few
+		## workarounds for dd (for example for files >= 2 GiB, see
+		## https://bugzilla.redhat.com/show_bug.cgi?id=612839 ).
 		if length == 0:
-			if unpackcutoff < filesize and (filesize - offset) < unpackcutoff:
-				srcfile = open(filename, 'rb')
-				dstfile = open(tmpfile, 'wb')
-				srcfile.seek(offset)
-				dstfile.write(srcfile.read(length))
-				dstfile.flush()
-				dstfile.close()
-				srcfile.close()
-				return
-			## The tail end of the file is needed and the first bytes (indicated by 'offset') need
-			## to be ignored, while the rest needs to be copied. If the offset is small, it is
-			## faster to use 'tail' instead of 'dd', especially for big files.
-			if offset < 128:
-				tmptmpfile = open(tmpfile, 'wb')
-				p = subprocess.Popen(['tail', filename, '-c', "%d" % (filesize - offset)], stdout=tmptmpfile, stderr=subprocess.PIPE, close_fds=True)
-				(stanout, stanerr) = p.communicate()
-				tmptmpfile.close()
-			else:
-				p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile,), 'bs=%s' % (offset,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-				(stanout, stanerr) = p.communicate()
-				os.chmod(tmpfile, stat.S_IRWXU)
-		else:
-			if unpackcutoff < filesize and length < unpackcutoff:
-				srcfile = open(filename, 'rb')
-				dstfile = open(tmpfile, 'wb')
-				srcfile.seek(offset)
-				dstfile.write(srcfile.read(length))
-				dstfile.flush()
-				dstfile.close()
-				srcfile.close()
-				return
-			if offset == 0:
-				## sometimes there are some issues with dd and maximum file size
-				## see for example https://bugzilla.redhat.com/show_bug.cgi?id=612839
-				if (length+offset) >= 2147479552:
-					shutil.copy(filename, tmpfile)
-					truncfile = open(tmpfile, 'a+b')
-					truncfile.seek(length+offset)
-					truncfile.truncate()
-					truncfile.close()
-				else:
-					## bytes need be removed only from the end of the file
-					p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile,), 'bs=%s' % (length,), 'count=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-					(stanout, stanerr) = p.communicate()
-					os.chmod(tmpfile, stat.S_IRWXU)
-			else:
-				## bytes need to be removed on both sides of the file, so possibly
-				## use a two way pass
-				## First determine which side to cut first before cutting
-				if offset > (filesize - length):
-					p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile,), 'bs=%s' % (offset,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-					(stanout, stanerr) = p.communicate()
-					os.chmod(tmpfile, stat.S_IRWXU)
-					tmptmpfile = open(tmpfile, 'a+b')
-					tmptmpfile.seek(length)
-					tmptmpfile.truncate()
-					tmptmpfile.close()
-				else:
-					tmptmpfile = tempfile.mkstemp(dir=tmpdir)
-					os.fdopen(tmptmpfile[0]).close()
-
-					## sometimes there are some issues with dd and maximum file size
-					## see for example https://bugzilla.redhat.com/show_bug.cgi?id=612839
-					if (length+offset) >= 2147479552:
-						shutil.copy(filename, tmptmpfile[1])
-						os.chmod(tmptmpfile[1], stat.S_IRWXU)
-						truncfile = open(tmptmpfile[1], 'a+b')
-						truncfile.seek(length+offset)
-						truncfile.truncate()
-						truncfile.close()
-					else:
-						## first copy bytes from the front of the file up to a certain length
-						p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmptmpfile[1],), 'bs=%s' % (length+offset,), 'count=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-						(stanout, stanerr) = p.communicate()
-						os.chmod(tmptmpfile[1], stat.S_IRWXU)
-
-					## then copy bytes from the temporary file, but skip 'offset' bytes at the front
-					p = subprocess.Popen(['dd', 'if=%s' % (tmptmpfile[1],), 'of=%s' % (tmpfile,), 'bs=%s' % (offset,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-					(stanout, stanerr) = p.communicate()
-					os.chmod(tmpfile, stat.S_IRWXU)
-					os.unlink(tmptmpfile[1])
+			length = filesize - offset
+		srcfile = open(filename, 'rb')
+		dstfile = open(tmpfile, 'wb')
+		srcfile.seek(offset)
+		bytestocopy = length
+		while bytestocopy > 0:
+			databuffer = srcfile.read(min(bytestocopy, unpackchunksize))
+			if databuffer == '':
+				break
+			dstfile.write(databuffer)
+			bytestocopy -= len(databuffer)
+		dstfile.close()
+		srcfile.close()
 
 ## There are certain routers that have all bytes swapped, because they use 16
 ## bytes NOR flash instead of 8 bytes SPI flash. This is an ugly hack to first
@@ -171,7 +125,7 @@ def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpack
 def searchUnpackByteSwap(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
 	## can't byteswap if there is not an even amount of bytes in the file
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	if filesize % 2 != 0:
 		return ([], blacklist, [], hints)
 	datafile = open(filename, 'rb')
@@ -205,7 +159,7 @@ def searchUnpackByteSwap(filename, tempdir=None, blacklist=[], offsets={}, scane
 			databuffer = datafile.read(1000000)
 		blacklist.append((0, filesize))
 		datafile.close()
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		return ([(tmpdir, 0, filesize)], blacklist, [], hints)
 	return ([], blacklist, [], hints)
 
@@ -238,7 +192,7 @@ def searchUnpackBase64(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 		return ([], blacklist, [], hints)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
 	os.write(tmpfile[0], stanout)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 	if template != None:
 		mvpath = os.path.join(tmpdir, template)
 		if not os.path.exists(mvpath):
@@ -247,7 +201,7 @@ def searchUnpackBase64(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 			except:
 				pass
 	## the whole file is blacklisted
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	blacklist.append((0, filesize))
 	diroffsets.append((tmpdir, 0, filesize))
 	return (diroffsets, blacklist, [], hints)
@@ -274,7 +228,7 @@ def searchUnpackUPX(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, tags, hints)
 	else:
 		## the whole file is blacklisted
-		filesize = os.stat(filename).st_size
+		filesize = getfilesize(filename, scanenv)
 		blacklist.append((0, filesize))
 		tags.append("compressed")
 		tags.append("upx")
@@ -295,7 +249,7 @@ def searchUnpackJavaSerialized(filename, tempdir=None, blacklist=[], offsets={},
 		return ([], blacklist, [], hints)
 
 	## file has to be at least 5 bytes long
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	if filesize < 5:
 		return ([], blacklist, [], hints)
 
@@ -473,7 +427,7 @@ def searchUnpackSwf(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		tmpdir = dirsetup(tempdir, filename, "swf", counter)
 		tmpfile = tempfile.mkstemp(dir=tmpdir)
 		os.write(tmpfile[0], unzswf)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 
 		diroffsets.append((tmpdir, offset, bytesread))
 		blacklist.append((offset, offset + bytesread))
@@ -484,7 +438,7 @@ def searchUnpackSwf(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 
 def searchUnpackJffs2(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	if filesize < 8:
 		return ([], blacklist, [], hints)
 
@@ -564,7 +518,7 @@ def searchUnpackJffs2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 		if jffs2buffer[:-4] in crccache:
 			jffs2crc = crccache[jffs2buffer[:-4]]
 		else:
-			jffs2crc = (binascii.crc32(jffs2buffer[:-4], -1) ^ -1) & 0xffffffff
+			jffs2crc = (_crc32(jffs2buffer[:-4], -1) ^ -1) & 0xffffffff
 			crccache[jffs2buffer[:-4]] = jffs2crc
 		if not jffs2_hdr_crc == jffs2crc:
 			continue
@@ -592,11 +546,11 @@ def unpackJffs2(filename, offset, filesize, tempdir=None, bigendian=False, jffs2
 
 	if jffs2_tmpdir != None:
 		tmpfile = tempfile.mkstemp(dir=jffs2_tmpdir)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		unpackFile(filename, offset, tmpfile[1], jffs2_tmpdir, blacklist=blacklist)
 	else:
 		tmpfile = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		unpackFile(filename, offset, tmpfile[1], tmpdir, blacklist=blacklist)
 
 	res = jffs2.unpackJFFS2(tmpfile[1], tmpdir, bigendian)
@@ -646,7 +600,7 @@ def searchUnpackAr(filename, tempdir=None, blacklist=[], offsets={}, scanenv={},
 		return ([], blacklist, [], hints)
 	if offsets['ar'] == []:
 		return ([], blacklist, [], hints)
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	## extra sanity check for size of the header
 	if filesize < 64:
 		return ([], blacklist, [], hints)
@@ -797,7 +751,7 @@ def searchUnpackISO9660(filename, tempdir=None, blacklist=[], offsets={}, scanen
 	diroffsets = []
 	counter = 1
 	isofile = open(filename, 'rb')
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	## set a few variables that need to be (re)set for each ISO image
 	## contained in the file
@@ -1481,7 +1435,7 @@ def searchUnpackXar(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 	newtags = []
 	counter = 1
 	diroffsets = []
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	xarfile = open(filename, 'rb')
 	for offset in offsets['xar']:
 		xarfile.seek(offset+4)
@@ -1767,11 +1721,11 @@ def unpackTar(filename, offset, tempdir=None, tar_tmpdir=None):
 	if tar_tmpdir != None:
 		tmpfile = tempfile.mkstemp(dir=tar_tmpdir)
 		testtar = tempfile.mkstemp(dir=tar_tmpdir)
-		os.fdopen(testtar[0]).close()
+		os.close(testtar[0])
 	else:
 		tmpfile = tempfile.mkstemp(dir=tmpdir)
 		testtar = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(testtar[0]).close()
+		os.close(testtar[0])
 
 	## first read about 1MB from the tar file and do a very simple rough check to
 	## filter out false positives
@@ -1786,7 +1740,7 @@ def unpackTar(filename, offset, tempdir=None, tar_tmpdir=None):
 		if not tarfile.is_tarfile(tartest.name):
 			os.unlink(testtar[1])
 			## not a tar file, so clean up
-			os.fdopen(tmpfile[0]).close()
+			os.close(tmpfile[0])
 			os.unlink(tmpfile[1])
 			if tempdir == None:
 				os.rmdir(tmpdir)
@@ -1798,7 +1752,7 @@ def unpackTar(filename, offset, tempdir=None, tar_tmpdir=None):
 		(stanout, stanerr) = p.communicate()
 	else:
 		templink = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(templink[0]).close()
+		os.close(templink[0])
 		os.unlink(templink[1])
 		try:
 			os.link(filename, templink[1])
@@ -1811,7 +1765,7 @@ def unpackTar(filename, offset, tempdir=None, tar_tmpdir=None):
 	tarsize = 0
 	if not tarfile.is_tarfile(tmpfile[1]):
 		## not a tar file, so clean up
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		os.unlink(tmpfile[1])
 		if tempdir == None:
 			os.rmdir(tmpdir)
@@ -1831,12 +1785,12 @@ def unpackTar(filename, offset, tempdir=None, tar_tmpdir=None):
 		tar.close()
 	except Exception, e:
 		## not a tar file, so clean up
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		os.unlink(tmpfile[1])
 		if tempdir == None:
 			os.rmdir(tmpdir)
 		return (None, None)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 	os.unlink(tmpfile[1])
 	return (tmpdir, tarsize)
 
@@ -1854,7 +1808,7 @@ def searchUnpackYaffs2(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 
 	## smallest possible file system supported by unpacker is 512 bytes if taking inband
 	## tags into account
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	if filesize < 512:
 		return (diroffsets, blacklist, newtags, hints)
 
@@ -1945,7 +1899,7 @@ def searchUnpackExe(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 	except:
 		## first copy the file to a temporary location
 		tmpmagic = tempfile.mkstemp()
-		os.fdopen(tmpmagic[0]).close()
+		os.close(tmpmagic[0])
 		shutil.copy(filename, tmpmagic[1])
 		mstype = ms.file(tmpmagic[1])
 		os.unlink(tmpmagic[1])
@@ -2033,7 +1987,7 @@ def searchUnpackExe(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			res = unpackRar(filename, 0, tmpdir)
 			if res != None:
 				(endofarchive, rardir) = res
-				filesize = os.stat(filename).st_size
+				filesize = getfilesize(filename, scanenv)
 				diroffsets.append((rardir, 0, filesize))
 				## add the whole binary to the blacklist
 				blacklist.append((0, filesize))
@@ -2157,7 +2111,7 @@ def unpackCab(filename, offset, tempdir=None, blacklist=[]):
 
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir, blacklist=blacklist, length=cabsize)
 
@@ -2211,13 +2165,16 @@ def searchUnpack7z(filename, tempdir=None, blacklist=[], offsets={}, scanenv={},
 			os.rmdir(tmpdir)
 	return (diroffsets, blacklist, tags, hints)
 
+## regular expression to get the compressed size from the output of '7z'
+re7zsize = re.compile("Compressed:\s+(\d+)")
+
 def unpack7z(filename, offset, tempdir=None, blacklist=[]):
 	## first unpack things, write things to a file and return
 	## the directory if the file is not empty
 	## Assumes (for now) that 7z is in the path
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir, blacklist=blacklist)
 
@@ -2240,7 +2197,7 @@ def unpack7z(filename, offset, tempdir=None, blacklist=[]):
 			os.rmdir(tmpdir)
 		return None
 	os.unlink(tmpfile[1])
-	sizeres = re.search("Compressed:\s+(\d+)", stanout)
+	sizeres = re7zsize.search(stanout)
 	if sizeres != None:
 		size7s = int(sizeres.groups()[0])
 	else:
@@ -2254,7 +2211,7 @@ def searchUnpackLzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		return ([], blacklist, [], hints)
 	if offsets['lzip'] == []:
 		return ([], blacklist, [], hints)
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	if filesize < 5:
 		return ([], blacklist, [], hints)
 	diroffsets = []
@@ -2291,7 +2248,7 @@ def unpackLzip(filename, offset, tempdir=None):
 	## Assumes (for now) that lzip is in the path
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir)
 
@@ -2300,7 +2257,7 @@ def unpackLzip(filename, offset, tempdir=None):
 	outtmpfile = tempfile.mkstemp(dir=tmpdir)
 	os.write(outtmpfile[0], stanout)
 	os.fsync(outtmpfile[0])
-	os.fdopen(outtmpfile[0]).close()
+	os.close(outtmpfile[0])
 	if os.stat(outtmpfile[1]).st_size == 0:
 		os.unlink(outtmpfile[1])
 		os.unlink(tmpfile[1])
@@ -2422,7 +2379,7 @@ def unpackLzop(filename, offset, tempdir=None):
 	## Assumes (for now) that lzop is in the path
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir)
 
@@ -2529,7 +2486,7 @@ def searchUnpackXZ(filename, tempdir=None, blacklist=[], offsets={}, scanenv={},
 def unpackXZ(filename, offset, xzsize, template, dotest, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir, length=xzsize)
 
@@ -2545,7 +2502,7 @@ def unpackXZ(filename, offset, xzsize, template, dotest, tempdir=None):
 	p = subprocess.Popen(['xzcat', tmpfile[1]], stdout=outtmpfile[0], stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
 	os.fsync(outtmpfile[0])
-	os.fdopen(outtmpfile[0]).close()
+	os.close(outtmpfile[0])
 	if os.stat(outtmpfile[1]).st_size == 0:
 		os.unlink(outtmpfile[1])
 		os.unlink(tmpfile[1])
@@ -2576,6 +2533,10 @@ def unpackXZ(filename, offset, xzsize, template, dotest, tempdir=None):
 					pass
 	return tmpdir
 
+## regular expressions to check the ASCII cpio headers (new and old format)
+recpionew = re.compile('[\w\d]{110}')
+recpioold = re.compile('[\w\d]{76}')
+
 ## Not sure how cpio works if we have a cpio archive within a cpio archive
 ## especially with regards to locating the proper cpio trailer.
 def searchUnpackCpio(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
@@ -2610,14 +2571,14 @@ def searchUnpackCpio(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 			datafile.seek(offset)
 			cpiodata = datafile.read(110)
 			## all characters in cpiodata need to be digits
-			cpiores = re.match('[\w\d]{110}', cpiodata)
+			cpiores = recpionew.match(cpiodata)
 			if cpiores != None:
 				newcpiooffsets.append(offset)
 		elif cpiomagic == '070707':
 			datafile.seek(offset)
 			cpiodata = datafile.read(76)
 			## all characters in cpiodata need to be digits
-			cpiores = re.match('[\w\d]{76}', cpiodata)
+			cpiores = recpioold.match(cpiodata)
 			if cpiores != None:
 				newcpiooffsets.append(offset)
 		else:
@@ -2693,7 +2654,7 @@ def searchUnpackRomfs(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 		res = unpackRomfs(filename, offset, tmpdir, blacklist=blacklist)
 		if res != None:
 			(romfsdir, size) = res
-			filesize = os.stat(filename).st_size
+			filesize = getfilesize(filename, scanenv)
 			if offset == 0 and size == filesize:
 				newtags.append("romfs")
 			diroffsets.append((romfsdir, offset, size))
@@ -2724,7 +2685,7 @@ def unpackRomfs(filename, offset, tempdir=None, unpacktempdir=None, blacklist=[]
 	## It could be a valid romfs, so unpack
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir, blacklist=blacklist)
 
@@ -2778,7 +2739,7 @@ def searchUnpackCramfs(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 	if le_offsets == [] and be_offsets == []:
 		return ([], blacklist, [], hints)
 
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	counter = 1
 	cramfsoffsets = le_offsets + be_offsets
 	diroffsets = []
@@ -2907,7 +2868,7 @@ def searchUnpackCramfs(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 def unpackCramfs(filename, offset, bigendian, cramfslen, oldcramfs, tempdir=None, unpacktempdir=None, blacklist=[]):
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir, length=cramfslen, unpacktempdir=unpacktempdir, blacklist=blacklist)
 
@@ -3042,7 +3003,7 @@ def searchUnpackSquashfs(filename, tempdir=None, blacklist=[], offsets={}, scane
 
 				sqshtmpdir = unpacksetup(tmpdir)
 				tmpfile = tempfile.mkstemp(dir=sqshtmpdir)
-				os.fdopen(tmpfile[0]).close()
+				os.close(tmpfile[0])
 
 				## unpack the file
 				unpackFile(filename, offset, tmpfile[1], tmpdir)
@@ -3109,7 +3070,7 @@ def unpackSquashfsWrapper(filename, offset, squashtype, sevenzipcompression, maj
 	tmpoffset = 0
 
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	## DD-WRT variant uses special magic
 	if squashtype == 'squashfs5' or squashtype == 'squashfs6':
@@ -3435,6 +3396,9 @@ def unpackSquashfsBroadcom40LZMA(filename, offset, tmpdir):
 def unpackSquashfsRalinkLZMA(filename, offset, tmpdir):
 	return unpackSquashfsWithLZMA(filename, offset, "bat-unsquashfs-ralink", tmpdir)
 
+## regular expression to get the size of a squashfs file system from 'file'
+resquashfssize = re.compile(", (\d+) bytes")
+
 ## squashfs variant from Atheros, with LZMA
 def unpackSquashfsAtheros40LZMA(filename, offset, tmpdir):
 	p = subprocess.Popen(['bat-unsquashfs-atheros40', '-d', tmpdir, '-f', filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
@@ -3463,7 +3427,7 @@ def unpackSquashfsAtheros40LZMA(filename, offset, tmpdir):
 	if p.returncode != 0:
 		return None
 	else:
-		squashsize = int(re.search(", (\d+) bytes", stanout).groups()[0])
+		squashsize = int(resquashfssize.search(stanout).groups()[0])
 	return (tmpdir, squashsize)
 
 ## squashfs variant from Broadcom, with zlib and LZMA
@@ -3593,7 +3557,7 @@ def unpackFAT(filename, offset, fattype, tempdir=None, unpackenv={}):
 	totalsize = totalnumberofsectors * bytespersector
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir, length=totalsize)
 	return (tmpdir, totalsize)
@@ -3636,7 +3600,7 @@ def unpackMinix(filename, offset, tempdir=None, unpackenv={}, unpacktempdir=None
 	## the directory if the file is not empty
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir)
 
@@ -3678,7 +3642,7 @@ def searchUnpackExt2fs(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 	unpackenv = os.environ.copy()
 	unpackenv['PATH'] = unpackenv['PATH'] + ":/sbin"
 
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	for offset in offsets['ext2']:
 		## according to /usr/share/magic the magic header starts at 0x438
@@ -3717,7 +3681,7 @@ def searchUnpackExt2fs(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 
 		tmpfile = tempfile.mkstemp()
 		os.write(tmpfile[0], ext2checkdata)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		## perform a sanity check
 		p = subprocess.Popen(['tune2fs', '-l', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, env=unpackenv)
 		(stanout, stanerr) = p.communicate()
@@ -3808,7 +3772,7 @@ def unpackExt2fs(filename, offset, ext2length, tempdir=None, unpackenv={}, black
 	## the directory if the file is not empty
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir,length=ext2length, blacklist=blacklist)
 
@@ -3850,9 +3814,9 @@ def gzipcrc32(filename):
 	datafile = open(filename, 'rb')
 	datafile.seek(0)
 	databuffer = datafile.read(10000000)
-	crc32 = binascii.crc32('')
+	crc32 = _crc32('')
 	while databuffer != '':
-		crc32 = binascii.crc32(databuffer, crc32)
+		crc32 = _crc32(databuffer, crc32)
 		databuffer = datafile.read(10000000)
 	datafile.close()
 	crc32 = crc32 & 0xffffffff
@@ -3893,6 +3857,10 @@ def searchUnpackKnownGzip(filename, tempdir=None, scanenv={}, debug=False):
 			return (diroffsets, blacklist, newtags, hints)
 	return ([], [], [], {})
 
+## template for raw deflate decompression objects. Copying it is cheaper than
+## creating and initialising a new object for every candidate offset.
+deflatetemplate = zlib.decompressobj(-zlib.MAX_WBITS)
+
 def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
 	if not 'gzip' in offsets:
@@ -3906,8 +3874,18 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 	template = None
 	if 'TEMPLATE' in scanenv:
 		template = scanenv['TEMPLATE']
-	for offset in offsets['gzip']:
-		blacklistoffset = extractor.inblacklist(offset, blacklist)
+
+	## map the file once, instead of opening it several times for every
+	## offset just to read a few bytes
+	gzipfd = os.open(filename, os.O_RDONLY)
+	gzipmm = mmap.mmap(gzipfd, 0, access=mmap.ACCESS_READ)
+	os.close(gzipfd)
+	## remove the offsets that are in the blacklist in one go. Only the
+	## regions that are added to the blacklist in this loop need to be
+	## checked for every offset.
+	blacklistlen = len(blacklist)
+	for offset in extractor.filterblacklist(offsets['gzip'], blacklist):
+		blacklistoffset = extractor.inblacklist(offset, blacklist[blacklistlen:])
 		if blacklistoffset != None:
 			continue
 
@@ -3919,10 +3897,9 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		## 1. check if "FEXTRA" is set. If so, don't continue searching for the name
 		## 2. check if "FNAME" is set. If so, it follows immediately after MTIME
 		## TODO: also process if FEXTRA is set
-		gzipfile = open(filename, 'rb')
-		gzipfile.seek(offset+3)
-		gzipbyte = gzipfile.read(1)
-		gzipfile.close()
+		gzipbyte = gzipmm[offset+3:offset+4]
+		if gzipbyte == '':
+			continue
 		hasnameset = False
 		hascrc16 = False
 		hascomment = False
@@ -3946,32 +3923,27 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 			## reserved
 			continue
 
-		gzipfile = open(filename, 'rb')
 		localoffset = offset+10
 		renamename = None
 		comment = None
+		## the name and the comment are both NUL terminated
 		if hasnameset:
-			renamename = ''
-			gzipfile.seek(localoffset)
-			gzipbyte = gzipfile.read(1)
-			localoffset += 1
-			while gzipbyte != '\0':
-				renamename += gzipbyte
-				gzipbyte = gzipfile.read(1)
-				localoffset += 1
+			nameend = gzipmm.find('\0', localoffset)
+			if nameend == -1:
+				continue
+			renamename = gzipmm[localoffset:nameend]
+			localoffset = nameend + 1
 		if hascomment:
-			comment = ''
-			gzipfile.seek(localoffset)
-			gzipbyte = gzipfile.read(1)
-			localoffset += 1
-			while gzipbyte != '\0':
-				comment += gzipbyte
-				gzipbyte = gzipfile.read(1)
-				localoffset += 1
+			commentend = gzipmm.find('\0', localoffset)
+			if commentend == -1:
+				continue
+			comment = gzipmm[localoffset:commentend]
+			localoffset = commentend + 1
 		if hascrc16:
 			localoffset += 2
-		gzipfile.seek(localoffset)
-		compresseddataheader = gzipfile.read(1)
+		compresseddataheader = gzipmm[localoffset:localoffset+1]
+		if compresseddataheader == '':
+			continue
 
 		## simple check for deflate
 		bfinal = (ord(compresseddataheader) >> 0 & 1)
@@ -3979,7 +3951,6 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		btype2 = (ord(compresseddataheader) >> 2 & 1)
 		if btype1 == 1 and btype2 == 1:
 			## according to RFC 1951 this is an error
-			gzipfile.close()
 			continue
 
 		## Because gzip is a header followed by deflate data it is
@@ -3988,13 +3959,16 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		## try to uncompress raw deflate data, first one block of
 		## a bit less than 10 meg
 		## http://www.zlib.net/manual.html#Advanced
-		gzipfile.seek(localoffset)
+		## The output of each decompress() call is capped at readsize
+		## as well, so bogus data cannot make zlib produce gigabytes of
+		## data in one go. Any input that was not processed because of
+		## this is kept in unconsumed_tail.
 		readsize = 10000000
-		deflatedata = gzipfile.read(readsize)
-		deflateobj = zlib.decompressobj(-zlib.MAX_WBITS)
+		deflatedata = gzipmm[localoffset:localoffset+readsize]
+		deflateobj = deflatetemplate.copy()
 		deflatesize = 0
 		try:
-			uncompresseddata = deflateobj.decompress(deflatedata)
+			uncompresseddata = deflateobj.decompress(deflatedata, readsize)
 			## check if there is some uncompressed data left. For a completely
 			## uncompressed ## file there should be some data left (8 bytes, namely
 			## CRC32 and file size). If there is no data left, then it means that
@@ -4002,28 +3976,46 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 			if deflateobj.unused_data != "":
 				deflatesize = len(deflatedata) - len(deflateobj.unused_data)
 		except:
-			gzipfile.close()
 			continue
 
-		tmpdir = dirsetup(tempdir, filename, "gzip", counter)
-		tmpfile = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(tmpfile[0]).close()
-
-		outgzipfile = open(tmpfile[1], 'wb')
-		outgzipfile.write(uncompresseddata)
-		outgzipfile.flush()
 		## The size of the *raw* deflate data is gzipsize,
 		## followed by the crc32 of the uncompresed data
 		## and the size
-		unpackfailure = False
-		if deflatesize == 0:
+		if deflatesize != 0:
+			## all data was uncompressed in one go, so the CRC32 and the
+			## size can be computed in memory. The data is only written
+			## to disk if the gzip trailer matches.
+			tmpdir = None
+			crc32 = _crc32(uncompresseddata) & 0xffffffff
+			uncompressedsize = len(uncompresseddata)
+		else:
+			tmpdir = dirsetup(tempdir, filename, "gzip", counter)
+			tmpfile = tempfile.mkstemp(dir=tmpdir)
+			os.close(tmpfile[0])
+
+			outgzipfile = open(tmpfile[1], 'wb')
+			outgzipfile.write(uncompresseddata)
+			outgzipfile.flush()
+			unpackfailure = False
 			while deflateobj.unused_data == "":
+				if deflateobj.unconsumed_tail != "":
+					## first process the input left over from the
+					## previous call. 'deflatedata' is not changed, as
+					## the unused data is always at the end of it.
+					try:
+						uncompresseddata = deflateobj.decompress(deflateobj.unconsumed_tail, readsize)
+						outgzipfile.write(uncompresseddata)
+						outgzipfile.flush()
+					except:
+						unpackfailure = True
+						break
+					continue
 				localoffset += readsize
-				deflatedata = gzipfile.read(readsize)
+				deflatedata = gzipmm[localoffset:localoffset+readsize]
 				if deflatedata == '':
 					break
 				try:
-					uncompresseddata = deflateobj.decompress(deflatedata)
+					uncompresseddata = deflateobj.decompress(deflatedata, readsize)
 					outgzipfile.write(uncompresseddata)
 					outgzipfile.flush()
 				except:
@@ -4031,39 +4023,41 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 					unpackfailure = True
 					break
 			deflatesize = len(deflatedata) - len(deflateobj.unused_data)
-		deflateobj.flush()
-		outgzipfile.close()
+			deflateobj.flush()
+			outgzipfile.close()
 
-		if unpackfailure:
-			gzipfile.close()
-			os.unlink(tmpfile[1])
-			os.rmdir(tmpdir)
-			continue
+			if unpackfailure:
+				os.unlink(tmpfile[1])
+				os.rmdir(tmpdir)
+				continue
+			crc32 = gzipcrc32(tmpfile[1])
+			uncompressedsize = os.stat(tmpfile[1]).st_size
 
 		## The trailer of a valid gzip file is the CRC32 followed by file
 		## size of uncompressed data
-		crc32 = gzipcrc32(tmpfile[1])
-
-		gzipfile.seek(localoffset + deflatesize)
-		gzipcrc32andsize = gzipfile.read(8)
+		gzipcrc32andsize = gzipmm[localoffset+deflatesize:localoffset+deflatesize+8]
 
+		validtrailer = True
 		if len(gzipcrc32andsize) != 8:
-			gzipfile.close()
-			os.unlink(tmpfile[1])
-			os.rmdir(tmpdir)
+			validtrailer = False
+		elif gzipcrc32andsize[0:4] != struct.pack('<I', crc32):
+			validtrailer = False
+		elif gzipcrc32andsize[4:8] != struct.pack('<I', uncompressedsize):
+			validtrailer = False
+
+		if not validtrailer:
+			if tmpdir != None:
+				os.unlink(tmpfile[1])
+				os.rmdir(tmpdir)
 			continue
 
-		if gzipcrc32andsize[0:4] != struct.pack('<I', crc32):
-			gzipfile.close()
-			os.unlink(tmpfile[1])
-			os.rmdir(tmpdir)
-			continue
-		filesize = os.stat(tmpfile[1]).st_size
-		if gzipcrc32andsize[4:8] != struct.pack('<I', filesize):
-			gzipfile.close()
-			os.unlink(tmpfile[1])
-			os.rmdir(tmpdir)
-			continue
+		if tmpdir == None:
+			## the data was only kept in memory, so write it out
+			tmpdir = dirsetup(tempdir, filename, "gzip", counter)
+			tmpfile = tempfile.mkstemp(dir=tmpdir)
+			outgzipfile = os.fdopen(tmpfile[0], 'wb')
+			outgzipfile.write(uncompresseddata)
+			outgzipfile.close()
 
 		## the size of the gzip data is the size of the deflate data,
 		## plus 4 bytes for crc32 and 4 bytes for file size, plus
@@ -4104,7 +4098,7 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 						gzpath = os.path.join(tmpdir, filenamenoext)
 						if not os.path.exists(gzpath):
 							shutil.move(tmpfile[1], gzpath)
-		gzipfile.close()
+	gzipmm.close()
 
 	return (diroffsets, blacklist, newtags, hints)
 
@@ -4120,16 +4114,22 @@ def searchUnpackCompress(filename, tempdir=None, blacklist=[], offsets={}, scane
 
 	counter = 1
 	diroffsets = []
-	compressfile = open(filename, 'rb')
-	for offset in offsets['compress']:
-		blacklistoffset = extractor.inblacklist(offset, blacklist)
+	## map the file once and read the headers straight from the mapping
+	compressfd = os.open(filename, os.O_RDONLY)
+	compressmm = mmap.mmap(compressfd, 0, access=mmap.ACCESS_READ)
+	os.close(compressfd)
+	## remove the offsets that are in the blacklist in one go. Only the
+	## regions that are added to the blacklist in this loop need to be
+	## checked for every offset.
+	blacklistlen = len(blacklist)
+	for offset in extractor.filterblacklist(offsets['compress'], blacklist):
+		blacklistoffset = extractor.inblacklist(offset, blacklist[blacklistlen:])
 		if blacklistoffset != None:
 			continue
 		## according to the specification the "bits per code" has
 		## to be 9 <= bits per code <= 16
 		## The "bits per code" field is masked with 0x1f
-		compressfile.seek(offset+2)
-		compressdata = compressfile.read(1)
+		compressdata = compressmm[offset+2:offset+3]
 		if len(compressdata) != 1:
 			break
 		compressbits = ord(compressdata) & 0x1f
@@ -4142,8 +4142,7 @@ def searchUnpackCompress(filename, tempdir=None, blacklist=[], offsets={}, scane
 		## data, so as a first test read 1 MiB of data and then
 		## try to decompress it.
 		## If no data could be uncompressed return
-		compressfile.seek(offset)
-		compressdata = compressfile.read(1048576)
+		compressdata = compressmm[offset:offset+1048576]
 
 		p = subprocess.Popen(['uncompress'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		(stanout, stanerr) = p.communicate(compressdata)
@@ -4166,7 +4165,7 @@ def searchUnpackCompress(filename, tempdir=None, blacklist=[], offsets={}, scane
 		else:
 			## cleanup
 			os.rmdir(tmpdir)
-	compressfile.close()
+	compressmm.close()
 	return (diroffsets, blacklist, [], hints)
 
 def unpackCompress(filename, offset, compresslimit, tempdir=None, compress_tmpdir=None, blacklist=[]):
@@ -4175,18 +4174,18 @@ def unpackCompress(filename, offset, compresslimit, tempdir=None, compress_tmpdi
 	## if UNPACK_TEMPDIR is set to for example a ramdisk use that instead.
 	if compress_tmpdir != None:
 		tmpfile = tempfile.mkstemp(dir=compress_tmpdir)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		outtmpfile = tempfile.mkstemp(dir=compress_tmpdir)
 		unpackFile(filename, offset, tmpfile[1], compress_tmpdir, blacklist=blacklist)
 	else:
 		tmpfile = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 		outtmpfile = tempfile.mkstemp(dir=tmpdir)
 		unpackFile(filename, offset, tmpfile[1], tmpdir, blacklist=blacklist)
 
 	p = subprocess.Popen(['uncompress', '-c', tmpfile[1]], stdout=outtmpfile[0], stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
-	os.fdopen(outtmpfile[0]).close()
+	os.close(outtmpfile[0])
 	os.unlink(tmpfile[1])
 	if os.stat(outtmpfile[1]).st_size < compresslimit:
 		os.unlink(outtmpfile[1])
@@ -4249,15 +4248,22 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 	counter = 1
 	newtags = []
 	bzip2datasize = 10000000
-	for offset in offsets['bz2']:
-		blacklistoffset = extractor.inblacklist(offset, blacklist)
+
+	## map the file once, instead of opening it several times for every
+	## offset just to read a few bytes
+	bzfd = os.open(filename, os.O_RDONLY)
+	bzmm = mmap.mmap(bzfd, 0, access=mmap.ACCESS_READ)
+	os.close(bzfd)
+	## remove the offsets that are in the blacklist in one go. Only the
+	## regions that are added to the blacklist in this loop need to be
+	## checked for every offset.
+	blacklistlen = len(blacklist)
+	for offset in extractor.filterblacklist(offsets['bz2'], blacklist):
+		blacklistoffset = extractor.inblacklist(offset, blacklist[blacklistlen:])
 		if blacklistoffset != None:
 			continue
 		## sanity check: block size is byte number 4 in the header
-		bzfile = open(filename, 'rb')
-		bzfile.seek(offset + 3)
-		blocksizebyte = bzfile.read(1)
-		bzfile.close()
+		blocksizebyte = bzmm[offset+3:offset+4]
 		try:
 			blocksizebyte = int(blocksizebyte)
 		except:
@@ -4266,10 +4272,9 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 			continue
 
 		## some more sanity checks based on bzip2's decompress.c
-		bzfile = open(filename, 'rb')
-		bzfile.seek(offset + 4)
-		blockbytes = bzfile.read(6)
-		bzfile.close()
+		blockbytes = bzmm[offset+4:offset+10]
+		if len(blockbytes) != 6:
+			continue
 
 		## first check if this is a stream or a regular file
 		if blockbytes[0] != '\x17':
@@ -4288,10 +4293,7 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 				continue
 
 		## extra sanity check: try to uncompress a few blocks of data
-		bzfile = open(filename, 'rb')
-		bzfile.seek(offset)
-		bzip2data = bzfile.read(bzip2datasize)
-		bzfile.close()
+		bzip2data = bzmm[offset:offset+bzip2datasize]
 		bzip2decompressobj = bz2.BZ2Decompressor()
 		bzip2size = 0
 		try:
@@ -4308,7 +4310,7 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 		tmpdir = dirsetup(tempdir, filename, "bzip2", counter)
 		if bzip2size != 0:
 			tmpfile = tempfile.mkstemp(dir=tmpdir)
-			os.fdopen(tmpfile[0]).close()
+			os.close(tmpfile[0])
 
 			outbzip2file = open(tmpfile[1], 'wb')
 			outbzip2file.write(uncompresseddata)
@@ -4337,15 +4339,13 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 		else:
 			## try to load more data into the bzip2 decompression object
 			localoffset = offset + bzip2datasize
-			bzfile = open(filename, 'rb')
-			bzfile.seek(localoffset)
-			bzip2data = bzfile.read(bzip2datasize)
+			bzip2data = bzmm[localoffset:localoffset+bzip2datasize]
 			unpackingerror = False
 			bytesread = bzip2datasize
 			unpackedbytessize = len(uncompresseddata)
 
 			tmpfile = tempfile.mkstemp(dir=tmpdir)
-			os.fdopen(tmpfile[0]).close()
+			os.close(tmpfile[0])
 
 			outbzip2file = open(tmpfile[1], 'wb')
 			outbzip2file.write(uncompresseddata)
@@ -4365,8 +4365,8 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 					bytesread += len(bzip2data) - len(bzip2decompressobj.unused_data)
 					break
 				bytesread += len(bzip2data)
-				bzip2data = bzfile.read(bzip2datasize)
-			bzfile.close()
+				localoffset += bzip2datasize
+				bzip2data = bzmm[localoffset:localoffset+bzip2datasize]
 			outbzip2file.close()
 			if unpackingerror:
 				## cleanup
@@ -4395,6 +4395,7 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 				## cleanup
 				os.unlink(tmpfile[1])
 				os.rmdir(tmpdir)
+	bzmm.close()
 	return (diroffsets, blacklist, newtags, hints)
 
 def searchUnpackRZIP(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
@@ -4441,7 +4442,7 @@ def unpackRZIP(filename, offset, rzipsize, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
 
 	tmpfile = tempfile.mkstemp(dir=tempdir, suffix='.rz')
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir)
 
@@ -4466,15 +4467,17 @@ def searchUnpackAndroidSparse(filename, tempdir=None, blacklist=[], offsets={},
 	diroffsets = []
 	counter = 1
 	tags = []
+
+	## map the file once and read the headers straight from the mapping
+	sparsefd = os.open(filename, os.O_RDONLY)
+	sparsemm = mmap.mmap(sparsefd, 0, access=mmap.ACCESS_READ)
+	os.close(sparsefd)
 	for offset in offsets['android-sparse']:
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
 		if blacklistoffset != None:
 			continue
 		## first see if the major version is correct
-		sparsefile = open(filename, 'rb')
-		sparsefile.seek(offset+4)
-		sparsedata = sparsefile.read(2)
-		sparsefile.close()
+		sparsedata = sparsemm[offset+4:offset+6]
 		if len(sparsedata) != 2:
 			break
 		majorversion = struct.unpack('<H', sparsedata)[0]
@@ -4492,8 +4495,57 @@ def searchUnpackAndroidSparse(filename, tempdir=None, blacklist=[], offsets={},
 		else:
 			## cleanup
 			os.rmdir(tmpdir)
+	sparsemm.close()
 	return (diroffsets, blacklist, tags, hints)
 
+## Android sparse chunk header (see sparse_format.h), little endian:
+## chunk type (2 bytes), unused (2 bytes), chunk size, total size
+sparsechunkheader = struct.Struct('<2s2xLL')
+
+## Lookup table for the Android sparse chunk types, indexed by the first byte
+## of the chunk type (the second byte is always 0xca). Each valid entry is a
+## tuple (raw, size): the size of the chunk data is 'chunk size' * 'block size'
+## for RAW chunks, or a fixed size for the other chunk types.
+sparsechunktypes = [None] * 256
+## RAW
+sparsechunktypes[0xc1] = (1, 0)
+## FILL
+sparsechunktypes[0xc2] = (0, 4)
+## DON'T CARE
+sparsechunktypes[0xc3] = (0, 0)
+## CRC
+sparsechunktypes[0xc4] = (0, 4)
+
+## Walk 'chunkcount' Android sparse chunk headers in 'data', starting at
+## 'seekctr'. Returns the offset right after the last chunk, or None if an
+## invalid or truncated chunk is found. Everything that is used in the loop
+## is bound to a local variable to keep the per chunk overhead down.
+def walkAndroidSparseChunks(data, seekctr, chunkcount, blocksize):
+	unpack_from = sparsechunkheader.unpack_from
+	chunktypes = sparsechunktypes
+	datalen = len(data)
+	for i in xrange(0,chunkcount):
+		## a truncated chunk header means this is not a valid file
+		if seekctr + 12 > datalen:
+			return None
+		## read the chunk header
+		## 0 - 1 : chunk type
+		## 2 - 3 : unused
+		## 4 - 7 : chunk size (for raw)
+		## 8 - 12 : total size
+		(chunktype, chunksize, totalsize) = unpack_from(data, seekctr)
+		if chunktype[1] != '\xca':
+			return None
+		chunkkind = chunktypes[ord(chunktype[0])]
+		if chunkkind == None:
+			## dunno what's happening here, so exit
+			return None
+		(raw, datasize) = chunkkind
+		if raw:
+			datasize = chunksize * blocksize
+		seekctr = seekctr + 12 + datasize
+	return seekctr
+
 def unpackAndroidSparse(filename, offset, tempdir=None):
 	## checks to find the right size
 	## First check the size of the header. If it has some
@@ -4520,50 +4572,27 @@ def unpackAndroidSparse(filename, offset, tempdir=None):
 	blocksize = struct.unpack('<L', sparsedata[12:16])[0]
 	chunkcount = struct.unpack('<L', sparsedata[20:24])[0]
 
-	## now reopen the file and read each chunk header.
-	sparsefile = open(filename, 'rb')
+	## now map the file and parse each chunk header directly from the
+	## mapping, instead of doing a seek() and read() for every chunk.
+	sparsefd = os.open(filename, os.O_RDONLY)
+	sparsemm = mmap.mmap(sparsefd, 0, access=mmap.ACCESS_READ)
+	os.close(sparsefd)
 
-	## keep a counter to see how many bytes were read. After unpacking
-	## this will indicate the size of the sparse file
-	seekctr = offset + 28
-	for i in xrange(0,chunkcount):
-		sparsefile.seek(seekctr)
-		## read the chunk header
-		sparsedata = sparsefile.read(12)
-		## 0 - 1 : chunk type
-		## 2 - 3 : unused
-		## 4 - 7 : chunk size (for raw)
-		## 8 - 12 : total size
-		chunktype = sparsedata[0:2]
-		if chunktype == '\xc1\xca':
-			## RAW
-			chunksize = struct.unpack('<L', sparsedata[4:8])[0]
-			datasize = chunksize * blocksize
-		elif chunktype == '\xc2\xca':
-			## FILL
-			datasize = 4
-		elif chunktype == '\xc3\xca':
-			## DON'T CARE
-			datasize = 0
-		elif chunktype == '\xc4\xca':
-			## CRC
-			datasize = 4
-		else:
-			## dunno what's happening here, so exit
-			sparsefile.close()
-			return None
-		seekctr = seekctr + 12 + datasize
-	sparsefile.close()
+	## walk all the chunk headers to find out the size of the sparse file
+	seekctr = walkAndroidSparseChunks(sparsemm, offset + 28, chunkcount, blocksize)
+	sparsemm.close()
+	if seekctr == None:
+		return None
 
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir, length=seekctr)
 
 	## write the data out to a temporary file
 	outtmpfile = tempfile.mkstemp(dir=tempdir)
-	os.fdopen(outtmpfile[0]).close()
+	os.close(outtmpfile[0])
 
 	p = subprocess.Popen(['bat-simg2img', tmpfile[1], outtmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
@@ -4657,7 +4686,7 @@ def searchUnpackAndroidSparseDataImage(filename, tempdir=None, blacklist=[], off
 
 	## hardcoded in the Android source code
 	blocksize = 4096
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	## now process all the commands
 	## The lines should be structured as:
@@ -4739,7 +4768,12 @@ def searchUnpackLRZIP(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 	lrzipmajorversions = [0]
 	lrzipminorversions = [0,1,2,3,4,5,6,7,8]
 
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
+
+	## map the file once and read the headers straight from the mapping
+	lrzipfd = os.open(filename, os.O_RDONLY)
+	lrzipmm = mmap.mmap(lrzipfd, 0, access=mmap.ACCESS_READ)
+	os.close(lrzipfd)
 
 	for offset in offsets['lrzip']:
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
@@ -4748,10 +4782,9 @@ def searchUnpackLRZIP(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 
 		## read the lrzip header, which is 24 bytes
 		## https://github.com/ckolivas/lrzip/blob/master/doc/magic.header.txt
-		lrzipfile = open(filename, 'rb')
-		lrzipfile.seek(offset)
-		lrzipheader = lrzipfile.read(24)
-		lrzipfile.close()
+		lrzipheader = lrzipmm[offset:offset+24]
+		if len(lrzipheader) != 24:
+			continue
 
 		lrzipversionbytes = lrzipheader[4:6]
 		lrzipmajorversion = ord(lrzipversionbytes[0])
@@ -4779,10 +4812,7 @@ def searchUnpackLRZIP(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 
 		lrzipmd5 = None
 		if hasmd5:
-			lrzipfile = open(filename, 'rb')
-			lrzipfile.seek(-16, os.SEEK_END)
-			lrzipmd5bytes = lrzipfile.read(16)
-			lrzipfile.close()
+			lrzipmd5bytes = lrzipmm[-16:]
 			lrzipmd5 = lrzipmd5bytes.encode('hex')
 
 		tmpdir = dirsetup(tempdir, filename, "lrzip", counter)
@@ -4798,13 +4828,14 @@ def searchUnpackLRZIP(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 		else:
 			## cleanup
 			os.rmdir(tmpdir)
+	lrzipmm.close()
 	return (diroffsets, blacklist, tags, hints)
 
 def unpackLRZIP(filename, offset, hasmd5, lrzipmd5, lrzipsize, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
 
 	tmpfile = tempfile.mkstemp(dir=tempdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	outtmpfile = tempfile.mkstemp(dir=tempdir)
 
@@ -4813,7 +4844,7 @@ def unpackLRZIP(filename, offset, hasmd5, lrzipmd5, lrzipsize, tempdir=None):
 	p = subprocess.Popen(['lrzcat', tmpfile[1]], stdout=outtmpfile[0], stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
 	os.fsync(outtmpfile[0])
-	os.fdopen(outtmpfile[0]).close()
+	os.close(outtmpfile[0])
 	if p.returncode != 0:
 		## depending on the output of lrzcat it might still be
 		## valid data, that might be followed by other data
@@ -4901,9 +4932,7 @@ def unpackLRZIP(filename, offset, hasmd5, lrzipmd5, lrzipsize, tempdir=None):
 
 	return (tmpdir, md5match, os.stat(filename).st_size)
 
-def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycutoff, tempdir=None):
-	filesize = os.stat(filename).st_size
-
+def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycutoff, filesize, tempdir=None):
 	inmemory = False
 	havetmpfile = False
 	if offset != 0 or cutoff != filesize:
@@ -4923,10 +4952,19 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 			openzipfile.seek(offset)
 			zipdata = openzipfile.read(ziplen)
 			openzipfile.close()
-			memfile = StringIO.StringIO(zipdata)
+			## cStringIO wraps the data without copying it and, unlike
+			## StringIO, does not run any Python code for read() and seek()
+			memfile = cStringIO.StringIO(zipdata)
+		elif cutoff == filesize:
+			## the ZIP file runs until the end of the file, so it can be
+			## read straight from the original file, as the zipfile module
+			## corrects the offsets for any data in front of the ZIP file.
+			## This avoids carving a possibly very large file first.
+			inmemory = False
+			memfile = filename
 		else:
 			tmpfile = tempfile.mkstemp(dir=tempdir)
-			os.fdopen(tmpfile[0]).close()
+			os.close(tmpfile[0])
 
 			if cutoff != 0:
 				unpackFile(filename, offset, tmpfile[1], tmpdir, length=ziplen)
@@ -4943,10 +4981,17 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 		## Also check if the file contains encrypted entries.
 		weirdzip = False
 		weirdzipnames = set()
+		## sorted list of all names in the ZIP file. All names that start
+		## with a certain name directly follow that name in this list, so
+		## only one name has to be checked per entry.
+		sortedzipnames = None
 		for i in infolist:
 			if i.file_size == 0:
 				if not i.filename.endswith('/'):
-					if filter(lambda x: x.filename.startswith(i.filename) and not x.filename == i.filename, infolist) != []:
+					if sortedzipnames == None:
+						sortedzipnames = sorted(map(lambda x: x.filename, infolist))
+					nextnameindex = bisect.bisect_right(sortedzipnames, i.filename)
+					if nextnameindex < len(sortedzipnames) and sortedzipnames[nextnameindex].startswith(i.filename):
 						weirdzip = True
 						weirdzipnames.add(i.filename)
 			if i.flag_bits & 0x01 == 1:
@@ -4959,20 +5004,39 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 						## write out the data if it is not already there
 						tmpdir = unpacksetup(tempdir)
 						tmpfile = tempfile.mkstemp(dir=tempdir)
-						os.fdopen(tmpfile[0]).close()
+						os.close(tmpfile[0])
 
 						datafile = open(tmpfile[1], 'wb')
 						datafile.write(zipdata)
 						datafile.close()
+				elif offset != 0:
+					## the ZIP file was read from the original file,
+					## so carve it, as the caller expects a file
+					tmpfile = tempfile.mkstemp(dir=tempdir)
+					os.close(tmpfile[0])
+					unpackFile(filename, offset, tmpfile[1], tmpdir)
 
 				return (tmpdir, ['encrypted'])
 		if not havetmpfile:
 			tmpdir = unpacksetup(tempdir)
+		if weirdzip:
+			## first create the directories for the weird entries, parents
+			## before children, so a single mkdir is enough in most cases
+			## and extracting the entries in these directories cannot
+			## make the mkdir fail.
+			for weirdzipname in sorted(weirdzipnames, key=lambda x: x.count('/')):
+				weirdzipdir = os.path.join(tmpdir, weirdzipname)
+				try:
+					os.mkdir(weirdzipdir)
+				except OSError, e:
+					## the parent directory is not there yet, or the
+					## directory was already created
+					if not os.path.isdir(weirdzipdir):
+						os.makedirs(weirdzipdir)
 		for i in infolist:
 			if weirdzip and i.filename in weirdzipnames:
-				os.mkdir(os.path.join(tmpdir, i.filename))
-			else:
-				memzipfile.extract(i, tmpdir)
+				continue
+			memzipfile.extract(i, tmpdir)
 		memzipfile.close()
 		if havetmpfile:
 			os.unlink(tmpfile[1])
@@ -4982,12 +5046,11 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 				os.unlink(tmpfile[1])
 			else:
 				memfile.close()
-		for i in os.listdir(tmpdir):
-			try:
-				os.unlink(os.path.join(tmpdir, i))
-				continue
-			except:
-				shutil.rmtree(os.path.join(tmpdir, i))
+		## remove anything that was already extracted in one go. The
+		## (empty) directory is expected to exist by the caller, so recreate
+		## it instead of removing the entries one by one.
+		shutil.rmtree(tmpdir)
+		os.mkdir(tmpdir)
 		return (None, [])
 	if inmemory:
 		if not havetmpfile:
@@ -5000,19 +5063,18 @@ def searchUnpackKnownZip(filename, tempdir=None, scanenv={}, debug=False):
 	datafile.close()
 	if databuffer != fsmagic.fsmagic['zip']:
 		return ([], [], [], {})
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	## try to find an end of central dir. A ZIP file comment can be 65535
-	## characters long, so at maximum 65535 + 22 characters should be read,
-	## perhaps a few more just in case
+	## characters long, so the end of central dir can be anywhere in the
+	## last 65535 + 22 bytes. Let Python's zipfile module find it, as it
+	## searches from the end of the file and knows about ZIP64.
 	datafile = open(filename, 'rb')
-	datafile.seek(max(0,min(filesize, filesize-(65535+30))))
-	offset = datafile.tell()
-	databuffer = datafile.read()
+	endrecord = zipfile._EndRecData(datafile)
 	datafile.close()
-	zipend = databuffer.find(fsmagic.fsmagic['zipend']) + offset
-	if zipend == -1:
+	if endrecord == None:
 		return ([], [], [], {})
+	zipend = endrecord[zipfile._ECD_LOCATION]
 	## then try unpacking it.
 	res = searchUnpackZip(filename, tempdir, [], {'zip': [0], 'zipend': [zipend]}, scanenv, debug)
 	(diroffsets, blacklist, newtags, hints) = res
@@ -5041,6 +5103,12 @@ def searchUnpackKnownZip(filename, tempdir=None, scanenv={}, debug=False):
 			return (diroffsets, blacklist, newtags, hints)
 	return ([], [], [], {})
 
+## ZIP end of central directory record, after the signature, little endian:
+## number of this disk, disk with the central directory, entries in the
+## central directory on this disk, total entries in the central directory,
+## size of the central directory, offset of the central directory, comment size
+zipendrecord = struct.Struct('<HHHHIIH')
+
 ## Carve and unpack ZIP files
 def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
@@ -5055,7 +5123,7 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, tags, hints)
 	diroffsets = []
 	counter = 1
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	## read the parameter for the maximum file size that should be read into
 	## memory from the configuration. Default: 50 million bytes.
@@ -5063,7 +5131,11 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		memorycutoff = int(scanenv.get('ZIP_MEMORY_CUTOFF', 50000000))
 	except:
 		memorycutoff = 50000000
-	zipfile = open(filename, 'rb')
+	## map the file, so all the header fields can be read straight from
+	## the mapping without any seek() and read() calls
+	zipfd = os.open(filename, os.O_RDONLY)
+	zipmm = mmap.mmap(zipfd, 0, access=mmap.ACCESS_READ)
+	os.close(zipfd)
 
 	zipends = []
 	## first check all the potential end of central dir offsets in the file and filter
@@ -5074,23 +5146,22 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		if blacklistoffset != None:
 			continue
 
-		## first check a few things in the ZIP file, as they have to make sense
-		zipfile.seek(zipend+4)
-		numberofthisdisk = struct.unpack('<H', zipfile.read(2))[0]
-		diskwithcentraldirectory = struct.unpack('<H', zipfile.read(2))[0]
-		entriesincentraldirectorythisdisk = struct.unpack('<H', zipfile.read(2))[0]
-		entriesincentraldirectory = struct.unpack('<H', zipfile.read(2))[0]
+		## the end of central directory is at least 22 bytes
+		if zipend + 22 > filesize:
+			continue
+
+		## first check a few things in the ZIP file, as they have to make sense.
+		## All fields of the end of central directory record (including the
+		## size of the ZIP file comment) are read in one go.
+		(numberofthisdisk, diskwithcentraldirectory, entriesincentraldirectorythisdisk, entriesincentraldirectory, sizeofcentraldirectory, offsetofcentraldirectory, commentsize) = zipendrecord.unpack_from(zipmm, zipend+4)
 
 		## the size of the central directory entries. This cannot be larger than
 		## the file itself
-		sizeofcentraldirectory = struct.unpack('<I', zipfile.read(4))[0]
 		if sizeofcentraldirectory > filesize:
 			continue
 
 		## the start of the central directory entries in the ZIP file (relative
-		## to the start of the file)
-		offsetofcentraldirectory = struct.unpack('<I', zipfile.read(4))[0]
-
+		## to the start of the file).
 		## These cannot be outside of the file (relative)
 		if offsetofcentraldirectory > filesize:
 			continue
@@ -5098,11 +5169,6 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		if offsetofcentraldirectory > zipend:
 			continue
 
-		## check if there is any ZIP file comment
-		zipfile.seek(zipend + 20)
-		commentdata = zipfile.read(2)
-		commentsize = struct.unpack('<H', commentdata)[0]
-
 		## comment cannot extend beyond the file
 		if zipend + 22 + commentsize > filesize:
 			continue
@@ -5110,15 +5176,27 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		cutoff = zipend + 22 + commentsize
 		zipends.append((zipend, cutoff, offsetofcentraldirectory))
 
-	## then walk all the ZIP offsets and see if anything can be unpacked
-	for offset in offsets['zip']:
+	## then walk all the ZIP offsets and see if anything can be unpacked.
+	## Both the ZIP offsets and the end of central directory offsets are
+	## walked in ascending order, so the end of central directory records
+	## that are in front of the current ZIP offset (and can never be used
+	## again) are skipped by moving a cursor instead of checking them for
+	## every ZIP offset.
+	zipends.sort()
+	zipendindex = 0
+	for offset in sorted(offsets['zip']):
+		while zipendindex < len(zipends) and zipends[zipendindex][0] < offset:
+			zipendindex += 1
+		if zipendindex == len(zipends):
+			break
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
 		if blacklistoffset != None:
 			continue
+		## a local file header is at least 30 bytes
+		if offset + 30 > filesize:
+			continue
 		## some more sanity checks
-		zipfile.seek(offset+4)
-		versionneededbytes = zipfile.read(2)
-		versionneeded = struct.unpack('<H', versionneededbytes)[0]
+		versionneeded = struct.unpack_from('<H', zipmm, offset+4)[0]
 
 		## https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
 		## section 4.4.3.2
@@ -5129,15 +5207,11 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		## extra sanity checks: read the name of the first local file header
 		## and match it with the name of the first entry of the central
 		## directory.
-		zipfile.seek(offset+26)
-		namesize = struct.unpack('<H', zipfile.read(2))[0]
-		zipfile.seek(offset+30)
-		firstfilename = zipfile.read(namesize)
+		namesize = struct.unpack_from('<H', zipmm, offset+26)[0]
+		firstfilename = zipmm[offset+30:offset+30+namesize]
 
-		for z in zipends:
+		for z in zipends[zipendindex:]:
 			(zipend, cutoff, offsetofcentraldirectory) = z
-			if offset > zipend:
-				continue
 
 			blacklistoffset = extractor.inblacklist(zipend, blacklist)
 			if blacklistoffset != None:
@@ -5153,29 +5227,28 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 				continue
 
 			## sanity check: the central directory entry should be valid
-			zipfile.seek(offset+offsetofcentraldirectory)
-			centraldirheader = zipfile.read(4)
-			if centraldirheader != "PK\x01\x02":
+			## and is at least 46 bytes
+			centraldiroffset = offset + offsetofcentraldirectory
+			if centraldiroffset + 46 > filesize:
+				continue
+			if zipmm[centraldiroffset:centraldiroffset+4] != "PK\x01\x02":
 				continue
 
 			## the name of the first entry in the central directory should match
 			## the name of the first entry in the local file header
-			zipfile.seek(offset+offsetofcentraldirectory+28)
-			filenamelengthdir = struct.unpack('<H', zipfile.read(2))[0]
-			zipfile.seek(offset+offsetofcentraldirectory+46)
-			if not firstfilename == zipfile.read(filenamelengthdir):
+			filenamelengthdir = struct.unpack_from('<H', zipmm, centraldiroffset+28)[0]
+			if not firstfilename == zipmm[centraldiroffset+46:centraldiroffset+46+filenamelengthdir]:
 				continue
 
 			## relative offset: assume it is 0 but not sure if this is
 			## correct. TODO: find out and if needed fix.
-			zipfile.seek(offset+offsetofcentraldirectory+42)
-			reloffset = struct.unpack('<I', zipfile.read(4))[0]
+			reloffset = struct.unpack_from('<I', zipmm, centraldiroffset+42)[0]
 			if reloffset != 0:
 				continue
 
 			tmpdir = dirsetup(tempdir, filename, "zip", counter)
 			endofcentraldir = zipend - offset
-			(res, tmptags) = unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycutoff, tmpdir)
+			(res, tmptags) = unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycutoff, filesize, tmpdir)
 			if res != None:
 				blacklist.append((offset, zipend + 22 + commentsize))
 				if offset == 0 and zipend + commentsize + 22 == filesize:
@@ -5198,7 +5271,7 @@ def searchUnpackZip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 				break
 			else:
 				os.rmdir(tmpdir)
-	zipfile.close()
+	zipmm.close()
 	return (diroffsets, blacklist, tags, hints)
 
 def searchUnpackPack200(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
@@ -5218,7 +5291,7 @@ def searchUnpackPack200(filename, tempdir=None, blacklist=[], offsets={}, scanen
 	tmpdir = dirsetup(tempdir, filename, "pack200", 1)
 	res = unpackPack200(filename, tmpdir)
 	if res != None:
-		filesize = os.stat(filename).st_size
+		filesize = getfilesize(filename, scanenv)
 		diroffsets.append((res, 0, filesize))
 		blacklist.append((0, filesize))
 	else:
@@ -5230,12 +5303,12 @@ def unpackPack200(filename, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
 
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, 0, tmpfile[1], tmpdir)
 
 	packtmpfile = tempfile.mkstemp(dir=tmpdir, suffix=".jar")
-	os.fdopen(packtmpfile[0]).close()
+	os.close(packtmpfile[0])
 
 	p = subprocess.Popen(['unpack200', tmpfile[1], packtmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
 	(stanout, stanerr) = p.communicate()
@@ -5277,6 +5350,10 @@ def searchUnpackRar(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			os.rmdir(tmpdir)
 	return (diroffsets, blacklist, [], hints)
 
+## regular expression to get the size of a RAR archive from the last line of
+## the output of 'unrar vvt'
+rerarsize = re.compile("\s*\d+\s*\d+\s+(\d+)\s+\d+%")
+
 def unpackRar(filename, offset, tempdir=None):
 	## according to various sites the marker header is
 	## followed by an archive header, of which the block type is 0x73
@@ -5294,33 +5371,45 @@ def unpackRar(filename, offset, tempdir=None):
 
 	## Assumes (for now) that unrar is in the path
 	tmpdir = unpacksetup(tempdir)
-	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
 
-	unpackFile(filename, offset, tmpfile[1], tmpdir)
+	## if the RAR file starts at the beginning of the file then unrar can
+	## use the file directly, instead of a (linked) copy of it
+	if offset == 0:
+		rarinfile = filename
+	else:
+		tmpfile = tempfile.mkstemp(dir=tmpdir)
+		os.close(tmpfile[0])
+
+		unpackFile(filename, offset, tmpfile[1], tmpdir)
+		rarinfile = tmpfile[1]
 
 	# inspect the rar archive, and retrieve the end of archive
 	# this way we won't waste too many resources when we don't need to
 	## TODO: unrar needs vvt now to work correctly?
-	p = subprocess.Popen(['unrar', 'vvt', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
+	p = subprocess.Popen(['unrar', 'vvt', rarinfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
 	#p = subprocess.Popen(['unrar', 'vt', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
 	(stanout, stanerr) = p.communicate()
 	if p.returncode != 0:
-		os.unlink(tmpfile[1])
+		if offset != 0:
+			os.unlink(tmpfile[1])
 		if tempdir == None:
 			os.rmdir(tmpdir)
 		return None
 	rarstring = stanout.strip().split("\n")[-1]
-	res = re.search("\s*\d+\s*\d+\s+(\d+)\s+\d+%", rarstring)
+	res = rerarsize.search(rarstring)
 	if res != None:
 		endofarchive = int(res.groups(0)[0]) + offset
 	else:
-		os.unlink(tmpfile[1])
+		if offset != 0:
+			os.unlink(tmpfile[1])
 		if tempdir == None:
 			os.rmdir(tmpdir)
 		return None
-	p = subprocess.Popen(['unrar', 'x', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
-	(stanout, stanerr) = p.communicate()
+	## the output of unrar is not used, so discard it
+	devnull = open(os.devnull, 'w')
+	p = subprocess.Popen(['unrar', 'x', rarinfile], stdout=devnull, stderr=devnull, close_fds=True, cwd=tmpdir)
+	p.wait()
+	devnull.close()
 	## oh the horror, we really need to check if unrar actually was successful
 	#outtmpfile = tempfile.mkstemp(dir=tmpdir)
 	#os.write(outtmpfile[0], stanout)
@@ -5328,9 +5417,17 @@ def unpackRar(filename, offset, tempdir=None):
 		#os.unlink(outtmpfile[1])
 		#os.unlink(tmpfile[1])
 		#return None
-	os.unlink(tmpfile[1])
+	if offset != 0:
+		os.unlink(tmpfile[1])
 	return (endofarchive, tmpdir)
 
+## uncompressed size in the LZMA header (8 bytes, little endian)
+lzmasizefield = struct.Struct('<Q')
+
+## the most significant bytes of the dictionary sizes that are seen in
+## practice in LZMA headers, see searchUnpackLZMA()
+lzmadictbytes = frozenset(['\x01\x00', '\x02\x00', '\x03\x00', '\x04\x00', '\x06\x00', '\x08\x00', '\x10\x00', '\x20\x00', '\x30\x00', '\x40\x00', '\x60\x00', '\x80\x00', '\x80\x01', '\x0c\x00', '\x18\x00', '\x00\x00', '\x00\x01', '\x00\x02', '\x00\x03', '\x00\x04', '\xc0\x00'])
+
 ## unpack LZMA compressed data. Uncompressing LZMA is difficult,
 ## as it is a stream without a fixed header and theoretically millions
 ## and millions of possible variations. In practice only a few seem
@@ -5342,7 +5439,7 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		lzmaoffsets = lzmaoffsets + offsets[marker]
 	if lzmaoffsets == []:
 		return ([], blacklist, [], hints)
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	## LZMA files should at least have a full header
 	if filesize < 13:
 		return ([], blacklist, [], hints)
@@ -5356,7 +5453,9 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		template = scanenv['TEMPLATE']
 
 	lzmalimit = int(scanenv.get('LZMA_MINIMUM_SIZE', 1))
-	lzma_file = open(filename, 'rb')
+	lzmafd = os.open(filename, os.O_RDONLY)
+	lzmamm = mmap.mmap(lzmafd, 0, access=mmap.ACCESS_READ)
+	os.close(lzmafd)
 
 	## see if LZMA_TRY_ALL is set. This option will disable the sanity checks.
 	## This is not recommended.
@@ -5369,8 +5468,12 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 
 	lzma_tmpdir = scanenv.get('UNPACK_TEMPDIR', None)
 
-	for offset in lzmaoffsets:
-		blacklistoffset = extractor.inblacklist(offset, blacklist)
+	## remove the offsets that are in the blacklist in one go. Only the
+	## regions that are added to the blacklist in this loop need to be
+	## checked for every offset.
+	blacklistlen = len(blacklist)
+	for offset in extractor.filterblacklist(lzmaoffsets, blacklist):
+		blacklistoffset = extractor.inblacklist(offset, blacklist[blacklistlen:])
 		if blacklistoffset != None:
 			continue
 		if filesize - offset < 13:
@@ -5392,16 +5495,11 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		## but could use refinement.
 		## Values were computed based on dictionary size 2^n or 2^n+2^(n-1), with 16 <= n <= 25
 		if not lzma_try_all:
-			lzma_file.seek(offset + 3)
-			lzmacheckbyte = lzma_file.read(2)
-			if lzmacheckbyte not in ['\x01\x00', '\x02\x00', '\x03\x00', '\x04\x00', '\x06\x00', '\x08\x00', '\x10\x00', '\x20\x00', '\x30\x00', '\x40\x00', '\x60\x00', '\x80\x00', '\x80\x01', '\x0c\x00', '\x18\x00', '\x00\x00', '\x00\x01', '\x00\x02', '\x00\x03', '\x00\x04', '\xc0\x00']:
+			if lzmamm[offset+3:offset+5] not in lzmadictbytes:
 				continue
 
 		## sanity checks to see if the size is set.
-		lzmafile = open(filename, 'rb')
-		lzmafile.seek(offset+5)
-		lzmasizebytes = lzmafile.read(8)
-		lzmafile.close()
+		lzmasizebytes = lzmamm[offset+5:offset+13]
 		if len(lzmasizebytes) != 8:
 			continue
 
@@ -5415,7 +5513,7 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		## at all, it is not a valid LZMA stream.
 		lzmasizeknown = False
 		if lzmasizebytes != '\xff\xff\xff\xff\xff\xff\xff\xff':
-			lzmasize = struct.unpack('<Q', lzmasizebytes)[0]
+			lzmasize = lzmasizefield.unpack(lzmasizebytes)[0]
 			## XZ Utils rejects files with uncompressed size of 256 GiB
 			if lzmasize > 274877906944:
 				continue
@@ -5429,28 +5527,23 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		minlzmadatatoread = 10000000
 		lzmabytestoread = min(filesize-offset, minlzmadatatoread)
 
-		lzmafile = open(filename, 'rb')
-		lzmafile.seek(offset)
-		lzmadata = lzmafile.read(lzmabytestoread)
+		lzmadata = lzmamm[offset:offset+lzmabytestoread]
 		if len(lzmadata) < 14:
-			lzmafile.close()
 			continue
 
 		if not lzma_try_all:
 			if not lzmadata[14] == '\x00':
-				lzmafile.close()
 				continue
 
 		p = subprocess.Popen(['lzma', '-cd', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 		(stanout, stanerr) = p.communicate(lzmadata)
 		if p.returncode == 0:
-			lzmafile.close()
 			## whole stream successfully unpacked and there was
 			## no trailing data
 			tmpdir = dirsetup(tempdir, filename, "lzma", counter)
 			tmpfile = tempfile.mkstemp(dir=tmpdir)
 			os.write(tmpfile[0], stanout)
-			os.fdopen(tmpfile[0]).close()
+			os.close(tmpfile[0])
 			diroffsets.append((tmpdir, offset, len(lzmadata)))
 			blacklist.append((offset, offset+len(lzmadata)))
 			counter += 1
@@ -5459,16 +5552,14 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		if len(stanout) == 0:
 			## no data was successfully unpacked, so this is not
 			## a valid LZMA stream
-			lzmafile.close()
 			continue
 
 		## The data seems to be a valid LZMA stream, but not all LZMA
 		## data was unpacked.
-		if lzmafile.tell() == filesize:
+		if offset + lzmabytestoread == filesize:
 			## dunno what to do in this case
 			pass
 
-		lzmafile.close()
 		## If there is a very big difference (thousandfold) between
 		## the unpacked data and the declared size it is a false positive
 		## for sure
@@ -5488,7 +5579,7 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 				tmpdir = dirsetup(tempdir, filename, "lzma", counter)
 				tmpfile = tempfile.mkstemp(dir=tmpdir)
 				os.write(tmpfile[0], stanout)
-				os.fdopen(tmpfile[0]).close()
+				os.close(tmpfile[0])
 				diroffsets.append((tmpdir, offset, 0))
 				counter += 1
 				continue
@@ -5501,7 +5592,7 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		## has been repeated
 
 		tmpdir = dirsetup(tempdir, filename, "lzma", counter)
-		res = unpackLZMA(filename, offset, template, tmpdir, lzmalimit, lzma_tmpdir, blacklist)
+		res = unpackLZMA(filename, offset, lzmasizebytes, template, tmpdir, lzmalimit, lzma_tmpdir, blacklist)
 		if res != None:
 			(diroffset, wholefile) = res
 			if wholefile:
@@ -5518,7 +5609,7 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		else:
 			## cleanup
 			os.rmdir(tmpdir)
-	lzma_file.close()
+	lzmamm.close()
 	return (diroffsets, blacklist, newtags, hints)
 
 ## tries to unpack stuff using lzma -cd. If it is successful, it will
@@ -5526,38 +5617,39 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 ## Newer versions of XZ (>= 5.0.0) have an option to test and list archives.
 ## Unfortunately this does not work for files with trailing data, so we can't
 ## use it to filter out "bad" files.
-def unpackLZMA(filename, offset, template, tempdir=None, minbytesize=1, lzma_tmpdir=None, blacklist=[]):
+def unpackLZMA(filename, offset, lzmasizebytes, template, tempdir=None, minbytesize=1, lzma_tmpdir=None, blacklist=[]):
 	tmpdir = unpacksetup(tempdir)
 
 	## if UNPACK_TEMPDIR is set to for example a ramdisk use that instead.
 	if lzma_tmpdir != None:
-		tmpfile = tempfile.mkstemp(dir=lzma_tmpdir)
-		os.fdopen(tmpfile[0]).close()
-		outtmpfile = tempfile.mkstemp(dir=lzma_tmpdir)
-		unpackFile(filename, offset, tmpfile[1], lzma_tmpdir, blacklist=blacklist)
+		lzmaworkdir = lzma_tmpdir
 	else:
-		tmpfile = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(tmpfile[0]).close()
-		outtmpfile = tempfile.mkstemp(dir=tmpdir)
-		unpackFile(filename, offset, tmpfile[1], tmpdir, blacklist=blacklist)
-	p = subprocess.Popen(['lzma', '-cd', tmpfile[1]], stdout=outtmpfile[0], stderr=subprocess.PIPE, close_fds=True)
+		lzmaworkdir = tmpdir
+	outtmpfile = tempfile.mkstemp(dir=lzmaworkdir)
+
+	## if the LZMA data starts at the beginning of the file and is not cut
+	## short by anything in the blacklist, then 'lzma' can use the file
+	## directly, instead of a (linked) copy of it
+	if offset == 0 and extractor.lowestnextblacklist(offset, blacklist) == 0:
+		lzmainfile = filename
+	else:
+		tmpfile = tempfile.mkstemp(dir=lzmaworkdir)
+		os.close(tmpfile[0])
+		unpackFile(filename, offset, tmpfile[1], lzmaworkdir, blacklist=blacklist)
+		lzmainfile = tmpfile[1]
+	p = subprocess.Popen(['lzma', '-cd', lzmainfile], stdout=outtmpfile[0], stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
 	wholefile = False
 	if p.returncode == 0:
 		wholefile = True
-	os.fdopen(outtmpfile[0]).close()
-	os.unlink(tmpfile[1])
-
-	## sanity checks if the size is set
-	lzmafile = open(filename, 'rb')
-	lzmafile.seek(offset+5)
-	lzmasizebytes = lzmafile.read(8)
-	lzmafile.close()
+	os.close(outtmpfile[0])
+	if lzmainfile != filename:
+		os.unlink(lzmainfile)
 
 	## check if the size of the uncompressed data is recorded
 	## in the binary
 	if lzmasizebytes != '\xff\xff\xff\xff\xff\xff\xff\xff':
-		lzmasize = struct.unpack('<Q', lzmasizebytes)[0]
+		lzmasize = lzmasizefield.unpack(lzmasizebytes)[0]
 		if os.stat(outtmpfile[1]).st_size != lzmasize:
 			os.unlink(outtmpfile[1])
 			if tempdir == None:
@@ -5607,20 +5699,16 @@ def searchUnpackUbi(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, [], hints)
 	if offsets['ubi'] == []:
 		return ([], blacklist, [], hints)
-	datafile = open(filename, 'rb')
 	## We can use the values of offset and ubisize where offset != -1
 	## to determine the ranges for the blacklist.
 	diroffsets = []
 	counter = 1
-	## TODO: big file fixes
-	data = datafile.read()
-	datafile.close()
 	for offset in offsets['ubi']:
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
 		if blacklistoffset != None:
 			continue
 		tmpdir = dirsetup(tempdir, filename, "ubi", counter)
-		res = unpackUbi(data, offset, tmpdir)
+		res = unpackUbi(filename, offset, tmpdir)
 		if res != None:
 			(ubitmpdir, ubisize) = res
 			diroffsets.append((ubitmpdir, offset, ubisize))
@@ -5632,17 +5720,22 @@ def searchUnpackUbi(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			os.rmdir(tmpdir)
 	return (diroffsets, blacklist, [], hints)
 
-def unpackUbi(data, offset, tempdir=None):
+def unpackUbi(filename, offset, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
+	## carve the data from the file instead of reading the whole
+	## file into memory first
 	tmpfile = tempfile.mkstemp()
-	os.write(tmpfile[0], data[offset:])
+	os.close(tmpfile[0])
+	unpackFile(filename, offset, tmpfile[1], tmpdir)
 	## take a two step approach: first unpack the UBI images,
-	## then extract the individual files from these images
-	p = subprocess.Popen(['ubi_extract_images.py', '-o', tmpdir, tmpfile[1]], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-	(stanout, stanerr) = p.communicate()
+	## then extract the individual files from these images.
+	## The output of the extraction scripts is not used, so discard it.
+	devnull = open(os.devnull, 'w')
+	p = subprocess.Popen(['ubi_extract_images.py', '-o', tmpdir, tmpfile[1]], stdin=subprocess.PIPE, stdout=devnull, stderr=devnull, close_fds=True)
+	p.communicate()
+	devnull.close()
 
 	if p.returncode != 0:
-		os.fdopen(tmpfile[0]).close()
 		os.unlink(tmpfile[1])
 		if tempdir == None:
 			os.rmdir(tmpdir)
@@ -5651,33 +5744,51 @@ def unpackUbi(data, offset, tempdir=None):
 		p = subprocess.Popen(['ubi_display_info.py', tmpfile[1]], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 		(stanout, stanerr) = p.communicate()
 		if p.returncode != 0:
-			os.fdopen(tmpfile[0]).close()
 			os.unlink(tmpfile[1])
 			if tempdir == None:
 				os.rmdir(tmpdir)
 			return None
 
+		## only the first block size and block count are needed, so stop
+		## looking as soon as both have been found
+		blocksize = None
+		blockcount = None
 		stanoutlines = stanout.split('\n')
 		for s in stanoutlines:
-			if 'PEB Size' in s:
-				blocksize = int(s.split(':')[1].strip())
-        		if 'Total Block Count' in s:
-				blockcount = int(s.split(':')[1].strip())
+			if blocksize == None and 'PEB Size' in s:
+				blocksize = int(s.split(':', 1)[1].strip())
+			elif blockcount == None and 'Total Block Count' in s:
+				blockcount = int(s.split(':', 1)[1].strip())
+			if blocksize != None and blockcount != None:
+				break
+
+		if blocksize == None or blockcount == None:
+			os.unlink(tmpfile[1])
+			shutil.rmtree(os.path.join(tmpdir, os.path.basename(tmpfile[1])))
+			if tempdir == None:
+				os.rmdir(tmpdir)
+			return None
 
 		ubisize = blocksize * blockcount
 
 		## clean up the temporary files
-		os.fdopen(tmpfile[0]).close()
 		os.unlink(tmpfile[1])
 		## determine the sum of the size of the unpacked files
 
 		## now the second stage, unpacking the images that were extracted
 
+		## The images are independent of each other, so start extracting
+		## all of them at once and only then wait for the results.
 		ubitmpdir = os.path.join(tmpdir, os.path.basename(tmpfile[1]))
+		ubiprocesses = []
+		devnull = open(os.devnull, 'w')
 		for i in os.listdir(ubitmpdir):
-			p = subprocess.Popen(['ubi_extract_files.py', '-o', tmpdir, os.path.join(ubitmpdir, i)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-			(stanout, stanerr) = p.communicate()
+			p = subprocess.Popen(['ubi_extract_files.py', '-o', tmpdir, os.path.join(ubitmpdir, i)], stdin=subprocess.PIPE, stdout=devnull, stderr=devnull, close_fds=True)
+			ubiprocesses.append((i, p))
+		for (i, p) in ubiprocesses:
+			p.communicate()
 			os.unlink(os.path.join(ubitmpdir, i))
+		devnull.close()
 
 		os.rmdir(ubitmpdir)
 
@@ -5721,7 +5832,7 @@ def searchUnpackARJ(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 def unpackARJ(filename, offset, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir, suffix=".arj")
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 
 	unpackFile(filename, offset, tmpfile[1], tmpdir)
 
@@ -5735,17 +5846,23 @@ def unpackARJ(filename, offset, tempdir=None):
 			os.rmdir(tmpdir)
 		return None
 	else:
-		p = subprocess.Popen(['arj', 'x', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
-		(stanout, stanerr) = p.communicate()
+		## the archive is valid, so extract it and, at the same time,
+		## list it to get the size, instead of waiting for the extraction
+		## to finish before starting the next process.
+		## the output of the extraction is not used, so discard it
+		devnull = open(os.devnull, 'w')
+		p = subprocess.Popen(['arj', 'x', tmpfile[1]], stdout=devnull, stderr=devnull, close_fds=True, cwd=tmpdir)
+		pv = subprocess.Popen(['arj', 'v', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
+		(liststanout, liststanerr) = pv.communicate()
+		p.wait()
+		devnull.close()
 		if p.returncode != 0:
 			os.unlink(tmpfile[1])
 			if tempdir == None:
 				os.rmdir(tmpdir)
 			return None
 	## everything has been unpacked, so we can get the size.
-	p = subprocess.Popen(['arj', 'v', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, cwd=tmpdir)
-	(stanout, stanerr) = p.communicate()
-	stanoutlines = stanout.strip().split("\n")
+	stanoutlines = liststanout.strip().split("\n")
 	## we should do more sanity checks here
 	arjsize = int(stanoutlines[-1].split()[-2])
 	## always clean up the old temporary files
@@ -5844,7 +5961,7 @@ def searchUnpackMSI(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, [], hints)
 	if not "msi" in offsets:
 		return ([], blacklist, [], hints)
-	if not 0 in offsets['msi']:
+	if offsets['msi'] == [] or offsets['msi'][0] != 0:
 		return ([], blacklist, [], hints)
 	diroffsets = []
 	newtags = []
@@ -5871,7 +5988,7 @@ def searchUnpackCHM(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, [], hints)
 	if not "chm" in offsets:
 		return ([], blacklist, [], hints)
-	if not 0 in offsets['chm']:
+	if offsets['chm'] == [] or offsets['chm'][0] != 0:
 		return ([], blacklist, [], hints)
 	diroffsets = []
 	newtags = []
@@ -5897,6 +6014,9 @@ def searchUnpackCHM(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 ## because that results in endless loops.
 ###
 
+## regular expression to find the offset of the xref table in a PDF trailer
+restartxref = re.compile('startxref\s+(\d+)\s+')
+
 ## PDFs end with %%EOF, sometimes followed by one or two extra characters
 ## See http://www.adobe.com/devnet/pdf/pdf_reference.html
 ## The structure is described in section 7.5
@@ -5912,7 +6032,7 @@ def searchUnpackPDF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, [], hints)
 	diroffsets = []
 	counter = 1
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	for offset in offsets['pdf']:
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
@@ -5953,7 +6073,7 @@ def searchUnpackPDF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 
 			## startxref is followed by whitespace and then a number indicating
 			## the byte offset for a possible xref table.
-			xrefres = re.search('startxref\s+(\d+)\s+', pdfbytes)
+			xrefres = restartxref.search(pdfbytes)
 			if xrefres == None:
 				continue
 
@@ -6023,7 +6143,7 @@ def searchUnpackPDF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			pdffile.close()
 
 			tmpdir = dirsetup(tempdir, filename, "pdf", counter)
-			res = unpackPDF(filename, offset, trailer, tmpdir)
+			res = unpackPDF(filename, offset, trailer, filesize, tmpdir)
 			if res != None:
 				(pdfdir, size) = res
 				if offset == 0 and (filesize - 2) <= size <= filesize:
@@ -6043,16 +6163,15 @@ def searchUnpackPDF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 
 	return (diroffsets, blacklist, [], hints)
 
-def unpackPDF(filename, offset, trailer, tempdir=None):
+def unpackPDF(filename, offset, trailer, filesize, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
-	filesize = os.stat(filename).st_size
+	os.close(tmpfile[0])
 
 	## if the data is the whole file we can just hardlink
 	if offset == 0 and (trailer + 5 == filesize or trailer + 5 == filesize-1 or trailer + 5 == filesize-2):
 		templink = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(templink[0]).close()
+		os.close(templink[0])
 		os.unlink(templink[1])
 
 		try:
@@ -6063,21 +6182,22 @@ def unpackPDF(filename, offset, trailer, tempdir=None):
 			shutil.copy(filename, templink[1])
 		shutil.move(templink[1], tmpfile[1])
 	else:
-		## first we use 'dd' or tail. Then we use truncate
-		if offset < 128:
-			tmptmpfile = open(tmpfile[1], 'wb')
-			p = subprocess.Popen(['tail', filename, '-c', "%d" % (filesize - offset)], stdout=tmptmpfile, stderr=subprocess.PIPE, close_fds=True)
-			(stanout, stanerr) = p.communicate()
-			tmptmpfile.close()
-		else:
-			p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile[1],), 'bs=%s' % (offset,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-			(stanout, stanerr) = p.communicate()
+		## copy just the PDF data (up to and including %%EOF) in chunks,
+		## instead of first carving the tail of the file with 'dd' or
+		## 'tail' and then cutting off the trailing data with 'truncate'
 		pdflength = trailer + 5 - offset
-		p = subprocess.Popen(['truncate', "-s", "%d" % pdflength, tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-		(stanout, stanerr) = p.communicate()
-		if p.returncode != 0:
-			os.unlink(tmpfile[1])
-			return None
+		pdffile = open(filename, 'rb')
+		pdffile.seek(offset)
+		outpdffile = open(tmpfile[1], 'wb')
+		bytestocopy = pdflength
+		while bytestocopy > 0:
+			pdfdata = pdffile.read(min(bytestocopy, 10485760))
+			if pdfdata == '':
+				break
+			outpdffile.write(pdfdata)
+			bytestocopy -= len(pdfdata)
+		outpdffile.close()
+		pdffile.close()
 
 	p = subprocess.Popen(['pdfinfo', "%s" % (tmpfile[1],)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
@@ -6090,13 +6210,18 @@ def unpackPDF(filename, offset, trailer, tempdir=None):
 		size = os.stat(tmpfile[1]).st_size
 		return (tmpdir, size)
 
+## known sizes of the DIB header in BMP files: BITMAPCOREHEADER (12),
+## OS22XBITMAPHEADER (16 and 64), BITMAPINFOHEADER (40), BITMAPV2INFOHEADER (52),
+## BITMAPV3INFOHEADER (56), BITMAPV4HEADER (108) and BITMAPV5HEADER (124)
+bmpdibheadersizes = set([12, 16, 40, 52, 56, 64, 108, 124])
+
 def searchUnpackBMP(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
 	if not 'bmp' in offsets:
 		return ([], blacklist, [], hints)
 	if offsets['bmp'] == []:
 		return ([], blacklist, [], hints)
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	diroffsets = []
 	newtags = []
 	counter = 1
@@ -6115,16 +6240,28 @@ def searchUnpackBMP(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		bmpsize = struct.unpack('<I', sizebytes)[0]
 		if bmpsize + offset > filesize:
 			break
-		## read 8 bytes more data. The first 4 bytes are for
-		## reserved fields, the last 
-		bmpdata = datafile.read(8)
-		bmpoffset = struct.unpack('<I', bmpdata[4:])[0]
+		## read 12 bytes more data. The first 4 bytes are for
+		## reserved fields, the next 4 bytes are the offset of the
+		## image data, the last 4 bytes are the size of the DIB header
+		## that follows the BMP header.
+		bmpdata = datafile.read(12)
+		if len(bmpdata) != 12:
+			break
+		bmpoffset = struct.unpack('<I', bmpdata[4:8])[0]
 		if bmpoffset + offset > filesize:
 			break
-		## offset for BMP cannot be less than the current
-		## file pointer
-		if bmpoffset + offset < datafile.tell():
+		## offset for BMP cannot be inside the 14 byte BMP header
+		if bmpoffset < 14:
 			break
+		## 'BM' is a very common byte sequence, so first check if the
+		## DIB header looks sane before launching bmptopnm. The size of
+		## the DIB header determines its version, so only a few values
+		## are possible, and the image data comes after the headers.
+		dibheadersize = struct.unpack('<I', bmpdata[8:])[0]
+		if not dibheadersize in bmpdibheadersizes:
+			continue
+		if bmpoffset < 14 + dibheadersize:
+			continue
 		## reset the file pointer and read all needed data
 		datafile.seek(offset)
 		bmpdata = datafile.read(bmpsize)
@@ -6157,6 +6294,20 @@ def searchUnpackBMP(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 
 	return (diroffsets, blacklist, newtags, hints)
 
+## regular expression to find the GIF trailer: a block terminator followed
+## by a semicolon
+regiftrailer = re.compile('\x00;')
+
+## number of candidate GIF files that are checked with gifinfo at the same time
+gifbatchsize = 8
+
+## check a candidate GIF file with gifinfo. This is run from a thread pool,
+## so several candidates can be checked at the same time.
+def gifinfocheck((gifmm, offset, trail)):
+	p = subprocess.Popen(['gifinfo'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	(stanout, stanerr) = p.communicate(gifmm[offset:offset+trail+2])
+	return p.returncode == 0
+
 ## http://en.wikipedia.org/wiki/Graphics_Interchange_Format
 ## 1. search for a GIF header
 ## 2. search for a GIF trailer
@@ -6169,10 +6320,14 @@ def searchUnpackBMP(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 def searchUnpackGIF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
 	gifoffsets = []
+	## The blacklist is checked for every header and for every trailer,
+	## so use an index that can be searched quickly. It has to be rebuilt
+	## whenever something is added to the blacklist.
+	blindex = extractor.blacklistindex(blacklist)
 	for marker in fsmagic.gif:
 		## first check if the header is not blacklisted
 		for m in offsets[marker]:
-			blacklistoffset = extractor.inblacklist(m, blacklist)
+			blacklistoffset = extractor.inblacklistindex(m, blindex)
 			if blacklistoffset != None:
 				continue
 			gifoffsets.append(m)
@@ -6188,8 +6343,16 @@ def searchUnpackGIF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 	xmpmagicheaderbytes = ['\x01'] + map(lambda x: chr(x), range(255,-1,-1)) + ['\x00']
 	xmpmagic = "".join(xmpmagicheaderbytes)
 
-	datafile = open(filename, 'rb')
+	## map the file once. The headers are parsed and the trailers are
+	## searched straight in the mapping, so the (possibly large) data
+	## between a header and the next header is never read into memory.
+	giffd = os.open(filename, os.O_RDONLY)
+	gifmm = mmap.mmap(giffd, 0, access=mmap.ACCESS_READ)
+	os.close(giffd)
 	lendata = os.stat(filename).st_size
+
+	## the thread pool for running gifinfo is only created when it is needed
+	gifpool = None
 	for i in range(0,len(gifoffsets)):
 		offset = gifoffsets[i]
 		if i < len(gifoffsets) - 1:
@@ -6197,23 +6360,26 @@ def searchUnpackGIF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		else:
 			nextoffset = lendata
 		## first check if the header is not blacklisted
-		blacklistoffset = extractor.inblacklist(offset, blacklist)
+		blacklistoffset = extractor.inblacklistindex(offset, blindex)
 		if blacklistoffset != None:
 			continue
 
 		localoffset = offset
 
 		## sanity check for the logical screen descriptor
-		datafile.seek(offset+6)
 		localoffset += 6
 		## first logical screen width
-		databytes = datafile.read(2)
+		databytes = gifmm[localoffset:localoffset+2]
 		localoffset += 2
+		if len(databytes) != 2:
+			continue
 		logicalwidth = struct.unpack('<H', databytes)[0]
 		if logicalwidth == 0:
 			continue
 		## then the logical screen height
-		databytes = datafile.read(2)
+		databytes = gifmm[localoffset:localoffset+2]
+		if len(databytes) != 2:
+			continue
 		logicalheight = struct.unpack('<H', databytes)[0]
 		if logicalheight == 0:
 			continue
@@ -6225,17 +6391,18 @@ def searchUnpackGIF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		## of information in between the logical screen descriptor and the first
 		## information control block, such as a global color table and XMP
 		## extensions or other application specific extensions.
-		packedfields = datafile.read(1)
+		packedfields = gifmm[localoffset:localoffset+1]
+		if packedfields == '':
+			continue
 		localoffset += 1
 		globalcolortablesize = 0
 		if (ord(packedfields) >> 7 & 1) == 1:
 			globalcolortablesize = pow(2,(ord(packedfields)%8) + 1) * 3
 		localoffset += 2
 		localoffset += globalcolortablesize
-		databytes = datafile.seek(localoffset)
 		## then read the next byte to see if it is an extension (0x21)
 		## or an image control block
-		databytes = datafile.read(1)
+		databytes = gifmm[localoffset:localoffset+1]
 		localoffset += 1
 
 		## there could be various extensions before there is an image
@@ -6243,132 +6410,139 @@ def searchUnpackGIF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		while databytes == '\x21':
 			## depending on the extension label a number of bytes
 			## need to be skipped
-			databytes = datafile.read(1)
+			databytes = gifmm[localoffset:localoffset+1]
 			localoffset += 1
 			if databytes == '\xf9':
 				## graphic control extension, 8 bytes in total counting
 				## label and extension identifier
 				localoffset += 6
-				datafile.seek(localoffset)
 			elif databytes == '\xfe':
 				## length of the comment
-				databytes = datafile.read(1)
+				databytes = gifmm[localoffset:localoffset+1]
+				if databytes == '':
+					break
 				localoffset += 1
 				commentsize = ord(databytes)
 				localoffset += commentsize
-				datafile.seek(localoffset)
 			elif databytes == '\xff':
 				## application extension with all other data is 14 bytes
 				## unless it is XMP, in which case it is variable
 				## for details see XMP Specification part 3
 				## TODO: add support for other extensions such
 				## as ICC profiles
-				databytes = datafile.read(1)
+				databytes = gifmm[localoffset:localoffset+1]
 				if databytes != '\x0b':
 					break
 				localoffset += 1
-				databytes = datafile.read(8)
+				databytes = gifmm[localoffset:localoffset+8]
 				localoffset += 8
 				if databytes == 'XMP Data':
-					databytes = datafile.read(1000)
-					magicoffset = databytes.find(xmpmagic)
-					while magicoffset == -1:
-						databuf = datafile.read(1000)
-						## files with a broken XMP trailer
-						## exist, so check if the end of the
-						## file is reached at some point
-						## TODO: check blacklists as well
-						if databuf == '':
-							break
-						databytes += databuf
-						magicoffset = databytes.find(xmpmagic)
+					## files with a broken XMP trailer exist, in which
+					## case the magic trailer cannot be found at all
+					## TODO: check blacklists as well
+					magicoffset = gifmm.find(xmpmagic, localoffset)
+					if magicoffset != -1:
+						magicoffset -= localoffset
 					localoffset += magicoffset + 258
-					datafile.seek(localoffset)
 				else:
 					localoffset += 3
-					datafile.seek(localoffset)
-					databytes = datafile.read(1)
+					databytes = gifmm[localoffset:localoffset+1]
+					if databytes == '':
+						break
 					localoffset += 1
 					blocksize = ord(databytes)
 					localoffset += blocksize
-					datafile.seek(localoffset)
-			databytes = datafile.read(1)
+			databytes = gifmm[localoffset:localoffset+1]
 			localoffset += 1
 			if databytes == '\x00':
-				databytes = datafile.read(1)
+				databytes = gifmm[localoffset:localoffset+1]
 				localoffset += 1
 		if databytes != '\x2c':
 			continue
 
-		## Now read data from the current offset until the next offset
-		## and search for trailer bytes. If these cannot be found, then
-		## move onto the next GIF offset.
+		## Now search the data from the current offset until the next offset
+		## for trailer bytes. If these cannot be found, then move onto the
+		## next GIF offset.
 		## GIF files have a trailer which according to the GIF specification
 		## consists of a "block terminator" and a semi-colon. Since the trailer
 		## is very generic it is best to search for it here instead of in the
 		## top level identifier search which would be quite costly.
-		datafile.seek(offset)
-
-		## read around 10 meg of data
-		gifchunkread = 100000000
-		bytesread = 0
 		giffound = False
-		data = ""
-		trailersearchoffset = 0
-		tmpdir = dirsetup(tempdir, filename, "gif", counter)
-		while bytesread <= nextoffset-offset and not giffound:
-			## concatenation of data is expensive :-(
-			data += datafile.read(gifchunkread)
-			bytesread += gifchunkread
-			traileroffsets = []
-			trailer = data.find('\x00;', trailersearchoffset)
-			while trailer != -1:
+		## let the regular expression engine find the trailers in the
+		## mapping instead of calling find() for every trailer. The
+		## candidates are collected in small batches that are checked
+		## with gifinfo in parallel. The first valid candidate (in order
+		## of the trailers) wins, just like when checking them one by one.
+		lastbatch = False
+		trailers = regiftrailer.finditer(gifmm, offset)
+		while not giffound and not lastbatch:
+			candidates = []
+			while len(candidates) < gifbatchsize:
+				trailerres = next(trailers, None)
+				if trailerres == None:
+					lastbatch = True
+					break
+				trail = trailerres.start() - offset
 				## see if the trailer is actually after the next offset
-				if trailer > nextoffset-offset:
+				if trail > nextoffset-offset:
+					lastbatch = True
 					break
 				## check if the trailer is not blacklisted. If so, then
 				## the trailer and any trailer following it can never be
 				## part of this GIF file.
-				blacklistoffset = extractor.inblacklist(trailer+offset, blacklist)
-				if blacklistoffset == None:
-					traileroffsets.append(trailer)
-				else:
+				blacklistoffset = extractor.inblacklistindex(offset+trail, blindex)
+				if blacklistoffset != None:
+					lastbatch = True
 					break
-				trailersearchoffset = trailer + 2
-				trailer = data.find('\x00;', trailersearchoffset)
+				candidates.append(trail)
+			if candidates == []:
+				break
 
-			for trail in traileroffsets:
+			## every check slices the data from the mapping itself, so
+			## only the candidates that are being checked are in memory
+			if len(candidates) == 1:
+				gifresults = [gifinfocheck((gifmm, offset, candidates[0]))]
+			else:
+				if gifpool == None:
+					gifpool = multiprocessing.pool.ThreadPool(gifbatchsize)
+				gifresults = gifpool.map(gifinfocheck, map(lambda x: (gifmm, offset, x), candidates))
+
+			for c in xrange(0, len(candidates)):
+				if not gifresults[c]:
+					continue
+				trail = candidates[c]
+				giffound = True
+				## basically this is copy of the original image so why bother?
+				if offset == 0 and trail == lendata - 2:
+					blacklist.append((0, lendata))
+					if gifpool != None:
+						gifpool.close()
+						gifpool.join()
+					gifmm.close()
+					return (diroffsets, blacklist, ['graphics', 'gif', 'binary'], hints)
+
+				## not the whole file, so carve. The directory is only
+				## created now that a valid GIF file was found.
 				## TODO: use templates here to make the name of the file more predictable
 				## which helps with result interpretation
-				p = subprocess.Popen(['gifinfo'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-				(stanout, stanerr) = p.communicate(data[:trail+2])
-				if p.returncode != 0:
-					continue
-				else:
-					giffound = True
-					## basically this is copy of the original image so why bother?
-					if offset == 0 and trail == lendata - 2:
-						blacklist.append((0, lendata))
-						datafile.close()
-						os.rmdir(tmpdir)
-						return (diroffsets, blacklist, ['graphics', 'gif', 'binary'], hints)
-
-					## not the whole file, so carve
-					tmpfilename = os.path.join(tmpdir, 'unpack-%d.gif' % counter)
-					tmpfile = open(tmpfilename, 'wb')
-					tmpfile.write(data[:trail+2])
-					tmpfile.close()
-					diroffsets.append((tmpdir, offset, trail+2))
-					hints[tmpfilename] = {}
-					hints[tmpfilename]['tags'] = ['graphics', 'gif', 'binary']
-					hints[tmpfilename]['scanned'] = True
-					counter = counter + 1
-					blacklist.append((offset, offset+trail+2))
-					## go to the next header
-					break
-		if not giffound:
-			os.rmdir(tmpdir)
-	datafile.close()
+				tmpdir = dirsetup(tempdir, filename, "gif", counter)
+				tmpfilename = os.path.join(tmpdir, 'unpack-%d.gif' % counter)
+				tmpfile = open(tmpfilename, 'wb')
+				tmpfile.write(gifmm[offset:offset+trail+2])
+				tmpfile.close()
+				diroffsets.append((tmpdir, offset, trail+2))
+				hints[tmpfilename] = {}
+				hints[tmpfilename]['tags'] = ['graphics', 'gif', 'binary']
+				hints[tmpfilename]['scanned'] = True
+				counter = counter + 1
+				blacklist.append((offset, offset+trail+2))
+				blindex = extractor.blacklistindex(blacklist)
+				## go to the next header
+				break
+	if gifpool != None:
+		gifpool.close()
+		gifpool.join()
+	gifmm.close()
 	return (diroffsets, blacklist, [], hints)
 
 def searchUnpackKnownPNG(filename, tempdir=None, scanenv={}, debug=False):
@@ -6434,13 +6608,26 @@ def searchUnpackPNG(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, [], hints)
 	diroffsets = []
 	headeroffsets = offsets['png']
-	traileroffsets = deque(offsets['pngtrailer'])
+	traileroffsets = sorted(offsets['pngtrailer'])
+	lentraileroffsets = len(traileroffsets)
 	counter = 1
-	datafile = open(filename, 'rb')
+	## map the file, so the chunks can be walked without seeking and
+	## reading for every chunk
+	pngfd = os.open(filename, os.O_RDONLY)
+	pngmm = mmap.mmap(pngfd, 0, access=mmap.ACCESS_READ)
+	os.close(pngfd)
 	orig_offset = headeroffsets[0]
 	lenheaderoffsets = len(headeroffsets)
 
-	trailerpopcounter = 0
+	## both the headers and the trailers are sorted, so remember where
+	## the search for trailers should start for the next header instead
+	## of walking all the earlier trailers again.
+	trailerindex = 0
+
+	## The blacklist is checked for every header and for every trailer,
+	## so use an index that can be searched quickly. It has to be rebuilt
+	## whenever something is added to the blacklist.
+	blindex = extractor.blacklistindex(blacklist)
 
 	for i in range(0,len(headeroffsets)):
 		offset = headeroffsets[i]
@@ -6449,43 +6636,33 @@ def searchUnpackPNG(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		else:
 			nextoffset = lendata
 		## first check if the offset is not blacklisted
-		blacklistoffset = extractor.inblacklist(offset, blacklist)
+		blacklistoffset = extractor.inblacklistindex(offset, blindex)
 		if blacklistoffset != None:
 			continue
 
-		datafile.seek(offset)
-
 		## some sanity checks. According to http://www.w3.org/TR/PNG/
 		## the first chunk in a PNG following the PNG signature is always IHDR.
 		## The PNG signature is 8 bytes
-		datafile.seek(offset+8)
-		chunkbytes = datafile.read(4)
+		chunkbytes = pngmm[offset+8:offset+12]
 		## IHDR chunk size is always 13 bytes
 		#chunksize = struct.unpack('>I', chunkbytes)[0]
 		if chunkbytes != '\x00\x00\x00\x0d':
 			continue
-		chunkbytes = datafile.read(4)
+		chunkbytes = pngmm[offset+12:offset+16]
 		if chunkbytes != 'IHDR':
 			continue
 
-		datafile.seek(offset)
-		for r in xrange(0, trailerpopcounter):
-			traileroffsets.popleft()
-
-		trailerpopcounter = 0
+		## jump to the first trailer after the header
+		trailerindex = bisect.bisect_right(traileroffsets, offset, trailerindex)
 
-		tmpdir = dirsetup(tempdir, filename, "png", counter)
-		pngfound = False
-		for trail in traileroffsets:
-			if trail <= offset:
-				trailerpopcounter += 1
-				continue
+		for t in xrange(trailerindex, lentraileroffsets):
+			trail = traileroffsets[t]
 			if trail >= nextoffset:
 				break
 			## then check if the trailer is not blacklisted. If it
 			## is, then the next trailers can never be valid for this
 			## PNG file either.
-			blacklistoffset = extractor.inblacklist(trail, blacklist)
+			blacklistoffset = extractor.inblacklistindex(trail, blindex)
 			if blacklistoffset != None:
 				break
 
@@ -6495,8 +6672,7 @@ def searchUnpackPNG(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			localoffset = offset + 8
 			trailerseen = False
 			while localoffset <= trail and not trailerseen:
-				datafile.seek(localoffset)
-				pngbytes = datafile.read(8)
+				pngbytes = pngmm[localoffset:localoffset+8]
 				if len(pngbytes) != 8:
 					break
 				localoffset += 8
@@ -6518,16 +6694,14 @@ def searchUnpackPNG(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			localoffset = offset + 8
 			crccorrect = True
 			while localoffset <= trail:
-				datafile.seek(localoffset)
-
 				## grab the size
-				pngbytes = datafile.read(4)
+				pngbytes = pngmm[localoffset:localoffset+4]
 				localoffset += 4
 
 				chunksize = struct.unpack('>I', pngbytes)[0]
-				databytes = datafile.read(chunksize + 4)
-				pngcrc = datafile.read(4)
-				computedcrc = binascii.crc32(databytes) & 0xffffffff
+				databytes = pngmm[localoffset:localoffset+chunksize+4]
+				pngcrc = pngmm[localoffset+chunksize+4:localoffset+chunksize+8]
+				computedcrc = _crc32(databytes) & 0xffffffff
 				if pngcrc != struct.pack('>I', computedcrc):
 					crccorrect = False
 					break
@@ -6542,16 +6716,15 @@ def searchUnpackPNG(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			## image here, so why bother reading and
 			## copying the data again?
 			if offset == 0 and trail == lendata - 12:
-				os.rmdir(tmpdir)
 				blacklist.append((0,lendata))
-				datafile.close()
+				pngmm.close()
 				return (diroffsets, blacklist, ['graphics', 'png', 'binary'], hints)
 
-			## carve the image data from the file and write it to disk
-			datafile.seek(offset)
+			## carve the image data from the file and write it to disk. The
+			## directory is only created now that a valid PNG file was found.
 			pngsize = trail+12-offset
-			data = datafile.read(pngsize)
-			pngfound = True
+			data = pngmm[offset:offset+pngsize]
+			tmpdir = dirsetup(tempdir, filename, "png", counter)
 			tmpfilename = os.path.join(tmpdir, 'unpack-%d.png' % counter)
 			tmpfile = open(tmpfilename, 'wb')
 			tmpfile.write(data)
@@ -6560,14 +6733,11 @@ def searchUnpackPNG(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			hints[tmpfilename]['tags'] = ['graphics', 'png', 'binary']
 			hints[tmpfilename]['scanned'] = True
 			blacklist.append((offset,trail+12))
+			blindex = extractor.blacklistindex(blacklist)
 			diroffsets.append((tmpdir, offset, pngsize))
 			counter = counter + 1
-			trailerpopcounter += 1
 			break
-
-		if not pngfound:
-			os.rmdir(tmpdir)
-	datafile.close()
+	pngmm.close()
 	return (diroffsets, blacklist, [], hints)
 
 ## JFIF is the most common JPEG format
@@ -6595,7 +6765,7 @@ def searchUnpackJPEG(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 	counter = 1
 	diroffsets = []
 	newtags = []
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	## list of JPEG segment markers
 	jpegmarkers = ['\xc0', '\xc1', '\xc2', '\xc3', '\xc4', '\xc5', '\xc6',
@@ -6893,7 +7063,7 @@ def searchUnpackWIM(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return (diroffsets, blacklist, newtags, hints)
 	if offsets['mswim'] == []:
 		return (diroffsets, blacklist, newtags, hints)
-	if not 0 in offsets['mswim']:
+	if offsets['mswim'][0] != 0:
 		return (diroffsets, blacklist, newtags, hints)
 	counter = 1
 	for offset in offsets['mswim']:
@@ -6960,7 +7130,7 @@ def searchUnpackAndroidBackup(filename, tempdir=None, blacklist=[], offsets={},
 		tmpdir = dirsetup(tempdir, filename, "androidbackup", counter)
 		tmpfile = tempfile.mkstemp(dir=tmpdir)
 		os.write(tmpfile[0], unz)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 
 		diroffsets.append((tmpdir, offset, bytesread))
 		blacklist.append((offset, offset + bytesread))
@@ -6978,7 +7148,7 @@ def searchUnpackIHex(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 	tags = []
 	diroffsets = []
 	counter = 1
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	tmpdir = dirsetup(tempdir, filename, "ihex", counter)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
@@ -6987,7 +7157,7 @@ def searchUnpackIHex(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 	offset = 0
 	for d in datafile:
 		if foundend:
-			os.fdopen(tmpfile[0]).close()
+			os.close(tmpfile[0])
 			datafile.close()
 			os.rmdir(tmpdir)
 			return (diroffsets, blacklist, tags, hints)
@@ -7006,7 +7176,7 @@ def searchUnpackIHex(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 		os.write(tmpfile[0], databytes)
 	diroffsets.append((tmpdir, offset, filesize))
 	blacklist.append((offset, offset + filesize))
-	os.fdopen(tmpfile[0]).close()
+	os.close(tmpfile[0])
 	datafile.close()
 	return (diroffsets, blacklist, tags, hints)
 
@@ -7026,7 +7196,7 @@ def searchUnpackPLF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 	if offsets['plf'] == []:
 		return ([], blacklist, [], hints)
 
-	if not 0 in offsets['plf']:
+	if offsets['plf'][0] != 0:
 		return ([], blacklist, [], hints)
 
 	newtags = []
@@ -7118,7 +7288,7 @@ def searchUnpackPLF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 				elif (fileflags >> 12) == 0x08:
 					tmpfile = tempfile.mkstemp(dir=tmpdir)
 					os.write(tmpfile[0], plfbuf[lenplfname+len(fileentry):])
-					os.fdopen(tmpfile[0]).close()
+					os.close(tmpfile[0])
 					if plfname != '':
 						try:
 							os.makedirs(os.path.dirname(os.path.join(tmpdir, plfname)))
@@ -7137,7 +7307,7 @@ def searchUnpackPLF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			elif entrytype == 4:
 				tmpfile = tempfile.mkstemp(dir=tmpdir)
 				os.write(tmpfile[0], plfbuf[lenplfname:])
-				os.fdopen(tmpfile[0]).close()
+				os.close(tmpfile[0])
 				if plfname != '':
 					try:
 						os.makedirs(os.path.dirname(os.path.join(tmpdir, plfname)))
@@ -7153,7 +7323,7 @@ def searchUnpackPLF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 				## for further analysis
 				tmpfile = tempfile.mkstemp(dir=tmpdir)
 				os.write(tmpfile[0], plfbuf)
-				os.fdopen(tmpfile[0]).close()
+				os.close(tmpfile[0])
 				dataunpacked = True
 				newdir = True
 				## the offsets are actually incorrect. TODO: fix this
@@ -7191,7 +7361,7 @@ def searchUnpackWOFF(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 	counter = 1
 	diroffsets = []
 
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	wofffile = open(filename, 'rb')
 	for offset in offsets['woff']:
 		## first check if the offset is not blacklisted
@@ -7683,7 +7853,7 @@ def searchUnpackOgg(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 	if offsets['ogg'] == []:
 		return ([], blacklist, [], hints)
 
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	newtags = []
 	counter = 1
@@ -7875,7 +8045,7 @@ def searchUnpackICS(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 	if offsets['ics'] == []:
 		return ([], blacklist, [], hints)
 
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 	if filesize < 128:
 		return ([], blacklist, [], hints)
 
@@ -7985,7 +8155,7 @@ def searchUnpackJavaClass(filename, tempdir=None, blacklist=[], offsets={}, scan
 	if offsets['java'] == []:
 		return ([], blacklist, [], hints)
 
-	filesize = os.stat(filename).st_size
+	filesize = getfilesize(filename, scanenv)
 
 	newtags = []
 	counter = 1
@@ -4,7 +4,7 @@
 ## Copyright 2013-2015 Armijn Hemel for Tjaldur Software Governance Solutions
 ## Licensed under Apache 2.0, see LICENSE file for details
 
-import os, os.path, sys, subprocess, copy, cPickle, tempfile, hashlib, shutil, multiprocessing, piecharts
+import os, os.path, sys, subprocess, copy, cPickle, hashlib, shutil, multiprocessing, piecharts
 import math
 import reportlab.rl_config as rl_config
 
@@ -49,20 +49,18 @@ The method works as follows:
 
 1. All data from pickles that is needed to generate pictures is extracted in
 parallel.
-2. The checksum of the pickle is computed and recorded. If there is a duplicate
-the pickle is removed and it is recorded which file it originally belonged to.
-3. Pictures are generated in parallel for the remaining pickle files.
+2. The checksum of the (pickled) data is computed and recorded. If there is a
+duplicate the data is discarded and it is recorded which file it originally
+belonged to.
+3. Pictures are generated in parallel for the remaining data, as soon as the
+data comes in.
 4. The pictures are copied and renamed, or symlinked.
 '''
 
-def generatepiecharts((picklefile, pickledir, filehash, imagedir)):
-	piecharts.generateImages(picklefile, pickledir, filehash, imagedir, "piechart")
-
-def generateversionchart((versionpickle, picklehash, imagedir, pickledir)):
-	datapickle = open(os.path.join(pickledir, versionpickle), 'rb')
-	data = cPickle.load(datapickle)
-	datapickle.close()
+def generatepiecharts(((piedata, pielabels), filehash, imagedir)):
+	piecharts.generateImages(piedata, pielabels, filehash, imagedir, "piechart")
 
+def generateversionchart((data, picklehash, imagedir)):
 	## calculate the possible widths and heights of chart, bars, labels and so on
 	maxversionstring = max(map(lambda x: len(x[0]), data))
 
@@ -109,7 +107,7 @@ def generateversionchart((versionpickle, picklehash, imagedir, pickledir)):
 	renderPM.drawToFile(drawing, outname, fmt='PNG')
 	return picklehash
 
-def extractpickles((filehash, pickledir, topleveldir, unpacktempdir, minpercentagecutoff, maxpercentagecutoff)):
+def extractpickles((filehash, topleveldir, minpercentagecutoff, maxpercentagecutoff)):
 	leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'rb')
 	leafreports = cPickle.load(leaf_file)
 	leaf_file.close()
@@ -157,12 +155,11 @@ def extractpickles((filehash, pickledir, topleveldir, unpacktempdir, minpercenta
 				assignedoruniquematches += len(unique)
 
 		## TODO: add information about matched but unassigned
-		## now dump the data to a pickle
+		## now hash the data, so duplicates can be weeded out
 		if statpielabels != [] and statpiedata != []:
-			tmppickle = tempfile.mkstemp(dir=unpacktempdir)
-			cPickle.dump((statpiedata, statpielabels), os.fdopen(tmppickle[0], 'w'))
-			picklehash = gethash(tmppickle[1])
-			statpieresult = (picklehash, tmppickle[1])
+			pickledata = (statpiedata, statpielabels)
+			picklehash = gethash(pickledata)
+			statpieresult = (picklehash, pickledata)
 
 		## now process statistics for score piechart
 		piedata = []
@@ -186,12 +183,11 @@ def extractpickles((filehash, pickledir, topleveldir, unpacktempdir, minpercenta
 				piedata.append(percentage)
 				totals += percentage
 
-		## now dump the data to a pickle
+		## now hash the data, so duplicates can be weeded out
 		if pielabels != [] and piedata != []:
-			tmppickle = tempfile.mkstemp(dir=unpacktempdir)
-			cPickle.dump((piedata, pielabels), os.fdopen(tmppickle[0], 'w'))
-			picklehash = gethash(tmppickle[1])
-			pieresult = (picklehash, tmppickle[1])
+			pickledata = (piedata, pielabels)
+			picklehash = gethash(pickledata)
+			pieresult = (picklehash, pickledata)
 
 		## process match data for version information
 		for j in res['reports']:
@@ -202,15 +198,13 @@ def extractpickles((filehash, pickledir, topleveldir, unpacktempdir, minpercenta
 				if vals == []:
 					continue
 				vals.sort(reverse=True)
-				tmppickle = tempfile.mkstemp(dir=unpacktempdir)
 				for v in vals:
 					j_sorted = filter(lambda x: x[1] == v, packageversions.items())
 					j_sorted.sort()
 					for v2 in j_sorted:
 						pickledata.append(v2)
-				cPickle.dump(pickledata, os.fdopen(tmppickle[0], 'w'))
-				picklehash = gethash(tmppickle[1])
-				versionresults.append((picklehash, tmppickle[1], package))
+				picklehash = gethash(pickledata)
+				versionresults.append((picklehash, pickledata, package))
 
 	## extract pickles with version information for functions
 	if dynamicRes.has_key('packages'):
@@ -222,29 +216,22 @@ def extractpickles((filehash, pickledir, topleveldir, unpacktempdir, minpercenta
 			if vals == []:
 				continue
 			vals.sort(reverse=True)
-			tmppickle = tempfile.mkstemp(dir=unpacktempdir)
 			for v in vals:
 				j_sorted = filter(lambda x: x[1] == v, p_sorted)
 				j_sorted.sort()
 				for v2 in j_sorted:
 					pickledata.append(v2)
-			cPickle.dump(pickledata, os.fdopen(tmppickle[0], 'w'))
-			picklehash = gethash(tmppickle[1])
-			funcresults.append((picklehash, tmppickle[1], package))
+			picklehash = gethash(pickledata)
+			funcresults.append((picklehash, pickledata, package))
 
 	return (filehash, pieresult, statpieresult, versionresults, funcresults)
 
-## compute a SHA256 hash. This is done in chunks to prevent a big file from
-## being read in its entirety at once, slowing down a machine.
-def gethash(path):
-	scanfile = open(path, 'r')
+## compute a SHA256 hash of the pickled data. The data is kept in memory and
+## handed to the chart generating methods directly, so there is no need to
+## write it to (and later read it from) a temporary file.
+def gethash(pickledata):
 	h = hashlib.new('sha256')
-	scanfile.seek(0)
-	hashdata = scanfile.read(10000000)
-	while hashdata != '':
-		h.update(hashdata)
-		hashdata = scanfile.read(10000000)
-	scanfile.close()
+	h.update(cPickle.dumps(pickledata, cPickle.HIGHEST_PROTOCOL))
 	return h.hexdigest()
 
 def generateimages(unpackreports, scantempdir, topleveldir, processors, scanenv, batcursors, batcons, scandebug=False, unpacktempdir=None):
@@ -253,10 +240,6 @@ def generateimages(unpackreports, scantempdir, topleveldir, processors, scanenv,
 			del scanenv['BAT_IMAGEDIR']
 		except:
 			pass
-		try:
-			del scanenv['BAT_PICKLEDIR']
-		except:
-			pass
 
 	imagedir = scanenv.get('BAT_IMAGEDIR', os.path.join(topleveldir, "images"))
 	try:
@@ -268,16 +251,6 @@ def generateimages(unpackreports, scantempdir, topleveldir, processors, scanenv,
 		except Exception, e:
 			return
 
-	pickledir = scanenv.get('BAT_PICKLEDIR', os.path.join(topleveldir, "pickles"))
-	try:
-		os.stat(pickledir)
-	except:
-		## BAT_PICKLEDIR does not exist
-		try:
-			os.makedirs(pickledir)
-		except Exception, e:
-			return
-
 	symlinks = False
 	if scanenv.get('AGGREGATE_IMAGE_SYMLINK', 0) == '1':
 		symlinks = True
@@ -307,7 +280,6 @@ def generateimages(unpackreports, scantempdir, topleveldir, processors, scanenv,
 	statpiepicklespackages = set()
 	funcpicklespackages = set()
 	versionpicklespackages = set()
-	picklehashes = {}
 	pickletofile = {}
 	funcfilehashpackage = {}
 	verfilehashpackage = {}
@@ -327,146 +299,94 @@ def generateimages(unpackreports, scantempdir, topleveldir, processors, scanenv,
 		except:
 			pass
 
-	## extract pickles
-	extracttasks = map(lambda x: (x, pickledir, topleveldir, unpacktempdir, minpercentagecutoff, maxpercentagecutoff), filehashes)
+	## extract pickles. The results are processed as soon as they come in
+	## and the data of a chart is only kept until a task to generate the
+	## chart has been queued, so the data of all files is never in memory
+	## at the same time. Duplicate data is discarded right away.
+	extracttasks = map(lambda x: (x, topleveldir, minpercentagecutoff, maxpercentagecutoff), filehashes)
 	pool = multiprocessing.Pool(processes=processors)
-	res = filter(lambda x: x != None, pool.map(extractpickles, extracttasks))
-	pool.terminate()
+	pietasks = []
+	generatetasks = []
 
-	for r in res:
+	for r in pool.imap_unordered(extractpickles, extracttasks):
+		if r == None:
+			continue
 		(filehash, pieresult, statpieresult, versionresults, funcresults) = r
 		if pieresult != None:
-			(picklehash, tmppickle) = pieresult
-			if picklehash in piepickles:
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
-				piepicklespackages.add((picklehash, filehash))
-				os.unlink(tmppickle)
+			(picklehash, pickledata) = pieresult
+			if not picklehash in piepickles and not picklehash in statpiepickles:
+				pietasks.append(pool.apply_async(generatepiecharts, ((pickledata, picklehash, imagedir),)))
+			piepickles.add(picklehash)
+			piepicklespackages.add((picklehash, filehash))
+			if pickletofile.has_key(picklehash):
+				pickletofile[picklehash].append(filehash)
 			else:
-				shutil.move(tmppickle, pickledir)
-				piepickles.add(picklehash)
-				piepicklespackages.add((picklehash, filehash))
-				picklehashes[picklehash] = os.path.basename(tmppickle)
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
+				pickletofile[picklehash] = [filehash]
 		if statpieresult != None:
-			(picklehash, tmppickle) = statpieresult
-			if picklehash in statpiepickles:
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
-				statpiepicklespackages.add((picklehash, filehash))
-				os.unlink(tmppickle)
+			(picklehash, pickledata) = statpieresult
+			if not picklehash in piepickles and not picklehash in statpiepickles:
+				pietasks.append(pool.apply_async(generatepiecharts, ((pickledata, picklehash, imagedir),)))
+			statpiepickles.add(picklehash)
+			statpiepicklespackages.add((picklehash, filehash))
+			if pickletofile.has_key(picklehash):
+				pickletofile[picklehash].append(filehash)
 			else:
-				shutil.move(tmppickle, pickledir)
-				statpiepickles.add(picklehash)
-				statpiepicklespackages.add((picklehash, filehash))
-				picklehashes[picklehash] = os.path.basename(tmppickle)
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
+				pickletofile[picklehash] = [filehash]
 		for v in versionresults:
-			(picklehash, tmppickle, package) = v
+			(picklehash, pickledata, package) = v
 			if verfilehashpackage.has_key(filehash):
 				verfilehashpackage[filehash].append(package)
 			else:
 				verfilehashpackage[filehash] = [package]
-			if picklehash in pickles:
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
-				versionpicklespackages.add((picklehash, package))
-				os.unlink(tmppickle)
-			else:
-				shutil.move(tmppickle, pickledir)
+			if not picklehash in pickles:
 				pickles.add(picklehash)
-				versionpicklespackages.add((picklehash, package))
-				picklehashes[picklehash] = os.path.basename(tmppickle)
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
-
+				generatetasks.append(pool.apply_async(generateversionchart, ((pickledata, picklehash, imagedir),)))
+			versionpicklespackages.add((picklehash, package))
+			if pickletofile.has_key(picklehash):
+				pickletofile[picklehash].append(filehash)
+			else:
+				pickletofile[picklehash] = [filehash]
 		for f in funcresults:
-			(picklehash, tmppickle, package) = f
+			(picklehash, pickledata, package) = f
 			if funcfilehashpackage.has_key(filehash):
 				funcfilehashpackage[filehash].append(package)
 			else:
 				funcfilehashpackage[filehash] = [package]
-			if picklehash in pickles:
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
-				funcpicklespackages.add((picklehash, package))
-				os.unlink(tmppickle)
-			else:
-				shutil.move(tmppickle, pickledir)
+			if not picklehash in pickles:
 				pickles.add(picklehash)
-				funcpicklespackages.add((picklehash, package))
-				picklehashes[picklehash] = os.path.basename(tmppickle)
-				if pickletofile.has_key(picklehash):
-					pickletofile[picklehash].append(filehash)
-				else:
-					pickletofile[picklehash] = [filehash]
-
-	## create a pool and generate the images
-	pool = multiprocessing.Pool(processes=processors)
+				generatetasks.append(pool.apply_async(generateversionchart, ((pickledata, picklehash, imagedir),)))
+			funcpicklespackages.add((picklehash, package))
+			if pickletofile.has_key(picklehash):
+				pickletofile[picklehash].append(filehash)
+			else:
+				pickletofile[picklehash] = [filehash]
 
-	if piepicklespackages != []:
-		pietasks = set(map(lambda x: (copy.deepcopy(picklehashes[x[0]]), pickledir, x[0], imagedir), piepicklespackages))
-		if len(pietasks) != 0:
-			results = pool.map(generatepiecharts, pietasks, 1)
-		else:
-			results = []
-		## first copy the file for every package that needs it
-		for p in piepicklespackages:
-			oldfilename = "%s-%s" % (p[0], "piechart.png")
-			filename = "%s-%s" % (p[1], "piechart.png")
-			if os.path.exists(os.path.join(imagedir, oldfilename)):
-				shutil.copy(os.path.join(imagedir, oldfilename), os.path.join(imagedir, filename))
-		## then remove the temporary files
-		for p in piepicklespackages:
-			try:
-				filename = "%s-%s" % (p[0], "piechart.png")
-				os.unlink(os.path.join(imagedir, filename))
-			except Exception, e:
-				#print >>sys.stderr, "ERR", e
-				pass
-	if statpiepicklespackages != []:
-		pietasks = set(map(lambda x: (copy.deepcopy(picklehashes[x[0]]), pickledir, x[0], imagedir), statpiepicklespackages))
-		if len(pietasks) != 0:
-			results = pool.map(generatepiecharts, pietasks, 1)
-		else:
-			results = []
-		## first copy the file for every package that needs it
-		for p in statpiepicklespackages:
-			oldfilename = "%s-%s" % (p[0], "piechart.png")
-			filename = "%s-%s" % (p[1], "statpiechart.png")
-			if os.path.exists(os.path.join(imagedir, oldfilename)):
-				shutil.copy(os.path.join(imagedir, oldfilename), os.path.join(imagedir, filename))
-		## then remove the temporary files
-		for p in statpiepicklespackages:
-			try:
-				filename = "%s-%s" % (p[0], "piechart.png")
-				os.unlink(os.path.join(imagedir, filename))
-			except Exception, e:
-				#print >>sys.stderr, "ERR", e
-				pass
-
-	generatetasks = map(lambda x: (picklehashes[x[0]], x[0], imagedir, pickledir), funcpicklespackages) + map(lambda x: (picklehashes[x[0]], x[0], imagedir, pickledir), versionpicklespackages)
-
-	if generatetasks != []:
-		results = pool.map(generateversionchart, set(generatetasks), 1)
+	## wait for all the charts to be generated
+	for p in pietasks:
+		p.get()
+	results = map(lambda x: x.get(), generatetasks)
 	pool.terminate()
 
+	## first copy the pie charts for every file that needs it
+	for p in piepicklespackages:
+		oldfilename = "%s-%s" % (p[0], "piechart.png")
+		filename = "%s-%s" % (p[1], "piechart.png")
+		if os.path.exists(os.path.join(imagedir, oldfilename)):
+			shutil.copy(os.path.join(imagedir, oldfilename), os.path.join(imagedir, filename))
+	for p in statpiepicklespackages:
+		oldfilename = "%s-%s" % (p[0], "piechart.png")
+		filename = "%s-%s" % (p[1], "statpiechart.png")
+		if os.path.exists(os.path.join(imagedir, oldfilename)):
+			shutil.copy(os.path.join(imagedir, oldfilename), os.path.join(imagedir, filename))
+	## then remove the temporary files
+	for p in piepickles.union(statpiepickles):
+		try:
+			filename = "%s-%s" % (p, "piechart.png")
+			os.unlink(os.path.join(imagedir, filename))
+		except Exception, e:
+			#print >>sys.stderr, "ERR", e
+			pass
+
 	results = filter(lambda x: x != None, results)
 
 	funcpickletopackage = {}
@@ -528,10 +448,3 @@ def generateimages(unpackreports, scantempdir, topleveldir, processors, scanenv,
 						shutil.copy(os.path.join(imagedir, r), os.path.join(imagedir, filename))
 		if unlinkpickle:
 			os.unlink(os.path.join(imagedir, r))
-
-	## cleanup
-	cleanpickles = set()
-	cleanpickles.update(map(lambda x: x[0], funcpicklespackages))
-	cleanpickles.update(map(lambda x: x[0], versionpicklespackages))
-	for i in cleanpickles:
-		os.unlink(os.path.join(pickledir, picklehashes[i]))
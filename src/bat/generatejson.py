@@ -12,255 +12,221 @@ including the ranking algorithm.
 The documentation of the format can be found in the 'doc' directory (subject to change)
 '''
 
-import os, sys, re, json, cPickle, multiprocessing, copy, gzip, codecs, Queue
+import os, sys, re, json, cPickle, multiprocessing, gzip, codecs, Queue
 from multiprocessing import Process, Lock
 from multiprocessing.sharedctypes import Value, Array
 
-def writejson(scanqueue, topleveldir, outputhash, cursor, conn, scanenv, converthash, compressed):
-	hashcache = {}
+## Decode a string for use in JSON. Any string that is not valid UTF-8 can
+## be decoded as Latin-1 (all bytes are valid Latin-1), so trying any other
+## encoding is not needed. Returns None if the string cannot be decoded at
+## all, for example when it is a unicode object with non-ASCII characters.
+def decodestring(s):
+	try:
+		return s.decode('utf-8')
+	except UnicodeDecodeError:
+		return s.decode('latin-1')
+	except Exception, e:
+		return None
+
+## maximum amount of checksums that are converted in a single query
+hashbatchsize = 500
+
+## create the JSON representation of a list of unique matches (string
+## identifiers, function names or variable names). hashcache only contains
+## checksums that could be converted to outputhash.
+def uniquereports(unique, hashcache, outputhash):
+	reports = []
+	## if no checksums were converted (the common case), then there is
+	## no need to look up every checksum, so use a simpler loop
+	if hashcache == {}:
+		for (identifier, identifierdata) in unique:
+			identifierdatareports = []
+			for (filechecksum, linenumber, fileversiondata) in identifierdata:
+				identifierdatareports.append({'filechecksum': filechecksum, 'filechecksumtype': 'sha256', 'linenumber': linenumber,
+					'packagedata': map(lambda x: {'packageversion': x[0], 'sourcefilename': x[1]}, fileversiondata)})
+			reports.append({'identifier': identifier, 'identifierdata': identifierdatareports})
+		return reports
+	for (identifier, identifierdata) in unique:
+		identifierdatareports = []
+		for (filechecksum, linenumber, fileversiondata) in identifierdata:
+			if filechecksum in hashcache:
+				identifierdatareport = {'filechecksum': hashcache[filechecksum], 'filechecksumtype': outputhash}
+			else:
+				identifierdatareport = {'filechecksum': filechecksum, 'filechecksumtype': 'sha256'}
+			identifierdatareport['linenumber'] = linenumber
+			identifierdatareport['packagedata'] = map(lambda x: {'packageversion': x[0], 'sourcefilename': x[1]}, fileversiondata)
+			identifierdatareports.append(identifierdatareport)
+		reports.append({'identifier': identifier, 'identifierdata': identifierdatareports})
+	return reports
+
+## collect all the file checksums that are used in the results of the ranking scan
+def rankingchecksums(ranking):
+	(stringidentifiers, functionnameresults, variablenameresults, language) = ranking
+	checksums = set()
+	if stringidentifiers != None and 'reports' in stringidentifiers:
+		for u in stringidentifiers['reports']:
+			for un in u[2]:
+				for iddata in un[1]:
+					checksums.add(iddata[0])
+	for nameresults in [functionnameresults, variablenameresults]:
+		if 'versionresults' in nameresults:
+			for packagename in nameresults['versionresults']:
+				for un in nameresults['versionresults'][packagename]:
+					for iddata in un[1]:
+						checksums.add(iddata[0])
+	return checksums
+
+## convert SHA256 checksums to outputhash in batches and store the results in
+## hashcache. Checksums that cannot be converted are stored in hashmisses, so
+## they are not looked up again.
+def converthashes(checksums, hashcache, hashmisses, outputhash, cursor, conn):
+	checksums = list(checksums.difference(hashcache).difference(hashmisses))
+	if checksums == []:
+		return
+	for i in range(0, len(checksums), hashbatchsize):
+		hashbatch = checksums[i:i+hashbatchsize]
+		query = "select sha256, %s from hashconversion where sha256 in (" % outputhash + ", ".join(["%s"] * len(hashbatch)) + ")"
+		cursor.execute(query, hashbatch)
+		for (filechecksum, convertedhash) in cursor.fetchall():
+			hashcache[filechecksum] = convertedhash
+	conn.commit()
+	hashmisses.update(filter(lambda x: x not in hashcache, checksums))
+
+def writejson(scanqueue, topleveldir, outputhash, cursor, conn, scanenv, converthash, compressed, hashcache, hashmisses):
+	## speed is more important than size for the compressed JSON files
+	compresslevel = int(scanenv.get('JSON_GZIP_LEVEL', 1))
 	while True:
-		filehash = scanqueue.get(timeout=2592000)
-		## read the data from the pickle file
-		leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'rb')
-		leafreports = cPickle.load(leaf_file)
-		leaf_file.close()
-		## then mangle the data and dump it into a JSON file
-		jsonreport = {}
-
-		if "tags" in leafreports:
-			jsonreport['tags'] = list(set(copy.deepcopy(leafreports['tags'])))
-		## now go through all of the scans that are there. This is hardcoded.
-		## TODO: make more generic based on configuration.
-		for i in ['busybox-version', 'forges', 'licenses']:
-			if i in leafreports:
-				jsonreport[i] = copy.deepcopy(leafreports[i])
-
-		if converthash:
-			query = "select %s from hashconversion where sha256=" % outputhash + "%s"
-
-		## then the 'ranking' scan
-		if 'ranking' in leafreports:
-			jsonreport['ranking'] = {}
-			(stringidentifiers, functionnameresults, variablenameresults, language) = leafreports['ranking']
-
-			## first the language
-			jsonreport['ranking']['language'] = language
-
-			## then the string identifier results
-			jsonreport['ranking']['stringresults'] = {}
-			jsonreport['ranking']['stringresults']['unmatched'] = []
-			jsonreport['ranking']['stringresults']['matchednonassignedlines'] = 0
-			jsonreport['ranking']['stringresults']['matchednotclonelines'] = 0
-			jsonreport['ranking']['stringresults']['nonUniqueMatches'] = []
-			jsonreport['ranking']['stringresults']['scores'] = []
-			jsonreport['ranking']['stringresults']['reports'] = []
-			if stringidentifiers != None:
-				if 'unmatched' in stringidentifiers:
-					newunmatched = []
-					for u in stringidentifiers['unmatched']:
-						decoded = False
-						for i in ['utf-8','ascii','latin-1','euc_jp', 'euc_jis_2004', 'jisx0213', 'iso2022_jp', 'iso2022_jp_1', 'iso2022_jp_2', 'iso2022_jp_2004', 'iso2022_jp_3', 'iso2022_jp_ext', 'iso2022_kr','shift_jis','shift_jis_2004','shift_jisx0213']:
-							try:
-								unmatchedline = u.decode(i)
-								decoded = True
-								break
-							except Exception, e:
-								pass
-						if decoded:
-							newunmatched.append(unmatchedline)
-						else:
-							pass
-					jsonreport['ranking']['stringresults']['unmatched'] = newunmatched
-
-				if 'matchednonassignedlines' in stringidentifiers:
-					jsonreport['ranking']['stringresults']['matchednonassignedlines'] = stringidentifiers['matchednonassignedlines']
-				if 'matchednotclonelines' in stringidentifiers:
-					jsonreport['ranking']['stringresults']['matchednotclonelines'] = stringidentifiers['matchednotclonelines']
-
-				if 'nonUniqueMatches' in stringidentifiers:
-					jsonreport['ranking']['stringresults']['nonUniqueMatches'] = []
-					for u in stringidentifiers['nonUniqueMatches']:
-						nonuniquereport = {}
-						nonuniquereport['packagename'] = u
-						nonuniquereport['nonuniquelines'] = stringidentifiers['nonUniqueMatches'][u]
-						jsonreport['ranking']['stringresults']['nonUniqueMatches'].append(nonuniquereport)
-
-				if 'scores' in stringidentifiers:
-					jsonreport['ranking']['stringresults']['scores'] = []
-					for u in stringidentifiers['scores']:
-						scorereport = {}
-						scorereport['packagename'] = u
-						scorereport['computedscore'] = stringidentifiers['scores'][u]
-						jsonreport['ranking']['stringresults']['scores'].append(scorereport)
-
-				if 'reports' in stringidentifiers:
-					jsonreport['ranking']['stringresults']['reports'] = []
-					for u in stringidentifiers['reports']:
-						(rank, package, unique, uniquematcheslen, percentage, packageversions, packagelicenses, packagecopyrights) = u
-						report = {}
-						report['packagename'] = package
-						report['rank'] = rank
-						report['percentage'] = percentage
-						report['unique'] = []
-						for un in unique:
-							(identifier, identifierdata) = un
-							uniquereport = {}
-							uniquereport['identifier'] = identifier
-							uniquereport['identifierdata'] = []
-							for iddata in identifierdata:
-								(filechecksum, linenumber, fileversiondata) = iddata
-								identifierdatareport = {}
-								if converthash:
-									if filechecksum in hashcache:
-										identifierdatareport['filechecksum'] = hashcache[filechecksum]
-										identifierdatareport['filechecksumtype'] = outputhash
-									else:
-										cursor.execute(query, (filechecksum,))
-										convertedhash = cursor.fetchone()
-										conn.commit()
-										if convertedhash != None:
-											hashcache[filechecksum] = convertedhash[0]
-											identifierdatareport['filechecksum'] = convertedhash[0]
-											identifierdatareport['filechecksumtype'] = outputhash
-										else:
-											identifierdatareport['filechecksum'] = filechecksum
-											identifierdatareport['filechecksumtype'] = 'sha256'
-								else:
-									identifierdatareport['filechecksum'] = filechecksum
-									identifierdatareport['filechecksumtype'] = 'sha256'
-								identifierdatareport['linenumber'] = linenumber
-								identifierdatareport['packagedata'] = []
-								for pack in fileversiondata:
-									(packageversion, sourcefilename) = pack
-									fileversionreport = {}
-									fileversionreport['packageversion'] = packageversion
-									fileversionreport['sourcefilename'] = sourcefilename
-									identifierdatareport['packagedata'].append(fileversionreport)
-								uniquereport['identifierdata'].append(identifierdatareport)
-							report['unique'].append(uniquereport)
-						report['packageversions'] = []
-						for p in packageversions:
-							packagereport = {}
-							packagereport['packageversion'] = p
-							packagereport['packagehits'] = packageversions[p]
-							report['packageversions'].append(packagereport)
-						jsonreport['ranking']['stringresults']['reports'].append(report)
-
-			## then the functionname results
-			jsonreport['ranking']['functionnameresults'] = {}
-			jsonreport['ranking']['functionnameresults']['totalfunctionnames'] = 0
-			jsonreport['ranking']['functionnameresults']['versionresults'] = []
-			if 'totalnames' in functionnameresults:
-				jsonreport['ranking']['functionnameresults']['totalfunctionnames'] = functionnameresults['totalnames']
-			if 'versionresults' in functionnameresults:
-				for packagename in functionnameresults['versionresults']:
-					packagereport = {}
-					packagereport['packagename'] = packagename
-					packagereport['unique'] = []
-					for un in functionnameresults['versionresults'][packagename]:
-						(identifier, identifierdata) = un
-						uniquereport = {}
-						uniquereport['identifier'] = identifier
-						uniquereport['identifierdata'] = []
-						for iddata in identifierdata:
-							(filechecksum, linenumber, fileversiondata) = iddata
-							identifierdatareport = {}
-							if outputhash != 'sha256':
-								if filechecksum in hashcache:
-									identifierdatareport['filechecksum'] = hashcache[filechecksum]
-									identifierdatareport['filechecksumtype'] = outputhash
-								else:
-									cursor.execute(query, (filechecksum,))
-									convertedhash = cursor.fetchone()
-									conn.commit()
-									if convertedhash != None:
-										hashcache[filechecksum] = convertedhash[0]
-										identifierdatareport['filechecksum'] = convertedhash[0]
-										identifierdatareport['filechecksumtype'] = outputhash
-									else:
-										identifierdatareport['filechecksum'] = filechecksum
-										identifierdatareport['filechecksumtype'] = 'sha256'
-							else:
-								identifierdatareport['filechecksum'] = filechecksum
-								identifierdatareport['filechecksumtype'] = 'sha256'
-							identifierdatareport['linenumber'] = linenumber
-							identifierdatareport['packagedata'] = []
-							for pack in fileversiondata:
-								(packageversion, sourcefilename) = pack
-								fileversionreport = {}
-								fileversionreport['packageversion'] = packageversion
-								fileversionreport['sourcefilename'] = sourcefilename
-								identifierdatareport['packagedata'].append(fileversionreport)
-							uniquereport['identifierdata'].append(identifierdatareport)
-						packagereport['unique'].append(uniquereport)
-					jsonreport['ranking']['functionnameresults']['versionresults'].append(packagereport)
-
-			## then the variablename results
-			jsonreport['ranking']['variablenameresults'] = {}
-			jsonreport['ranking']['variablenameresults'] = {}
-			jsonreport['ranking']['variablenameresults']['totalvariablenames'] = 0
-			jsonreport['ranking']['variablenameresults']['versionresults'] = []
-			if 'totalnames' in variablenameresults:
-				jsonreport['ranking']['variablenameresults']['totalvariablenames'] = variablenameresults['totalnames']
-			if 'versionresults' in variablenameresults:
-				for packagename in variablenameresults['versionresults']:
-					packagereport = {}
-					packagereport['packagename'] = packagename
-					packagereport['unique'] = []
-					for un in variablenameresults['versionresults'][packagename]:
-						(identifier, identifierdata) = un
-						uniquereport = {}
-						uniquereport['identifier'] = identifier
-						uniquereport['identifierdata'] = []
-						for iddata in identifierdata:
-							(filechecksum, linenumber, fileversiondata) = iddata
-							identifierdatareport = {}
-							if outputhash != 'sha256':
-								if filechecksum in hashcache:
-									identifierdatareport['filechecksum'] = hashcache[filechecksum]
-									identifierdatareport['filechecksumtype'] = outputhash
-								else:
-									cursor.execute(query, (filechecksum,))
-									convertedhash = cursor.fetchone()
-									conn.commit()
-									if convertedhash != None:
-										hashcache[filechecksum] = convertedhash[0]
-										identifierdatareport['filechecksum'] = convertedhash[0]
-										identifierdatareport['filechecksumtype'] = outputhash
-									else:
-										identifierdatareport['filechecksum'] = filechecksum
-										identifierdatareport['filechecksumtype'] = 'sha256'
-							else:
-								identifierdatareport['filechecksum'] = filechecksum
-								identifierdatareport['filechecksumtype'] = 'sha256'
-							identifierdatareport['linenumber'] = linenumber
-							identifierdatareport['packagedata'] = []
-							for pack in fileversiondata:
-								(packageversion, sourcefilename) = pack
-								fileversionreport = {}
-								fileversionreport['packageversion'] = packageversion
-								fileversionreport['sourcefilename'] = sourcefilename
-								identifierdatareport['packagedata'].append(fileversionreport)
-							uniquereport['identifierdata'].append(identifierdatareport)
-						packagereport['unique'].append(uniquereport)
-					jsonreport['ranking']['variablenameresults']['versionresults'].append(packagereport)
-
-		## then security information
-		## TODO
-
-		## dump the JSON to a file
-		jsonfilename = os.path.join(topleveldir, "reports", "%s.json" % filehash)
-		jsonfile = open(jsonfilename, 'w')
-		for chunk in json.JSONEncoder(indent=4).iterencode(jsonreport):
-			jsonfile.write(chunk)
-		jsonfile.close()
-		if compressed:
-			fin = open(jsonfilename, 'rb')
-			fout = gzip.open("%s.gz" % jsonfilename, 'wb')
-			fout.write(fin.read())
-			fout.close()
-			fin.close()
-			os.unlink(fin.name)
+		## the file hashes are handed out in chunks to reduce the overhead
+		## of getting them from the queue
+		filehashes = scanqueue.get(timeout=2592000)
+		for filehash in filehashes:
+			## read the data from the pickle file
+			leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'rb')
+			leafreports = cPickle.load(leaf_file)
+			leaf_file.close()
+			## then mangle the data and dump it into a JSON file
+			jsonreport = {}
+
+			if "tags" in leafreports:
+				jsonreport['tags'] = list(set(leafreports['tags']))
+			## now go through all of the scans that are there. This is hardcoded.
+			## TODO: make more generic based on configuration.
+			for i in ['busybox-version', 'forges', 'licenses']:
+				if i in leafreports:
+					jsonreport[i] = leafreports[i]
+
+			## then the 'ranking' scan
+			if 'ranking' in leafreports:
+				jsonreport['ranking'] = {}
+				(stringidentifiers, functionnameresults, variablenameresults, language) = leafreports['ranking']
+
+				if converthash:
+					## first convert all the checksums that are not known yet,
+					## so they can be looked up in a few queries instead of
+					## querying the database for every checksum.
+					converthashes(rankingchecksums(leafreports['ranking']), hashcache, hashmisses, outputhash, cursor, conn)
+
+				## first the language
+				jsonreport['ranking']['language'] = language
+
+				## then the string identifier results
+				jsonreport['ranking']['stringresults'] = {}
+				jsonreport['ranking']['stringresults']['unmatched'] = []
+				jsonreport['ranking']['stringresults']['matchednonassignedlines'] = 0
+				jsonreport['ranking']['stringresults']['matchednotclonelines'] = 0
+				jsonreport['ranking']['stringresults']['nonUniqueMatches'] = []
+				jsonreport['ranking']['stringresults']['scores'] = []
+				jsonreport['ranking']['stringresults']['reports'] = []
+				if stringidentifiers != None:
+					if 'unmatched' in stringidentifiers:
+						newunmatched = []
+						for u in stringidentifiers['unmatched']:
+							unmatchedline = decodestring(u)
+							if unmatchedline != None:
+								newunmatched.append(unmatchedline)
+						jsonreport['ranking']['stringresults']['unmatched'] = newunmatched
+
+					if 'matchednonassignedlines' in stringidentifiers:
+						jsonreport['ranking']['stringresults']['matchednonassignedlines'] = stringidentifiers['matchednonassignedlines']
+					if 'matchednotclonelines' in stringidentifiers:
+						jsonreport['ranking']['stringresults']['matchednotclonelines'] = stringidentifiers['matchednotclonelines']
+
+					if 'nonUniqueMatches' in stringidentifiers:
+						jsonreport['ranking']['stringresults']['nonUniqueMatches'] = []
+						for u in stringidentifiers['nonUniqueMatches']:
+							nonuniquereport = {}
+							nonuniquereport['packagename'] = u
+							nonuniquereport['nonuniquelines'] = stringidentifiers['nonUniqueMatches'][u]
+							jsonreport['ranking']['stringresults']['nonUniqueMatches'].append(nonuniquereport)
+
+					if 'scores' in stringidentifiers:
+						jsonreport['ranking']['stringresults']['scores'] = []
+						for u in stringidentifiers['scores']:
+							scorereport = {}
+							scorereport['packagename'] = u
+							scorereport['computedscore'] = stringidentifiers['scores'][u]
+							jsonreport['ranking']['stringresults']['scores'].append(scorereport)
+
+					if 'reports' in stringidentifiers:
+						jsonreport['ranking']['stringresults']['reports'] = []
+						for u in stringidentifiers['reports']:
+							(rank, package, unique, uniquematcheslen, percentage, packageversions, packagelicenses, packagecopyrights) = u
+							report = {}
+							report['packagename'] = package
+							report['rank'] = rank
+							report['percentage'] = percentage
+							report['unique'] = uniquereports(unique, hashcache, outputhash)
+							report['packageversions'] = []
+							for p in packageversions:
+								packagereport = {}
+								packagereport['packageversion'] = p
+								packagereport['packagehits'] = packageversions[p]
+								report['packageversions'].append(packagereport)
+							jsonreport['ranking']['stringresults']['reports'].append(report)
+
+				## then the functionname results
+				jsonreport['ranking']['functionnameresults'] = {}
+				jsonreport['ranking']['functionnameresults']['totalfunctionnames'] = 0
+				jsonreport['ranking']['functionnameresults']['versionresults'] = []
+				if 'totalnames' in functionnameresults:
+					jsonreport['ranking']['functionnameresults']['totalfunctionnames'] = functionnameresults['totalnames']
+				if 'versionresults' in functionnameresults:
+					for packagename in functionnameresults['versionresults']:
+						packagereport = {}
+						packagereport['packagename'] = packagename
+						packagereport['unique'] = uniquereports(functionnameresults['versionresults'][packagename], hashcache, outputhash)
+						jsonreport['ranking']['functionnameresults']['versionresults'].append(packagereport)
+
+				## then the variablename results
+				jsonreport['ranking']['variablenameresults'] = {}
+				jsonreport['ranking']['variablenameresults'] = {}
+				jsonreport['ranking']['variablenameresults']['totalvariablenames'] = 0
+				jsonreport['ranking']['variablenameresults']['versionresults'] = []
+				if 'totalnames' in variablenameresults:
+					jsonreport['ranking']['variablenameresults']['totalvariablenames'] = variablenameresults['totalnames']
+				if 'versionresults' in variablenameresults:
+					for packagename in variablenameresults['versionresults']:
+						packagereport = {}
+						packagereport['packagename'] = packagename
+						packagereport['unique'] = uniquereports(variablenameresults['versionresults'][packagename], hashcache, outputhash)
+						jsonreport['ranking']['variablenameresults']['versionresults'].append(packagereport)
+
+			## then security information
+			## TODO
+
+			## dump the JSON to a file. If the file should be compressed, then
+			## write the JSON straight into the gzip file, instead of first
+			## writing it uncompressed and reading it back in again.
+			## The JSON is first serialised to a string and written in one
+			## go: json.dump() with indent does a write() for every token,
+			## which is very slow for a GzipFile.
+			jsonfilename = os.path.join(topleveldir, "reports", "%s.json" % filehash)
+			if compressed:
+				jsonfile = gzip.open("%s.gz" % jsonfilename, 'wb', compresslevel)
+			else:
+				jsonfile = open(jsonfilename, 'w')
+			jsonfile.write(json.dumps(jsonreport, indent=4))
+			jsonfile.close()
 		scanqueue.task_done()
 
 def printjson(unpackreports, scantempdir, topleveldir, processors, scanenv, batcursors, batcons, scandebug=False, unpacktempdir=None):
@@ -287,58 +253,44 @@ def printjson(unpackreports, scantempdir, topleveldir, processors, scanenv, batc
 	if batcursors != []:
 		usedb = True
 
-	decodingneeded = ['utf-8','ascii','latin-1','euc_jp', 'euc_jis_2004', 'jisx0213', 'iso2022_jp', 'iso2022_jp_1', 'iso2022_jp_2', 'iso2022_jp_2004', 'iso2022_jp_3', 'iso2022_jp_ext', 'iso2022_kr','shift_jis','shift_jis_2004','shift_jisx0213']
 	for unpackreport in unpackreports:
 		jsonreport = {}
 		filehash = None
 		if "checksum" in unpackreports[unpackreport]:
-			filehash = copy.deepcopy(unpackreports[unpackreport]['checksum'])
+			filehash = unpackreports[unpackreport]['checksum']
 			jsonreport['checksum'] = filehash
 			jsonreport['checksumtype'] = outputhash
 			for c in ['sha256', 'md5', 'sha1', 'crc32', 'tlsh']:
 				if c in unpackreports[unpackreport]:
 					if unpackreports[unpackreport][c] != None:
-						jsonreport[c] = copy.deepcopy(unpackreports[unpackreport][c])
+						jsonreport[c] = unpackreports[unpackreport][c]
 		for p in ["name", "path", "realpath"]:
 			if p in unpackreports[unpackreport]:
-				nodename = copy.deepcopy(unpackreports[unpackreport][p])
 				## check whether or not the name of the file does not contain any weird
 				## characters by decoding it to UTF-8
-				decoded = False
-				for i in decodingneeded:
-					try:
-						nodename = nodename.decode(i)
-						decoded = True
-						break
-					except Exception, e:
-						pass
-				if decoded:
+				nodename = decodestring(unpackreports[unpackreport][p])
+				if nodename != None:
 					jsonreport[p] = nodename
 				else:
 					if filehash != None:
 						jsonreport[p] = "name-for-%s-cannot-be-displayed" % filehash
 		if "tags" in unpackreports[unpackreport]:
-			jsonreport['tags'] = list(set(copy.deepcopy(unpackreports[unpackreport]['tags'])))
+			jsonreport['tags'] = list(set(unpackreports[unpackreport]['tags']))
 		if "magic" in unpackreports[unpackreport]:
-			jsonreport['magic'] = copy.deepcopy(unpackreports[unpackreport]['magic'])
+			jsonreport['magic'] = unpackreports[unpackreport]['magic']
 		if "size" in unpackreports[unpackreport]:
-			jsonreport['size'] = copy.deepcopy(unpackreports[unpackreport]['size'])
+			jsonreport['size'] = unpackreports[unpackreport]['size']
 		if "scans" in unpackreports[unpackreport]:
 			if unpackreports[unpackreport]['scans'] != []:
-				reps = copy.deepcopy(unpackreports[unpackreport]['scans'])
+				## the scan reports are rewritten below, so make a (shallow)
+				## copy of each scan instead of changing the unpack reports
+				reps = map(lambda x: dict(x), unpackreports[unpackreport]['scans'])
 				for r in reps:
 					if 'scanreports' in r:
 						newscanreports = []
 						for s in r['scanreports']:
-							decoded = False
-							for i in decodingneeded:
-								try:
-									s = s.decode(i)
-									decoded = True
-									break
-								except Exception, e:
-									pass
-							if decoded:
+							s = decodestring(s)
+							if s != None:
 								newscanreports.append(s)
 							else:
 								if filehash != None:
@@ -349,13 +301,13 @@ def printjson(unpackreports, scantempdir, topleveldir, processors, scanenv, batc
 
 	if jsondumps != []:
 		jsonfile = open(os.path.join(topleveldir, "scandata.json"), 'w')
-		for chunk in json.JSONEncoder(indent=4).iterencode(jsondumps):
-			jsonfile.write(chunk)
+		json.dump(jsondumps, jsonfile, indent=4)
 		jsonfile.close()
 
 	## keep track of which file hashes have already been seen
 	filehashes = set()
 	jsontasks = []
+	rankingtasks = []
 
 	converthash = False
 
@@ -378,6 +330,7 @@ def printjson(unpackreports, scantempdir, topleveldir, processors, scanenv, batc
 		if 'ranking' in unpackreports[unpackreport]['tags']:
 			if outputhash != 'sha256':
 				converthash = True
+			rankingtasks.append(filehash)
 		filehashes.add(filehash)
 		jsontasks.append(filehash)
 
@@ -387,10 +340,31 @@ def printjson(unpackreports, scantempdir, topleveldir, processors, scanenv, batc
 		else:
 			processamount = processors
 		processamount = min(processamount, len(jsontasks))
-		scanmanager = multiprocessing.Manager()
+
+		## If there are several processes, then convert the checksums for all
+		## reports here first. Otherwise each process would look up the
+		## checksums that are shared between files (which are quite common)
+		## again. The processes get a copy of the results when they are
+		## started.
+		hashcache = {}
+		hashmisses = set()
+		if converthash and usedb and processamount > 1:
+			checksums = set()
+			for filehash in rankingtasks:
+				leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'rb')
+				leafreports = cPickle.load(leaf_file)
+				leaf_file.close()
+				if 'ranking' in leafreports:
+					checksums.update(rankingchecksums(leafreports['ranking']))
+			converthashes(checksums, hashcache, hashmisses, outputhash, batcursors[0], batcons[0])
+
 		processpool = []
 		scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-		map(lambda x: scanqueue.put(x), jsontasks)
+		## put the tasks in the queue in chunks, with a few chunks per
+		## process so the work is still spread evenly
+		chunksize = max(1, len(jsontasks)/(processamount*4))
+		for i in range(0, len(jsontasks), chunksize):
+			scanqueue.put(jsontasks[i:i+chunksize])
 
 		for i in range(0,processamount):
 			if usedb:
@@ -399,7 +373,7 @@ def printjson(unpackreports, scantempdir, topleveldir, processors, scanenv, batc
 			else:
 				cursor = None
 				conn = None
-			p = multiprocessing.Process(target=writejson, args=(scanqueue,topleveldir,outputhash, cursor, conn, scanenv, converthash, compressed))
+			p = multiprocessing.Process(target=writejson, args=(scanqueue,topleveldir,outputhash, cursor, conn, scanenv, converthash, compressed, hashcache, hashmisses))
 			processpool.append(p)
 			p.start()
 
@@ -16,48 +16,44 @@ The method works as follows:
 
 1. All data from pickles that is needed to generate reports is extracted in
 parallel.
-2. The checksums of the pickles are computed and recorded. If there is a
-duplicate the duplicate pickle is removed and it is recorded which file it
+2. The checksums of the (pickled) data are computed and recorded. If there is
+a duplicate the duplicate data is discarded and it is recorded which file it
 originally belonged to.
-3. Reports are (partially) generated in parallel for the remaining pickle files.
+3. Reports are (partially) generated in parallel for the remaining data, as
+soon as the data comes in.
 4. The reports are copied and renamed, or assembled from partial reports
 '''
 
-import os, os.path, sys, copy, cPickle, tempfile, hashlib, shutil, multiprocessing, cgi, gzip
+import os, os.path, sys, copy, cPickle, hashlib, shutil, multiprocessing, cgi, gzip
 
-## compute a SHA256 hash. This is done in chunks to prevent a big file from
-## being read in its entirety at once, slowing down a machine.
-def gethash(path):
-	scanfile = open(path, 'r')
+## compute a SHA256 hash of the pickled data. The data is handed to the
+## report generating methods directly, so there is no need to write it to
+## (and later read it from) a temporary file.
+def gethash(pickledata):
 	h = hashlib.new('sha256')
-	scanfile.seek(0)
-	hashdata = scanfile.read(10000000)
-	while hashdata != '':
-		h.update(hashdata)
-		hashdata = scanfile.read(10000000)
-	scanfile.close()
+	h.update(cPickle.dumps(pickledata, cPickle.HIGHEST_PROTOCOL))
 	return h.hexdigest()
 
 ## helper function to condense version numbers and squash numbers.
 def squash_versions(versions):
 	if len(versions) <= 3:
-		versionline = reduce(lambda x, y: "%s, %s" % (x,y), versions)
+		versionline = ", ".join(versions)
 		return versionline
 	# check if we have versions without '.'
-	if len(filter(lambda x: '.' not in x, versions)) != 0:
-		versionline = reduce(lambda x, y: "%s, %s" % (x,y), versions)
+	if any('.' not in x for x in versions):
+		versionline = ", ".join(versions)
 		return versionline
 	versionparts = []
 	# get the major version number first
-	majorv = set(map(lambda x: x.split('.')[0], versions))
+	majorv = set(map(lambda x: x.split('.', 1)[0], versions))
 	for m in majorv:
 		maxconsolidationlevel = 0
 		## determine how many subcomponents we have at max
 		filterversions = filter(lambda x: x.startswith(m + "."), versions)
 		if len(filterversions) == 1:
-			versionparts.append(reduce(lambda x, y: "%s, %s" % (x, y), filterversions))
+			versionparts.append(filterversions[0])
 			continue
-		minversionsplits = min(set(map(lambda x: len(x.split('.')), filterversions))) - 1
+		minversionsplits = min(set(map(lambda x: x.count('.'), filterversions)))
 		## split with a maximum of minversionsplits splits
 		splits = map(lambda x: x.split('.', minversionsplits), filterversions)
 		for c in xrange(0, minversionsplits):
@@ -66,16 +62,12 @@ def squash_versions(versions):
 			else: break
 		if minversionsplits != maxconsolidationlevel:
 			splits = map(lambda x: x.split('.', maxconsolidationlevel), filterversions)
-		versionpart = reduce(lambda x, y: "%s.%s" % (x, y), splits[0][:maxconsolidationlevel]) + ".{%s}" % reduce(lambda x, y: x + ", " + y, map(lambda x: x[-1], splits))
+		versionpart = ".".join(splits[0][:maxconsolidationlevel]) + ".{%s}" % ", ".join(map(lambda x: x[-1], splits))
 		versionparts.append(versionpart)
-	versionline = reduce(lambda x, y: x + ", " + y, versionparts)
+	versionline = ", ".join(versionparts)
 	return versionline
 
-def generatehtmlsnippet((picklefile, pickledir, picklehash, reportdir)):
-	html_pickle = open(os.path.join(pickledir, picklefile), 'rb')
-	(packagename, uniquematches) = cPickle.load(html_pickle)
-	html_pickle.close()
-	os.unlink(os.path.join(pickledir, picklefile))
+def generatehtmlsnippet(((packagename, uniquematches), picklehash, reportdir)):
 	lenuniquematches = len(uniquematches)
 	if lenuniquematches == 0:
 		return
@@ -83,7 +75,8 @@ def generatehtmlsnippet((picklefile, pickledir, picklehash, reportdir)):
 	squashed_versions = {}
 
 	uniquehtmlfile = open("%s/%s-unique.snippet" % (reportdir, picklehash), 'wb')
-	uniquehtmlfile.write("<hr><h2><a name=\"%s\" href=\"#%s\">Matches for: %s (%d)</a></h2>" % (packagename, packagename, packagename, lenuniquematches))
+	htmlpackagename = cgi.escape(packagename, True)
+	uniquehtmlfile.write("<hr><h2><a name=\"%s\" href=\"#%s\">Matches for: %s (%d)</a></h2>" % (htmlpackagename, htmlpackagename, htmlpackagename, lenuniquematches))
 	uniquematches.sort()
 	for k in uniquematches:
 		(programstring, results) = k
@@ -135,19 +128,19 @@ def generatehtmlsnippet((picklefile, pickledir, picklehash, reportdir)):
 					if squashed_versions.has_key(checksum):
 						versionline = squashed_versions[checksum]
 					else:
-						versionline = squash_versions(versions)
+						versionline = cgi.escape(squash_versions(versions))
 						squashed_versions[checksum] = versionline
 					ch = sh[checksum].pop()
-					numlines = reduce(lambda x, y: "%s, %s" % (x,y), map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
-					uniquehtmlfile.write("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (ch[0], versionline, numlines, checksum))
+					numlines = ", ".join(map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
+					uniquehtmlfile.write("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (cgi.escape(ch[0]), versionline, numlines, checksum))
 				else:   
 					for d in chs:
 						filterd = filter(lambda x: x[0] == d, sh[checksum])
 						linenumbers = sorted(set(map(lambda x: (x[2]), filterd)))
 						versions = sorted(set(map(lambda x: (x[1]), filterd)))
-						versionline = squash_versions(versions)
-						numlines = reduce(lambda x, y: "%s, %s" % (x,y), map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
-						uniquehtmlfile.write("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (d, versionline, numlines, checksum))
+						versionline = cgi.escape(squash_versions(versions))
+						numlines = ", ".join(map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
+						uniquehtmlfile.write("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (cgi.escape(d), versionline, numlines, checksum))
 			uniquehtmlfile.write("</table></p>\n")
 		else:
 			uniquehtmlfile.write("<h5>%s</h5>" % cgi.escape(programstring))
@@ -155,7 +148,7 @@ def generatehtmlsnippet((picklefile, pickledir, picklehash, reportdir)):
 
 ## generate several output files and extract pickles
 ## TODO: change name
-def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir, compressed)):
+def extractpickles((filehash, topleveldir, reportdir, compressed)):
 	leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'rb')
 	leafreports = cPickle.load(leaf_file)
 	leaf_file.close()
@@ -164,7 +157,7 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 	reportresults = []
 	functionresults = []
 
-	## (picklehash, picklename)
+	## (picklehash, pickledata)
 	unmatchedresult = None
 	if not leafreports.has_key('ranking'):
 		return (filehash, reportresults, functionresults, unmatchedresult)
@@ -172,35 +165,35 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 	(res, dynamicRes, variablepvs, language) = leafreports['ranking']
 
 	if dynamicRes != {}:
-		html = ""
+		htmlparts = []
 		## if the results are stored in the pickle generate nice reports.
 		if dynamicRes.has_key('kernelfunctions'):
 			if dynamicRes['kernelfunctions'] != []:
 				if not dynamicRes.has_key('versionresults'):
 					kernelfuncs = list(set(dynamicRes['kernelfunctions']))
 					kernelfuncs.sort()
-					html += "<h1>Kernel function name matches</h1><p><ul>\n"
+					htmlparts.append("<h1>Kernel function name matches</h1><p><ul>\n")
 					for d in kernelfuncs:
-						html += "<li>%s</li>" % d
-					html += "</ul></p>\n"
+						htmlparts.append("<li>%s</li>" % cgi.escape(d))
+					htmlparts.append("</ul></p>\n")
 		if dynamicRes.has_key('versionresults'):
 			if dynamicRes['versionresults'] != {}:
 				squashed_versions = {}
-				html += "<h1>Unique function name matches per package</h1><p><ul>\n"
-				ukeys = map(lambda x: (x[0], len(x[1])), dynamicRes['versionresults'].items())
+				htmlparts.append("<h1>Unique function name matches per package</h1><p><ul>\n")
+				ukeys = map(lambda x: (x[0], len(x[1]), cgi.escape(x[0], True)), dynamicRes['versionresults'].items())
 				ukeys.sort(key=lambda x: x[1], reverse=True)
 				for i in ukeys:
-					html += "<li><a href=\"#%s\">%s (%d)</a></li>" % (i[0], i[0], i[1])
-				html += "</ul></p>\n"
+					htmlparts.append("<li><a href=\"#%s\">%s (%d)</a></li>" % (i[2], i[2], i[1]))
+				htmlparts.append("</ul></p>\n")
 				for i in ukeys:
 					packagename = i[0]
-					html += "<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2>\n" % (packagename, packagename, packagename, i[1])
+					htmlparts.append("<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2>\n" % (i[2], i[2], i[2], i[1]))
 					upkgs = dynamicRes['versionresults'][packagename]
 					upkgs.sort()
 					for up in upkgs:
 						sh = {}
 						(funcname, results) = up
-						html += "<h5>%s</h5><p><table><tr><td><b>Filename</b></td><td><b>Version(s)</b></td><td><b>Line number</b></td><td><b>SHA256</b></td></tr>" % cgi.escape(funcname)
+						htmlparts.append("<h5>%s</h5><p><table><tr><td><b>Filename</b></td><td><b>Version(s)</b></td><td><b>Line number</b></td><td><b>SHA256</b></td></tr>" % cgi.escape(funcname))
 						for r in results:
 							(checksum, linenumber, versionfilenames) = r 
 							for vf in versionfilenames:
@@ -245,41 +238,41 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 								if squashed_versions.has_key(checksum):
 									versionline = squashed_versions[checksum]
 								else:
-									versionline = squash_versions(versions)
+									versionline = cgi.escape(squash_versions(versions))
 									squashed_versions[checksum] = versionline
 								ch = sh[checksum].pop()
-								numlines = reduce(lambda x, y: "%s, %s" % (x,y), map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
-								html+= "<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (ch[0], versionline, numlines, checksum)
+								numlines = ", ".join(map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
+								htmlparts.append("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (cgi.escape(ch[0]), versionline, numlines, checksum))
 							else:
 								for d in chs:
 									filterd = filter(lambda x: x[0] == d, sh[checksum])
 									linenumbers = sorted(set(map(lambda x: (x[2]), filterd)))
 									versions = sorted(set(map(lambda x: (x[1]), filterd)))
-									versionline = squash_versions(versions)
-									numlines = reduce(lambda x, y: "%s, %s" % (x,y), map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
-									html += "<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (d, versionline, numlines, checksum)
+									versionline = cgi.escape(squash_versions(versions))
+									numlines = ", ".join(map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
+									htmlparts.append("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (cgi.escape(d), versionline, numlines, checksum))
 
 
-						html += "</table></p>\n"
+						htmlparts.append("</table></p>\n")
 		elif dynamicRes.has_key('uniquepackages'):
 			if dynamicRes['uniquepackages'] != {}:
-				html += "<h1>Unique function name matches per package</h1><p><ul>\n"
-				ukeys = map(lambda x: (x[0], len(x[1])), dynamicRes['uniquepackages'].items())
+				htmlparts.append("<h1>Unique function name matches per package</h1><p><ul>\n")
+				ukeys = map(lambda x: (x[0], len(x[1]), cgi.escape(x[0], True)), dynamicRes['uniquepackages'].items())
 				ukeys.sort(key=lambda x: x[1], reverse=True)
 				for i in ukeys:
-					html += "<li><a href=\"#%s\">%s (%d)</a></li>" % (i[0], i[0], i[1])
-				html += "</ul></p>"
+					htmlparts.append("<li><a href=\"#%s\">%s (%d)</a></li>" % (i[2], i[2], i[1]))
+				htmlparts.append("</ul></p>")
 				for i in ukeys:
-					html += "<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2><p>\n" % (i[0], i[0], i[0], i[1])
+					htmlparts.append("<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2><p>\n" % (i[2], i[2], i[2], i[1]))
 					upkgs = dynamicRes['uniquepackages'][i[0]]
 					upkgs.sort()
 					for v in upkgs:
-						html += "%s<br>\n" % cgi.escape(v)
-					html += "</p>\n"
-		if html != "":
+						htmlparts.append("%s<br>\n" % cgi.escape(v))
+					htmlparts.append("</p>\n")
+		if htmlparts != []:
 			htmlfilename = "%s/%s-functionnames.html" % (reportdir, filehash)
 			nameshtmlfile = open(htmlfilename, 'wb')
-			nameshtmlfile.write("<html><body>%s</body></html>" % html)
+			nameshtmlfile.write("<html><body>%s</body></html>" % "".join(htmlparts))
 			nameshtmlfile.close()
 			if compressed:
 				fin = open(htmlfilename, 'rb')
@@ -296,7 +289,7 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 			header = "<html><body><h1>Unique matches of class names, field names and source file names</h1>"
 		elif language == 'C':
 			header = "<html><body><h1>Matches of variable names</h1>"
-		html = ""
+		htmlparts = []
 
 		if language == 'Java':
 			totalvars = 0
@@ -309,15 +302,16 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 			for i in ['classes', 'sources', 'fields']:
 				if not variablepvs.has_key(i):
 					continue
-				totalvars += len(variablepvs[i])
+				variablenames = variablepvs[i]
+				totalvars += len(variablenames)
 				packages = {}
 				packagecount = {}
-				if variablepvs[i] != []:
-					for c in variablepvs[i]:
-						lenres = len(set(map(lambda x: x[0], variablepvs[i][c])))
+				if variablenames != []:
+					for c in variablenames:
+						pvs = variablenames[c]
+						lenres = len(set(map(lambda x: x[0], pvs)))
 						if lenres == 1:
-							pvs = variablepvs[i][c]
-							(package,version) = variablepvs[i][c][0]
+							(package,version) = pvs[0]
 							if packagecount.has_key(package):
 								packagecount[package] = packagecount[package] + 1
 							else:
@@ -339,45 +333,45 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 						fieldspackages = packages
 
 			if classescount != {}:
-				html = html + "<h3>Unique matches of class names</h3>\n<table>\n"
-				html = html + "<tr><td><b>Name</b></td><td><b>Unique matches</b></td></tr>"
+				htmlparts.append("<h3>Unique matches of class names</h3>\n<table>\n")
+				htmlparts.append("<tr><td><b>Name</b></td><td><b>Unique matches</b></td></tr>")
 				for i in classescount:
-					html = html + "<tr><td>%s</td><td>%d</td></tr>\n" % (i, classescount[i])
-				html = html + "</table>\n"
+					htmlparts.append("<tr><td>%s</td><td>%d</td></tr>\n" % (cgi.escape(i), classescount[i]))
+				htmlparts.append("</table>\n")
 
 			if sourcescount != {}:
-				html = html + "<h3>Unique matches of source file names</h3>\n<table>\n"
-				html = html + "<tr><td><b>Name</b></td><td><b>Unique matches</b></td></tr>"
+				htmlparts.append("<h3>Unique matches of source file names</h3>\n<table>\n")
+				htmlparts.append("<tr><td><b>Name</b></td><td><b>Unique matches</b></td></tr>")
 				for i in sourcescount:
-					html = html + "<tr><td>%s</td><td>%d</td></tr>\n" % (i, sourcescount[i])
-				html = html + "</table>\n"
+					htmlparts.append("<tr><td>%s</td><td>%d</td></tr>\n" % (cgi.escape(i), sourcescount[i]))
+				htmlparts.append("</table>\n")
 
 			if fieldscount != {}:
-				html = html + "<h3>Unique matches of field names</h3>\n<table>\n"
-				html = html + "<tr><td><b>Name</b></td><td><b>Unique matches</b></td></tr>"
+				htmlparts.append("<h3>Unique matches of field names</h3>\n<table>\n")
+				htmlparts.append("<tr><td><b>Name</b></td><td><b>Unique matches</b></td></tr>")
 				for i in fieldscount:
-					html = html + "<tr><td>%s</td><td>%d</td></tr>\n" % (i, fieldscount[i])
-				html = html + "</table>\n"
+					htmlparts.append("<tr><td>%s</td><td>%d</td></tr>\n" % (cgi.escape(i), fieldscount[i]))
+				htmlparts.append("</table>\n")
 
 		if language == 'C':
 			totalvars = 0
 			if variablepvs.has_key('versionresults'):
 				if variablepvs['versionresults'] != {}:
-					html += "<h1>Unique variable name matches per package</h1><p><ul>\n"
-					ukeys = map(lambda x: (x[0], len(x[1])), variablepvs['versionresults'].items())
+					htmlparts.append("<h1>Unique variable name matches per package</h1><p><ul>\n")
+					ukeys = map(lambda x: (x[0], len(x[1]), cgi.escape(x[0], True)), variablepvs['versionresults'].items())
 					ukeys.sort(key=lambda x: x[1], reverse=True)
 					for i in ukeys:
-						html += "<li><a href=\"#%s\">%s (%d)</a></li>" % (i[0], i[0], i[1])
-					html += "</ul></p>\n"
+						htmlparts.append("<li><a href=\"#%s\">%s (%d)</a></li>" % (i[2], i[2], i[1]))
+					htmlparts.append("</ul></p>\n")
 					for i in ukeys:
 						packagename = i[0]
-						html += "<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2>\n" % (packagename, packagename, packagename, i[1])
+						htmlparts.append("<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2>\n" % (i[2], i[2], i[2], i[1]))
 						upkgs = variablepvs['versionresults'][packagename]
 						upkgs.sort()
 						for up in upkgs:
 							sh = {}
 							(funcname, results) = up
-							html += "<h5>%s</h5><p><table><tr><td><b>Filename</b></td><td><b>Version(s)</b></td><td><b>Line number</b></td><td><b>SHA256</b></td></tr>" % cgi.escape(funcname)
+							htmlparts.append("<h5>%s</h5><p><table><tr><td><b>Filename</b></td><td><b>Version(s)</b></td><td><b>Line number</b></td><td><b>SHA256</b></td></tr>" % cgi.escape(funcname))
 							for r in results:
 								(checksum, linenumber, versionfilenames) = r 
 								for vf in versionfilenames:
@@ -417,43 +411,43 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 									if squashed_versions.has_key(checksum):
 										versionline = squashed_versions[checksum]
 									else:
-										versionline = squash_versions(versions)
+										versionline = cgi.escape(squash_versions(versions))
 										squashed_versions[checksum] = versionline
 									ch = sh[checksum].pop()
-									numlines = reduce(lambda x, y: "%s, %s" % (x,y), map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
-									html+= "<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (ch[0], versionline, numlines, checksum)
+									numlines = ", ".join(map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
+									htmlparts.append("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (cgi.escape(ch[0]), versionline, numlines, checksum))
 								else:
 									for d in chs:
 										filterd = filter(lambda x: x[0] == d, sh[checksum])
 										linenumbers = sorted(set(map(lambda x: (x[2]), filterd)))
 										versions = sorted(set(map(lambda x: (x[1]), filterd)))
-										versionline = squash_versions(versions)
-										numlines = reduce(lambda x, y: "%s, %s" % (x,y), map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
-										html += "<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (d, versionline, numlines, checksum)
+										versionline = cgi.escape(squash_versions(versions))
+										numlines = ", ".join(map(lambda x: "<a href=\"unique:/%s#%d\">%d</a>" % (checksum, x, x), linenumbers))
+										htmlparts.append("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n" % (cgi.escape(d), versionline, numlines, checksum))
 
 
-							html += "</table></p>\n"
+							htmlparts.append("</table></p>\n")
 			elif variablepvs.has_key('uniquepackages'):
 				if variablepvs['uniquepackages'] != {}:
 
-					ukeys = map(lambda x: (x[0], len(x[1])), variablepvs['uniquepackages'].items())
+					ukeys = map(lambda x: (x[0], len(x[1]), cgi.escape(x[0], True)), variablepvs['uniquepackages'].items())
 					ukeys.sort(key=lambda x: x[1], reverse=True)
 					for i in ukeys:
-						html += "<li><a href=\"#%s\">%s (%d)</a></li>" % (i[0], i[0], i[1])
-					html += "</ul></p>"
+						htmlparts.append("<li><a href=\"#%s\">%s (%d)</a></li>" % (i[2], i[2], i[1]))
+					htmlparts.append("</ul></p>")
 					for i in ukeys:
-						html += "<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2><p>\n" % (i[0], i[0], i[0], i[1])
+						htmlparts.append("<hr><h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2><p>\n" % (i[2], i[2], i[2], i[1]))
 						upkgs = variablepvs['uniquepackages'][i[0]]
 						upkgs.sort()
 						for v in upkgs:
-							html += "%s<br>\n" % cgi.escape(v)
-						html += "</p>\n"
+							htmlparts.append("%s<br>\n" % cgi.escape(v))
+						htmlparts.append("</p>\n")
 
-		if html != "":
+		if htmlparts != []:
 			htmlfilename = "%s/%s-names.html" % (reportdir, filehash)
 			nameshtmlfile = open(htmlfilename, 'wb')
 			nameshtmlfile.write(header)
-			nameshtmlfile.write(html)
+			nameshtmlfile.write("".join(htmlparts))
 			nameshtmlfile.write(footer)
 			nameshtmlfile.close()
 			if compressed:
@@ -469,41 +463,39 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 			unmatches = list(set(res['unmatched']))
 			unmatches.sort()
 
-			tmppickle = tempfile.mkstemp(dir=unpacktempdir)
-
-			cPickle.dump(unmatches, os.fdopen(tmppickle[0], 'wb'))
-			picklehash = gethash(tmppickle[1])
-			unmatchedresult = (picklehash, tmppickle[1])
+			picklehash = gethash(unmatches)
+			unmatchedresult = (picklehash, unmatches)
 
 		if res['reports'] != []:
 			for j in res['reports']:
 				(rank, packagename, uniquematches, uniquematcheslen, percentage, packageversions, licenses, copyrights) = j
 				if len(uniquematches) == 0:
 					continue
-				tmppickle = tempfile.mkstemp(dir=unpacktempdir)
-				cPickle.dump((packagename, uniquematches), os.fdopen(tmppickle[0], 'wb'))
-				picklehash = gethash(tmppickle[1])
-				reportresults.append((rank, picklehash, tmppickle[1], uniquematcheslen, packagename))
+				pickledata = (packagename, uniquematches)
+				picklehash = gethash(pickledata)
+				reportresults.append((rank, picklehash, pickledata, uniquematcheslen, packagename))
 		if res['nonUniqueMatches'] != {}:
 			order = map(lambda x: (len(res['nonUniqueMatches'][x]), x), res['nonUniqueMatches'].keys())
 			order.sort(reverse=True)
-			html = "<html><body><h1>Assigned strings per package</h1><p><ul>"
+			htmlparts = ["<html><body><h1>Assigned strings per package</h1><p><ul>"]
 			for r in order:
 				(count, packagename) = r
-				html += "<li><a href=\"#%s\">%s (%d)</a></li>" % (packagename, packagename, count)
-			html += "</ul></p><hr>"
-			html += "</body></html>"
+				htmlpackagename = cgi.escape(packagename, True)
+				htmlparts.append("<li><a href=\"#%s\">%s (%d)</a></li>" % (htmlpackagename, htmlpackagename, count))
+			htmlparts.append("</ul></p><hr>")
+			htmlparts.append("</body></html>")
 			for r in order:
 				(count, packagename) = r
-				html += "<h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2><p>" % (packagename, packagename, packagename, count)
+				htmlpackagename = cgi.escape(packagename, True)
+				htmlparts.append("<h2><a name=\"%s\" href=\"#%s\">Matches for %s (%d)</a></h2><p>" % (htmlpackagename, htmlpackagename, htmlpackagename, count))
 				assignedmatches = res['nonUniqueMatches'][packagename]
 				assignedmatches.sort()
 				for rr in assignedmatches:
-					html += "%s<br>\n" % cgi.escape(rr)
-				html += "</p><hr>"
+					htmlparts.append("%s<br>\n" % cgi.escape(rr))
+				htmlparts.append("</p><hr>")
 			htmlfilename = "%s/%s-assigned.html" % (reportdir, filehash)
 			assignedhtmlfile = open(htmlfilename, 'wb')
-			assignedhtmlfile.write(html)
+			assignedhtmlfile.write("".join(htmlparts))
 			assignedhtmlfile.write(footer)
 			assignedhtmlfile.close()
 			if compressed:
@@ -515,11 +507,7 @@ def extractpickles((filehash, pickledir, topleveldir, reportdir, unpacktempdir,
 				os.unlink(fin.name)
 	return (filehash, reportresults, functionresults, unmatchedresult)
 
-def generateunmatched((picklefile, pickledir, filehash, reportdir, compressed)):
-
-	unmatched_pickle = open(os.path.join(pickledir, picklefile), 'rb')
-	unmatches = cPickle.load(unmatched_pickle)
-        unmatched_pickle.close()
+def generateunmatched((unmatches, filehash, reportdir, compressed)):
 
 	unmatchedhtml = "<html><body><h1>Unmatched strings (%d strings)</h1><p>" % (len(unmatches),)
 	unmatchedsnippets = map(lambda x: "%s<br>\n" % cgi.escape(x), unmatches)
@@ -536,7 +524,6 @@ def generateunmatched((picklefile, pickledir, filehash, reportdir, compressed)):
 		fout.close()
 		fin.close()
 		os.unlink(fin.name)
-	os.unlink(os.path.join(pickledir, picklefile))
 
 def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv, batcursors, batcons, scandebug=False, unpacktempdir=None):
 	if scanenv.has_key('overridedir'):
@@ -544,10 +531,6 @@ def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv
 			del scanenv['BAT_REPORTDIR']
 		except:
 			pass
-		try:
-			del scanenv['BAT_PICKLEDIR']
-		except:
-			pass
 
 	reportdir = scanenv.get('BAT_REPORTDIR', os.path.join(topleveldir, "reports"))
 	try:
@@ -559,16 +542,6 @@ def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv
 		except Exception, e:
 			return
 
-	pickledir = scanenv.get('BAT_PICKLEDIR', os.path.join(topleveldir, "pickles"))
-	try:
-		os.stat(pickledir)
-	except:
-		## BAT_PICKLEDIR does not exist
-		try:
-			os.makedirs(pickledir)
-		except Exception, e:
-			return
-
 	filehashes = set()
 
 	## filter out the files which don't have ranking results
@@ -591,7 +564,6 @@ def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv
 
 	unmatchedpicklespackages = set()
 	picklespackages = set()
-	picklehashes = {}
 	unmatchedpickles = set()
 	reportpickles = set()
 
@@ -600,50 +572,47 @@ def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv
 	else:
 		compressed = False
 
-	## extract pickles and generate some files
-	extracttasks = map(lambda x: (x, pickledir, topleveldir, reportdir, unpacktempdir, compressed), filehashes)
+	## extract pickles and generate some files. Every result is handled
+	## when it arrives: new data is queued on the same pool right away and
+	## duplicate data is thrown away, instead of first keeping the data of
+	## every file in the main process.
+	extracttasks = map(lambda x: (x, topleveldir, reportdir, compressed), filehashes)
 	pool = multiprocessing.Pool(processes=processors)
-	res = filter(lambda x: x != None, pool.map(extractpickles, extracttasks, 1))
-	pool.terminate()
+	generatetasks = []
 
 	## {filehash: [(picklehash, uniquematcheslen, packagename)]
 	## misnomer since 'rank' is no longer used
 	resultranks = {}
 
-	for r in res:
+	for r in pool.imap_unordered(extractpickles, extracttasks, 1):
+		if r == None:
+			continue
 		(filehash, resultreports, functionresults, unmatchedresult) = r
 		if unmatchedresult != None:
-			(picklehash, tmppickle) = unmatchedresult
-			if picklehash in unmatchedpickles:
-				unmatchedpicklespackages.add((picklehash, filehash))
-				os.unlink(tmppickle)
-			else:
-				shutil.move(tmppickle, pickledir)
+			(picklehash, pickledata) = unmatchedresult
+			if not picklehash in unmatchedpickles:
 				unmatchedpickles.add(picklehash)
-				unmatchedpicklespackages.add((picklehash, filehash))
-				picklehashes[picklehash] = os.path.basename(tmppickle)
+				generatetasks.append(pool.apply_async(generateunmatched, ((pickledata, picklehash, reportdir, compressed),)))
+			unmatchedpicklespackages.add((picklehash, filehash))
 		if resultreports != []:
 			for report in resultreports:
-				(rank, picklehash, tmppickle, uniquematcheslen, packagename) = report
+				(rank, picklehash, pickledata, uniquematcheslen, packagename) = report
 				if resultranks.has_key(filehash):
 					resultranks[filehash].append((picklehash, uniquematcheslen, packagename))
 				else:
 					resultranks[filehash] = [(picklehash, uniquematcheslen, packagename)]
-				if picklehash in reportpickles:
-					picklespackages.add((picklehash, filehash))
-					os.unlink(tmppickle)
-				else:
-					shutil.move(tmppickle, pickledir)
+				if not picklehash in reportpickles:
 					reportpickles.add(picklehash)
-					picklespackages.add((picklehash, filehash))
-					picklehashes[picklehash] = os.path.basename(tmppickle)
+					generatetasks.append(pool.apply_async(generatehtmlsnippet, ((pickledata, picklehash, reportdir),)))
+				picklespackages.add((picklehash, filehash))
 
-	pool = multiprocessing.Pool(processes=processors)
+	## wait for all the reports to be generated
+	for g in generatetasks:
+		g.get()
+	pool.terminate()
 
-	## generate files for unmatched strings
+	## copy the files for unmatched strings for every file that needs it
 	if unmatchedpickles != set():
-		unmatchedtasks = set(map(lambda x: (picklehashes[x[0]], pickledir, x[0], reportdir, compressed), unmatchedpicklespackages))
-		results = pool.map(generateunmatched, unmatchedtasks, 1)
 		for p in unmatchedpicklespackages:
 			if compressed:
 				oldfilename = "%s-%s" % (p[0], "unmatched.html.gz")
@@ -666,8 +635,6 @@ def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv
 				#print >>sys.stderr, "ERR", e
 				pass
 	if reportpickles != set():
-		reporttasks = set(map(lambda x: (picklehashes[x[0]], pickledir, x[0], reportdir), picklespackages))
-		pool.map(generatehtmlsnippet, reporttasks, 1)
 		## now recombine the results and write to a HTML file
 		pickleremoves = set()
 		for filehash in resultranks.keys():
@@ -676,7 +643,8 @@ def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv
 			uniquehtmlfile.write("<html><body><h1>Unique matches per package</h1><p><ul>")
 			for r in resultranks[filehash]:
 				(picklehash, uniquematcheslen, packagename) = r
-				uniquehtmlfile.write("<li><a href=\"#%s\">%s (%d)</a></li>" % (packagename, packagename, uniquematcheslen))
+				htmlpackagename = cgi.escape(packagename, True)
+				uniquehtmlfile.write("<li><a href=\"#%s\">%s (%d)</a></li>" % (htmlpackagename, htmlpackagename, uniquematcheslen))
 			uniquehtmlfile.write("</ul></p>")
 			for r in resultranks[filehash]:
 				(picklehash, uniquematcheslen, packagename) = r
@@ -700,4 +668,3 @@ def generatereports(unpackreports, scantempdir, topleveldir, processors, scanenv
 			except Exception, e:
 				## print >>sys.stderr, e
 				pass
-	pool.terminate()
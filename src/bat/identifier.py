@@ -301,7 +301,7 @@ def extractC(filepath, tags, scanenv, filesize, stringcutoff, linuxkernel, black
 				return None
 			tmpfile = tempfile.mkstemp(dir=unpacktempdir)
 			os.write(tmpfile[0], databytes)
-			os.fdopen(tmpfile[0]).close()
+			os.close(tmpfile[0])
 			scanfile = tmpfile[1]
 			createdtempfile = True
 	## store the extracted string constants in the order
@@ -367,7 +367,7 @@ def extractC(filepath, tags, scanenv, filesize, stringcutoff, linuxkernel, black
 						datafile.seek(elfoffset)
 						data = datafile.read(elfsize)
 						os.write(elftmp[0], data)
-						os.fdopen(elftmp[0]).close()
+						os.close(elftmp[0])
 						elfscanfiles.append(elftmp[1])
 				datafile.close()
 
@@ -421,7 +421,7 @@ def extractC(filepath, tags, scanenv, filesize, stringcutoff, linuxkernel, black
 			os.write(bfltdata[0], uncompresseddata)
 		else:
 			os.write(bfltdata[0], databytes)
-		os.fdopen(bfltdata[0]).close()
+		os.close(bfltdata[0])
 
 		## TODO: check if -Tbinary is needed or not
        		p = subprocess.Popen(['strings', '-a', '-n', str(stringcutoff), bfltdata[1]], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
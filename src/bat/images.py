@@ -20,7 +20,7 @@ Parameters for configuration file:
 * BAT_IMAGEDIR :: location to where images should be written
 '''
 
-import os, os.path, sys, subprocess
+import os, os.path, sys, subprocess, mmap
 from PIL import Image
 
 def generateImages(filename, unpackreport, scantempdir, topleveldir, scanenv, cursor, conn, debug=False):
@@ -41,15 +41,12 @@ def generateImages(filename, unpackreport, scantempdir, topleveldir, scanenv, cu
 	filesize = os.stat("%s/%s" % (scantempdir, filename)).st_size
 	if filesize > maxsize:
 		return
+	## an empty file cannot be turned into a picture (or mapped)
+	if filesize == 0:
+		return
 	## this stuff is easily cached
 	if not os.path.exists("%s/%s.png" % (imagedir, unpackreport['checksum'])):
-		fwfile = open("%s/%s" % (scantempdir, filename))
-
-		## this is very inefficient for large files, but we *really* need all the data :-(
-		fwdata = fwfile.read()
-		fwfile.close()
-
-		fwlen = len(fwdata)
+		fwlen = filesize
 
 		if fwlen > 512:
 			height = 512
@@ -57,18 +54,34 @@ def generateImages(filename, unpackreport, scantempdir, topleveldir, scanenv, cu
 			height = fwlen
 		width = fwlen/height
 
+		fwmm = None
 		## we might need to add some bytes so we can create a valid picture
 		if fwlen%height > 0:
 			width = width + 1
-			for i in range(0, height - (fwlen%height)):
-				fwdata = fwdata + chr(0)
-
-		imgbuffer = buffer(bytearray(fwdata))
+			## allocate the padded buffer in one go (it is zero filled) and
+			## read the data straight into it, so it is only copied once
+			imgbuffer = bytearray(width*height)
+			fwfile = open("%s/%s" % (scantempdir, filename), 'rb')
+			fwfile.readinto(memoryview(imgbuffer)[:fwlen])
+			fwfile.close()
+		else:
+			## no padding needed, so the mapping can be handed to PIL
+			## as is and the data is never copied.
+			fwfd = os.open("%s/%s" % (scantempdir, filename), os.O_RDONLY)
+			fwmm = mmap.mmap(fwfd, 0, access=mmap.ACCESS_READ)
+			os.close(fwfd)
+			imgbuffer = fwmm
 
 		im = Image.frombuffer("L", (height, width), imgbuffer, "raw", "L", 0, 1)
-		im.save("%s/%s.png" % (imagedir, unpackreport['checksum']))
-		#'''
+		## binary data hardly compresses, so the default compression level
+		## mostly costs time. The images are only for informational purposes
+		## so use the fastest compression.
+		im.save("%s/%s.png" % (imagedir, unpackreport['checksum']), compress_level=1)
 		if width > 100:
-			imthumb = im.thumbnail((height/4, width/4))
-			im.save("%s/%s-thumbnail.png" % (imagedir, unpackreport['checksum']))
-		#'''
+			## resize into a new image instead of changing the original one
+			## in place with thumbnail()
+			imthumb = im.resize((height/4, width/4), Image.ANTIALIAS)
+			imthumb.save("%s/%s-thumbnail.png" % (imagedir, unpackreport['checksum']), compress_level=1)
+		## PIL might still use the mapping, so only close it at the very end
+		if fwmm != None:
+			fwmm.close()
@@ -79,7 +79,7 @@ def parseJava(filename, offset):
 	## parse the constant pool and split data accordingly
 	skip = False
 	brokenclass = False
-	for i in range(1, constant_pool_count):
+	for i in xrange(1, constant_pool_count):
 		if brokenclass:
 			classfile.close()
 			return
@@ -156,13 +156,13 @@ def parseJava(filename, offset):
 	classbytes = classfile.read(2)
 	interfaces_count = struct.unpack('>H', classbytes)[0]
 
-	for i in range(0, interfaces_count+1):
+	for i in xrange(0, interfaces_count+1):
 		classbytes = classfile.read(2)
 
 	fields_count = struct.unpack('>H', classbytes)[0]
 
 	fieldnames = []
-	for i in range(0, fields_count):
+	for i in xrange(0, fields_count):
 		## access flags
 		classbytes = classfile.read(2)
 		## name_index
@@ -182,7 +182,7 @@ def parseJava(filename, offset):
 		## attributes_count
 		classbytes = classfile.read(2)
 		attributes_count = struct.unpack('>H', classbytes)[0]
-		for a in range(0, attributes_count):
+		for a in xrange(0, attributes_count):
 			classbytes = classfile.read(2)
 			attribute_name_index = struct.unpack('>H', classbytes)[0]
 			classbytes = classfile.read(4)
@@ -193,7 +193,7 @@ def parseJava(filename, offset):
 	method_count = struct.unpack('>H', classbytes)[0]
 
 	methodnames = []
-	for i in range(0, method_count):
+	for i in xrange(0, method_count):
 		## access flags
 		classbytes = classfile.read(2)
 		## name_index
@@ -214,7 +214,7 @@ def parseJava(filename, offset):
 		## attributes_count
 		classbytes = classfile.read(2)
 		attributes_count = struct.unpack('>H', classbytes)[0]
-		for a in range(0, attributes_count):
+		for a in xrange(0, attributes_count):
 			classbytes = classfile.read(2)
 			attribute_name_index = struct.unpack('>H', classbytes)[0]
 			classbytes = classfile.read(4)
@@ -224,7 +224,7 @@ def parseJava(filename, offset):
 	sourcefile = None
 	classbytes = classfile.read(2)
 	attributes_count = struct.unpack('>H', classbytes)[0]
-	for a in range(0, attributes_count):
+	for a in xrange(0, attributes_count):
 		classbytes = classfile.read(2)
 		attribute_name_index = struct.unpack('>H', classbytes)[0]
 		classbytes = classfile.read(4)
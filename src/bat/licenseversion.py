@@ -125,6 +125,21 @@ reerrorlevel = re.compile("<[\d+cd]>")
 reparam = re.compile("([\w_]+)\.([\w_]+)")
 rematch = re.compile("\d+")
 
+## maximum amount of strings or checksums that are looked up in a single query
+querybatchsize = 500
+
+## maximum amount of lines (strings, function names, variable names) for
+## which the lookup results are kept in the cache. Some lines have hundreds
+## of results, so the cache is emptied when it grows beyond this.
+linecachesize = 50000
+
+## split items into batches that are looked up with a single query each, but
+## make sure that there are still enough batches to keep all processes busy
+def querybatches(items, processamount):
+	items = list(items)
+	batchsize = min(querybatchsize, max(1, len(items)/processamount))
+	return map(lambda x: items[x:x+batchsize], xrange(0, len(items), batchsize))
+
 ## The scanners that are used in BAT are Ninka and FOSSology. These scanners
 ## don't always agree on results, but when they do, it is very reliable.
 def squashlicenses(licenses):
@@ -149,7 +164,7 @@ def squashlicenses(licenses):
 					licenses = [(licenses[0][0], 'squashed')]
 	return licenses
 
-def aggregatejars(unpackreports, scantempdir, topleveldir, pool, scanenv, cleanclasses, scandebug=False, unpacktempdir=None):
+def aggregatejars(unpackreports, scantempdir, topleveldir, processors, scanenv, cleanclasses, scandebug=False, unpacktempdir=None):
 	## find all JAR files. Do this by:
 	## 1. checking the tags for 'zip'
 	## 2. verifying for unpacked files that there are .class files
@@ -209,7 +224,22 @@ def aggregatejars(unpackreports, scantempdir, topleveldir, pool, scanenv, cleanc
 
 	ranked = set()
 	if jartasks != []:
-		res = pool.map(aggregate, jartasks, 1)
+		if len(jartasks) == 1:
+			## starting a pool of processes for a single JAR file
+			## costs more than it saves, so aggregate it here
+			res = map(aggregate, jartasks)
+		else:
+			if processors == None:
+				processamount = multiprocessing.cpu_count()
+			else:
+				processamount = processors
+			pool = multiprocessing.Pool(processes=min(processamount, len(jartasks)))
+			## the order of the results does not matter, so use them as soon
+			## as they are ready, and hand out a few tasks at a time to the
+			## processes to cut down on the communication overhead.
+			chunksize = max(1, len(jartasks)/(4*processamount))
+			res = list(pool.imap_unordered(aggregate, jartasks, chunksize))
+			pool.terminate()
 		for i in res:
 			(jarfile, rankres) = i
 			if rankres:
@@ -441,46 +471,47 @@ def aggregate((jarfile, jarreport, unpackreports, topleveldir)):
 	leafreports['ranking'] = (rankres, dynamicresfinal, {'classes': classmatches, 'fields': fieldmatches, 'sources': sourcematches}, 'Java')
 
 	leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-	leafreports = cPickle.dump(leafreports, leaf_file)
+	cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 	leaf_file.close()
 	return (jarfile, aggregated)
 
 def prune(uniques, package):
 	if have_counter:
 		uniqueversions = collections.Counter()
+		linesperversion = collections.defaultdict(set)
 	else:
 		uniqueversions = {}
-
-	linesperversion = {}
+		linesperversion = {}
 
 	for u in uniques:
 		(line, res) = u
 		versions = set()
 		for r in res:
 			(checksum, linenumber, versionfilenames) = r
-			map(lambda x: versions.add(x[0]), versionfilenames)
-		for version in versions:
-			if version in linesperversion:
-				linesperversion[version].add(line)
-			else:
-				linesperversion[version] = set([line])
+			versions.update(map(lambda x: x[0], versionfilenames))
 		if have_counter:
+			for version in versions:
+				linesperversion[version].add(line)
 			uniqueversions.update(versions)
 		else:
 			for version in versions:
+				if version in linesperversion:
+					linesperversion[version].add(line)
+				else:
+					linesperversion[version] = set([line])
 				if version in uniqueversions:
 					uniqueversions[version] += 1
 				else:
 					uniqueversions[version] = 1
 				
 	## there is only one version, so no need to continue
-	if len(uniqueversions.keys()) == 1:
+	if len(uniqueversions) == 1:
 		return uniques
 
 	pruneme = set()
 
-	unique_sorted_rev = sorted(uniqueversions, key = lambda x: uniqueversions.__getitem__(x), reverse=True)
-	unique_sorted = sorted(uniqueversions, key = lambda x: uniqueversions.__getitem__(x))
+	unique_sorted_rev = sorted(uniqueversions, key = uniqueversions.__getitem__, reverse=True)
+	unique_sorted = sorted(uniqueversions, key = uniqueversions.__getitem__)
 
 	equivalents = set()
 	for l in unique_sorted_rev:
@@ -488,10 +519,13 @@ def prune(uniques, package):
 			continue
 		if l in equivalents:
 			continue
-		linesperversion_l = set(linesperversion[l])
+		## the values in linesperversion are already sets, so they can
+		## be compared directly without making copies first
+		linesperversion_l = linesperversion[l]
+		uniqueversions_l = uniqueversions[l]
 		pruneremove = set()
 		for k in unique_sorted:
-			if uniqueversions[k] == uniqueversions[l]:
+			if uniqueversions[k] == uniqueversions_l:
 				## Both versions have the same amount of identifiers, so
 				## could be the same. If so, add to 'equivalents'
 				## and skip all equivalents since the results would be the
@@ -500,17 +534,17 @@ def prune(uniques, package):
 				if linesperversion[k] == linesperversion_l:
 					equivalents.add(k)
 				continue
-			if uniqueversions[k] > uniqueversions[l]:
+			if uniqueversions[k] > uniqueversions_l:
 				break
-			if set(linesperversion[k]).issubset(linesperversion_l):
+			if linesperversion[k] <= linesperversion_l:
 				pruneme.add(k)
 				pruneremove.add(k)
 		## make the inner loop a bit shorter
-		for k in pruneremove:
-			unique_sorted.remove(k)
+		if pruneremove != set():
+			unique_sorted = filter(lambda x: x not in pruneremove, unique_sorted)
 
 	## TODO: pruneme might have length 0, so uniques can be returned. Verify this.
-	notpruned = set(uniqueversions.keys()).difference(pruneme)
+	notpruned = set(uniqueversions).difference(pruneme)
 	newuniques = []
 	for u in uniques:
 		(line, res) = u
@@ -680,9 +714,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 		if scanenv.get('AGGREGATE_CLEAN', 0) == '1':
 			cleanclasses = True
 
-		pool = multiprocessing.Pool(processes=processors)
-		rankedjars = aggregatejars(unpackreports, scantempdir, topleveldir, pool, scanenv, cleanclasses, scandebug=False, unpacktempdir=None)
-		pool.terminate()
+		rankedjars = aggregatejars(unpackreports, scantempdir, topleveldir, processors, scanenv, cleanclasses, scandebug=False, unpacktempdir=None)
 		for r in rankedjars:
 			## results are now aggregated, so add the JAR file to
 			## the list of rankingfiles for Java
@@ -769,13 +801,33 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 
 	scanmanager = multiprocessing.Manager()
 
-	sha256_filename_query = "select version, pathname from processed_file where checksum=%s"
-	sha256_license_query = "select distinct license, scanner from licenses where checksum=%s"
-	sha256_copyright_query = "select distinct copyright, type from extracted_copyright where checksum=%s"
+	## Start the processes that do the database lookups. These are started
+	## once and reused for every lookup for every file, instead of starting
+	## (and killing) a new set of processes for every lookup.
+	## The processes are daemonic, so they are killed when the scan exits,
+	## also when an error occurs (or the scan is interrupted) before they
+	## are terminated at the end of this method.
+	scanqueue = multiprocessing.JoinableQueue(maxsize=0)
+	reportqueue = scanmanager.Queue(maxsize=0)
+	processpool = []
+	for i in range(0,processamount):
+		p = multiprocessing.Process(target=grab_sha256, args=(scanqueue,reportqueue,batcursors[i], batcons[i]))
+		p.daemon = True
+		processpool.append(p)
+		p.start()
+
+	## the queries are done for a batch of checksums at once
+	sha256_filename_query = "select checksum, version, pathname from processed_file where checksum in (%s)"
+	sha256_license_query = "select distinct checksum, license, scanner from licenses where checksum in (%s)"
+	sha256_copyright_query = "select distinct checksum, copyright, type from extracted_copyright where checksum in (%s)"
 
 	for language in rankingfilesperlanguage:
 		## keep a list of versions per sha256, since source files often are in more than one version
 		sha256_versions = {}
+		## keep the checksums and line numbers per string, function name and
+		## variable name, since many files contain the same strings or names.
+		## The cache is emptied when it holds more than linecachesize lines.
+		linecache = {}
 		for rankingfile in rankingfilesperlanguage[language]:
 			unpackreport = unpackreports[rankingfile]
 			## read the pickle
@@ -818,35 +870,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 					## first grab all possible checksums, plus associated line numbers
 					## for this string. Since these are unique strings they will only be
 					## present in the package (or clones of the package).
-					processpool = []
-					vsha256s = []
-
-					scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-					reportqueue = scanmanager.Queue(maxsize=0)
-
-					map(lambda x: scanqueue.put(x), uniques)
-
-					minprocessamount = min(len(uniques), processamount)
-
-					for i in range(0,minprocessamount):
-						p = multiprocessing.Process(target=grab_sha256_parallel, args=(scanqueue,reportqueue,batcursors[i], batcons[i], language, 'string'))
-						processpool.append(p)
-						p.start()
-
-					scanqueue.join()
-
-					while True:
-						try:
-							val = reportqueue.get_nowait()
-							vsha256s.append(val)
-							reportqueue.task_done()
-						except Queue.Empty, e:
-							## Queue is empty
-							break
-					reportqueue.join()
-
-					for p in processpool:
-						p.terminate()
+					vsha256s = cachedqueries(scanqueue, reportqueue, 'string', language, uniques, processamount, linecache)
 
 					## for each combination (line,sha256,linenumber) store per checksum
 					## the line and linenumber(s). The checksums are used to look up version
@@ -871,35 +895,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 										tmplines[line] = []
 								tmplines[line].append((checksum, linenumber, sha256_versions[checksum]))
 
-					processpool = []
-					fileres = []
-
-					scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-					reportqueue = scanmanager.Queue(maxsize=0)
-
-					map(lambda x: scanqueue.put(x), sha256_scan_versions.keys())
-
-					minprocessamount = min(len(sha256_scan_versions.keys()), processamount)
-
-					for i in range(0,minprocessamount):
-						p = multiprocessing.Process(target=grab_sha256_filename, args=(scanqueue,reportqueue,batcursors[i], batcons[i], sha256_filename_query))
-						processpool.append(p)
-						p.start()
-
-					scanqueue.join()
-
-					while True:
-						try:
-							val = reportqueue.get_nowait()
-							fileres.append(val)
-							reportqueue.task_done()
-						except Queue.Empty, e:
-							## Queue is empty
-							break
-					reportqueue.join()
-
-					for p in processpool:
-						p.terminate()
+					fileres = runqueries(scanqueue, reportqueue, 'filename', language, sha256_filename_query, sha256_scan_versions.keys(), processamount)
 
 					resdict = {}
 					map(lambda x: resdict.update(x), fileres)
@@ -959,33 +955,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 					if determinelicense:
 						if len(licensesha256s) != 0:
 							licensesha256s = set(licensesha256s)
-							processpool = []
-
-							scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-							reportqueue = scanmanager.Queue(maxsize=0)
-
-							map(lambda x: scanqueue.put(x), licensesha256s)
-							minprocessamount = min(len(licensesha256s), processamount)
-
-							for i in range(0,minprocessamount):
-								p = multiprocessing.Process(target=grab_sha256_license, args=(scanqueue,reportqueue,batcursors[i], batcons[i], sha256_license_query))
-								processpool.append(p)
-								p.start()
-
-							scanqueue.join()
-
-							while True:
-								try:
-									val = reportqueue.get_nowait()
-									packagelicenses.append(val)
-									reportqueue.task_done()
-								except Queue.Empty, e:
-									## Queue is empty
-									break
-							reportqueue.join()
-
-							for p in processpool:
-								p.terminate()
+							packagelicenses = runqueries(scanqueue, reportqueue, 'license', language, sha256_license_query, licensesha256s, processamount)
 
 							packagelicenses_tmp = []
 							for p in packagelicenses:
@@ -994,33 +964,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 
 					if determinecopyright:
 						if len(copyrightsha256s) != 0:
-							processpool = []
-
-							scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-							reportqueue = scanmanager.Queue(maxsize=0)
-
-							map(lambda x: scanqueue.put(x), copyrightsha256s)
-							minprocessamount = min(len(copyrightsha256s), processamount)
-
-							for i in range(0,minprocessamount):
-								p = multiprocessing.Process(target=grab_sha256_copyright, args=(scanqueue,reportqueue,batcursors[i], batcons[i], sha256_copyright_query))
-								processpool.append(p)
-								p.start()
-
-							scanqueue.join()
-
-							while True:
-								try:
-									val = reportqueue.get_nowait()
-									packagecopyrights.append(val)
-									reportqueue.task_done()
-								except Queue.Empty, e:
-									## Queue is empty
-									break
-							reportqueue.join()
-
-							for p in processpool:
-								p.terminate()
+							packagecopyrights = runqueries(scanqueue, reportqueue, 'copyright', language, sha256_copyright_query, set(copyrightsha256s), processamount)
 
 							## result is a list of {sha256sum: list of copyright statements}
 							packagecopyrights_tmp = []
@@ -1042,34 +986,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 					functionnames = functionRes['uniquepackages'][package]
 
 					## right now only C is supported. TODO: fix this for other languages such as Java.
-					processpool = []
-					vsha256s = []
-
-					scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-					reportqueue = scanmanager.Queue(maxsize=0)
-
-					map(lambda x: scanqueue.put(x), functionnames)
-					minprocessamount = min(len(functionnames), processamount)
-
-					for i in range(0,minprocessamount):
-						p = multiprocessing.Process(target=grab_sha256_parallel, args=(scanqueue,reportqueue,batcursors[i], batcons[i], 'C', 'function'))
-						processpool.append(p)
-						p.start()
-
-					scanqueue.join()
-
-					while True:
-						try:
-							val = reportqueue.get_nowait()
-							vsha256s.append(val)
-							reportqueue.task_done()
-						except Queue.Empty, e:
-							## Queue is empty
-							break
-					reportqueue.join()
-
-					for p in processpool:
-						p.terminate()
+					vsha256s = cachedqueries(scanqueue, reportqueue, 'function', 'C', functionnames, processamount, linecache)
 
 					sha256_scan_versions = {}
 					tmplines = {}
@@ -1091,33 +1008,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 								tmplines[functionname].append((checksum, linenumber, sha256_versions[checksum]))
 					fileres = []
 					if len(sha256_scan_versions.keys()) != 0:
-						processpool = []
-
-						scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-						reportqueue = scanmanager.Queue(maxsize=0)
-
-						map(lambda x: scanqueue.put(x), sha256_scan_versions.keys())
-						minprocessamount = min(len(sha256_scan_versions.keys()), processamount)
-
-						for i in range(0,minprocessamount):
-							p = multiprocessing.Process(target=grab_sha256_filename, args=(scanqueue,reportqueue,batcursors[i], batcons[i], sha256_filename_query))
-							processpool.append(p)
-							p.start()
-
-						scanqueue.join()
-
-						while True:
-							try:
-								val = reportqueue.get_nowait()
-								fileres.append(val)
-								reportqueue.task_done()
-							except Queue.Empty, e:
-								## Queue is empty
-								break
-						reportqueue.join()
-
-						for p in processpool:
-							p.terminate()
+						fileres = runqueries(scanqueue, reportqueue, 'filename', language, sha256_filename_query, sha256_scan_versions.keys(), processamount)
 
 					resdict = {}
 					map(lambda x: resdict.update(x), fileres)
@@ -1185,37 +1076,10 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 									vartype = 'kernelvariable'
 							uniques = variablepvs['uniquepackages'][package]
 
-							processpool = []
-							vsha256s = []
-
-							scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-							reportqueue = scanmanager.Queue(maxsize=0)
-
-							map(lambda x: scanqueue.put(x), uniques)
-							minprocessamount = min(len(uniques), processamount)
-
-							for i in range(0,minprocessamount):
-								p = multiprocessing.Process(target=grab_sha256_parallel, args=(scanqueue,reportqueue,batcursors[i], batcons[i], language, vartype))
-								processpool.append(p)
-								p.start()
-
-							scanqueue.join()
+							vsha256s = cachedqueries(scanqueue, reportqueue, vartype, language, uniques, processamount, linecache)
 
-							while True:
-								try:
-									val = reportqueue.get_nowait()
-									vsha256s.append(val)
-									reportqueue.task_done()
-								except Queue.Empty, e:
-									## Queue is empty
-									break
-							reportqueue.join()
-
-							for p in processpool:
-								p.terminate()
-
-                        					sha256_scan_versions = {}
-                        					tmplines = {}
+							sha256_scan_versions = {}
+							tmplines = {}
 
 							for p in vsha256s:
 								(variablename, varres) = p
@@ -1235,34 +1099,7 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 
 							resdict = {}
 							if len(sha256_scan_versions.keys()) != 0:
-								processpool = []
-								fileres = []
-
-								scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-								reportqueue = scanmanager.Queue(maxsize=0)
-
-								map(lambda x: scanqueue.put(x), sha256_scan_versions.keys())
-								minprocessamount = min(len(sha256_scan_versions.keys()), processamount)
-
-								for i in range(0,minprocessamount):
-									p = multiprocessing.Process(target=grab_sha256_filename, args=(scanqueue,reportqueue,batcursors[i], batcons[i], sha256_filename_query))
-									processpool.append(p)
-									p.start()
-
-								scanqueue.join()
-
-								while True:
-									try:
-										val = reportqueue.get_nowait()
-										fileres.append(val)
-										reportqueue.task_done()
-									except Queue.Empty, e:
-										## Queue is empty
-										break
-								reportqueue.join()
-
-								for p in processpool:
-									p.terminate()
+								fileres = runqueries(scanqueue, reportqueue, 'filename', language, sha256_filename_query, sha256_scan_versions.keys(), processamount)
 
 								map(lambda x: resdict.update(x), fileres)
 
@@ -1320,10 +1157,72 @@ def determinelicense_version_copyright(unpackreports, scantempdir, topleveldir,
 				leafreports['ranking'] = (res, functionRes, variablepvs, language)
 				leafreports['tags'] = list(set(leafreports['tags'] + ['ranking']))
 				leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-				leafreports = cPickle.dump(leafreports, leaf_file)
+				cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 				leaf_file.close()
 				unpackreport['tags'].append('ranking')
 
+	for p in processpool:
+		p.terminate()
+	for p in processpool:
+		p.join()
+
+## look up items with the processes started in determinelicense_version_copyright()
+## and return the results. The items are split into batches first.
+def runqueries(scanqueue, reportqueue, querytype, language, query, items, processamount):
+	batches = querybatches(items, processamount)
+	map(lambda x: scanqueue.put((querytype, language, query, x)), batches)
+
+	scanqueue.join()
+
+	results = []
+	while True:
+		try:
+			val = reportqueue.get_nowait()
+			results.append(val)
+			reportqueue.task_done()
+		except Queue.Empty, e:
+			## Queue is empty
+			break
+	reportqueue.join()
+	return results
+
+## look up checksums and line numbers for lines (strings, function names,
+## variable names), but only for the lines that are not in linecache yet.
+## Results are returned as (line, results) for every item. The cache is
+## cleared before adding new results would make it larger than linecachesize.
+def cachedqueries(scanqueue, reportqueue, querytype, language, items, processamount, linecache):
+	lookups = set(filter(lambda x: not (querytype, x) in linecache, items))
+	lookupresults = {}
+	if lookups != set():
+		for (line, res) in runqueries(scanqueue, reportqueue, querytype, language, None, lookups, processamount):
+			lookupresults[line] = res
+	results = []
+	for i in items:
+		if i in lookupresults:
+			results.append((i, lookupresults[i]))
+		else:
+			results.append((i, linecache[(querytype, i)]))
+	if len(linecache) + len(lookupresults) > linecachesize:
+		linecache.clear()
+	for line in lookupresults:
+		linecache[(querytype, line)] = lookupresults[line]
+	return results
+
+## continuously grab lookup tasks from the queue and put the results in the
+## report queue. A task is a batch of items plus the type of lookup.
+def grab_sha256(scanqueue, reportqueue, cursor, conn):
+	while True:
+		(querytype, language, query, items) = scanqueue.get(timeout=2592000)
+		if querytype == 'filename':
+			reportqueue.put(grab_sha256_filename(items, cursor, conn, query))
+		elif querytype == 'license':
+			reportqueue.put(grab_sha256_license(items, cursor, conn, query))
+		elif querytype == 'copyright':
+			reportqueue.put(grab_sha256_copyright(items, cursor, conn, query))
+		else:
+			map(lambda x: reportqueue.put(x), grab_sha256_parallel(items, cursor, conn, language, querytype))
+		scanqueue.task_done()
+
 ## grab variable names.
 def grab_sha256_varname(scanqueue, reportqueue, cursor, conn, query):
 	while True:
@@ -1334,66 +1233,66 @@ def grab_sha256_varname(scanqueue, reportqueue, cursor, conn, query):
 		reportqueue.put({sha256sum: results})
 		scanqueue.task_done()
 
-def grab_sha256_filename(scanqueue, reportqueue, cursor, conn, query):
-	while True:
-		sha256sum = scanqueue.get(timeout=2592000)
-		cursor.execute(query, (sha256sum,))
-		results = cursor.fetchall()
-		conn.commit()
-		reportqueue.put({sha256sum: results})
-		scanqueue.task_done()
+## All checksums in a batch are looked up with a single query and the results
+## are returned per checksum. The first column of the query should be the checksum.
+def grab_sha256_filename(sha256sums, cursor, conn, query):
+	cursor.execute(query % ", ".join(["%s"] * len(sha256sums)), sha256sums)
+	results = dict(map(lambda x: (x, []), sha256sums))
+	for r in cursor.fetchall():
+		results[r[0]].append(r[1:])
+	conn.commit()
+	return results
 
 ## grab copyright statements from the license database
-def grab_sha256_copyright(scanqueue, reportqueue, cursor, conn, query):
-	while True:
-		sha256sum = scanqueue.get(timeout=2592000)
-		cursor.execute(query, (sha256sum,))
-		results = cursor.fetchall()
-		conn.commit()
+def grab_sha256_copyright(sha256sums, cursor, conn, query):
+	cursor.execute(query % ", ".join(["%s"] * len(sha256sums)), sha256sums)
+	results = dict(map(lambda x: (x, []), sha256sums))
+	for r in cursor.fetchall():
 		## 'statements' are not very accurate so ignore those
-		results = filter(lambda x: x[1] != 'statement', results)
-		reportqueue.put({sha256sum: results})
-		scanqueue.task_done()
+		if r[2] != 'statement':
+			results[r[0]].append(r[1:])
+	conn.commit()
+	return results
 
 ## grab licenses from the license database
-def grab_sha256_license(scanqueue, reportqueue, cursor, conn, query):
-	while True:
-		sha256sum = scanqueue.get(timeout=2592000)
-		cursor.execute(query, (sha256sum,))
-		results = cursor.fetchall()
-		conn.commit()
-		reportqueue.put({sha256sum: results})
-		scanqueue.task_done()
-
-def grab_sha256_parallel(scanqueue, reportqueue, cursor, conn, language, querytype):
-	stringquery = "select distinct checksum, linenumber, language from extracted_string where stringidentifier=%s and language=%s"
-	functionquery = "select distinct checksum, linenumber, language from extracted_function where functionname=%s"
-	variablequery = "select distinct checksum, linenumber, language, type from extracted_name where name=%s"
-	kernelvarquery = "select distinct checksum, linenumber, language, type from extracted_name where name=%s"
-	while True:
-		res = None
-		line = scanqueue.get(timeout=2592000)
-		if querytype == "string":
-			cursor.execute(stringquery, (line,language))
-			res = cursor.fetchall()
-		elif querytype == 'function':
-			cursor.execute(functionquery, (line,))
-			res = cursor.fetchall()
-		elif querytype == 'variable':
-			cursor.execute(variablequery, (line,))
-			res = cursor.fetchall()
-			res = filter(lambda x: x[3] == 'variable', res)
-		elif querytype == 'kernelvariable':
-			cursor.execute(kernelvarquery, (line,))
-			res = cursor.fetchall()
-			res = filter(lambda x: x[3] == 'kernelsymbol', res)
-		conn.commit()
-		if res != None:
-			res = filter(lambda x: x[2] == language, res)
-			## TODO: make a list of line numbers
-			res = map(lambda x: (x[0], x[1]), res)
-			reportqueue.put((line, res))
-		scanqueue.task_done()
+def grab_sha256_license(sha256sums, cursor, conn, query):
+	cursor.execute(query % ", ".join(["%s"] * len(sha256sums)), sha256sums)
+	results = dict(map(lambda x: (x, []), sha256sums))
+	for r in cursor.fetchall():
+		results[r[0]].append(r[1:])
+	conn.commit()
+	return results
+
+## A batch of lines (strings, function names, variable names) is looked up with
+## a single query. Results are returned per line.
+def grab_sha256_parallel(lines, cursor, conn, language, querytype):
+	## filtering on language and type is done by the database, so only the
+	## rows that are actually needed are sent back
+	stringquery = "select distinct stringidentifier, checksum, linenumber from extracted_string where stringidentifier in (%s) and language=%%s"
+	functionquery = "select distinct functionname, checksum, linenumber from extracted_function where functionname in (%s) and language=%%s"
+	variablequery = "select distinct name, checksum, linenumber from extracted_name where name in (%s) and language=%%s and type='variable'"
+	kernelvarquery = "select distinct name, checksum, linenumber from extracted_name where name in (%s) and language=%%s and type='kernelsymbol'"
+	if querytype == "string":
+		query = stringquery
+	elif querytype == 'function':
+		query = functionquery
+	elif querytype == 'variable':
+		query = variablequery
+	elif querytype == 'kernelvariable':
+		query = kernelvarquery
+	else:
+		return []
+	cursor.execute(query % ", ".join(["%s"] * len(lines)), lines + [language])
+	res = cursor.fetchall()
+	conn.commit()
+	lineres = {}
+	for r in res:
+		## TODO: make a list of line numbers
+		if r[0] in lineres:
+			lineres[r[0]].append((r[1], r[2]))
+		else:
+			lineres[r[0]] = [(r[1], r[2])]
+	return map(lambda x: (x, lineres.get(x, [])), lines)
 
 def extractJava(javameta, scanenv, funccursor, funcconn, clones):
 	dynamicRes = {}  # {'namesmatched': 0, 'totalnames': int, 'uniquematches': int, 'packages': {} }
@@ -2518,7 +2417,7 @@ def lookup_identifier(scanqueue, reportqueue, cursor, conn, scanenv, topleveldir
 		leafreports['ranking'] = (res, functionRes, variablepvs, language)
 		leafreports['tags'].append('ranking')
 		leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-		leafreports = cPickle.dump(leafreports, leaf_file)
+		cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 		leaf_file.close()
 		reportqueue.put(filehash)
 		scanqueue.task_done()
@@ -11,16 +11,12 @@ of the ranking scan, like piecharts and version charts.
 It is used by generateimages.py
 '''
 
-import os, os.path, sys, cPickle
+import os, os.path, sys
 import matplotlib
 matplotlib.use('cairo')
 import pylab
 
-def generateImages(picklefile, pickledir, filehash, imagedir, pietype):
-
-	leaf_file = open(os.path.join(pickledir, picklefile), 'rb')
-	(piedata, pielabels) = cPickle.load(leaf_file)
-	leaf_file.close()
+def generateImages(piedata, pielabels, filehash, imagedir, pietype):
 
 	pylab.figure(1, figsize=(6.5,6.5))
 	ax = pylab.axes([0.2, 0.15, 0.6, 0.6])
@@ -29,4 +25,3 @@ def generateImages(picklefile, pickledir, filehash, imagedir, pietype):
 
 	pylab.savefig(os.path.join(imagedir, '%s-%s.png' % (filehash, pietype)))
 	pylab.gcf().clear()
-	os.unlink(os.path.join(pickledir, picklefile))
@@ -24,21 +24,81 @@ spent, plus there might be false positives (mostly LZMA).
 '''
 
 import sys, os, subprocess, os.path, shutil, stat, struct, zlib, binascii
-import tempfile, re, magic, hashlib, HTMLParser, math
+import tempfile, re, magic, hashlib, HTMLParser, math, mmap
 import fsmagic, extractor, javacheck, elfcheck
 
+## pyahocorasick is optional. If it is available all markers are searched
+## in a single pass over the data, instead of one pass per marker.
+try:
+	import ahocorasick
+	ahocorasickscan = True
+except Exception, e:
+	ahocorasickscan = False
+
+## the automaton is built only once for all markers in fsmagic. Each marker
+## maps to its length and the list of keys that use it.
+if ahocorasickscan:
+	markerautomaton = ahocorasick.Automaton()
+	markerkeys = {}
+	for key in fsmagic.fsmagic:
+		if fsmagic.fsmagic[key] in markerkeys:
+			markerkeys[fsmagic.fsmagic[key]].append(key)
+		else:
+			markerkeys[fsmagic.fsmagic[key]] = [key]
+	for marker in markerkeys:
+		markerautomaton.add_word(marker, (len(marker), markerkeys[marker]))
+	markerautomaton.make_automaton()
+
+## lxml is optional. It uses libxml2, just like xmllint, so it can be used
+## to check XML files without launching xmllint for every file.
+try:
+	import lxml.etree
+	lxmlscan = True
+except Exception, e:
+	lxmlscan = False
+
+## parser with the same settings as 'xmllint --noout --nonet': no network
+## access, no external DTDs and no entity substitution
+if lxmlscan:
+	xmlparser = lxml.etree.XMLParser(no_network=True, load_dtd=False, resolve_entities=False)
+
+## markers that are so generic that a few extra bytes are checked
+checkedmarkers = set(['jpeg', 'compress', 'ttf'])
+
+## hardcode a few checks to avoid possibly passing around many offsets to
+## many methods
+def checkMarker(key, datamm, markeroffset):
+	if key == 'jpeg':
+		checkkey = datamm[markeroffset+2:markeroffset+3]
+		if len(checkkey) == 1:
+			if checkkey == '\xff':
+				return True
+	elif key == 'compress':
+		compressdata = datamm[markeroffset+2:markeroffset+3]
+		if len(compressdata) == 1:
+			compressbits = ord(compressdata) & 0x1f
+			if compressbits >= 9 and compressbits <= 16:
+				return True
+	elif key == 'ttf':
+		fontdata = datamm[markeroffset+4:markeroffset+8]
+		fontbytes = fontdata[:2]
+		if len(fontbytes) == 2:
+			numberoftables = struct.unpack('>H', fontbytes)[0]
+			if numberoftables != 0:
+				## followed by searchrange
+				fontbytes = fontdata[2:4]
+				if len(fontbytes) == 2:
+					searchrange = struct.unpack('>H', fontbytes)[0]
+					## sanity check, see specification
+					if pow(2, int(math.log(numberoftables, 2)+4)) == searchrange:
+						return True
+	return False
+
 ## method to search for all the markers in magicscans
 ## Although it is in this method it is actually not a pre-run scan, so perhaps
 ## it should be moved to bruteforcescan.py instead.
 def genericMarkerSearch(filename, magicscans, optmagicscans, offset=0, length=0, debug=False):
-	datafile = open(filename, 'rb')
-	databuffer = []
 	offsets = {}
-	datafile.seek(offset)
-	if length == 0:
-		databuffer = datafile.read(2000000)
-	else:
-		databuffer = datafile.read(length)
 	marker_keys = magicscans + optmagicscans
 	bufkeys = []
 	for key in marker_keys:
@@ -48,75 +108,67 @@ def genericMarkerSearch(filename, magicscans, optmagicscans, offset=0, length=0,
 		if not key in fsmagic.fsmagic:
 			continue
 		bufkeys.append((key,fsmagic.fsmagic[key]))
-	datafile2 = open(filename, 'rb')
+
+	## map the file instead of reading it with two file objects (one for
+	## the blocks, one for the extra checks). Empty files cannot be mapped,
+	## but slicing an empty string gives the same results.
+	datafd = os.open(filename, os.O_RDONLY)
+	filesize = os.fstat(datafd).st_size
+	if filesize == 0:
+		datamm = ''
+	else:
+		datamm = mmap.mmap(datafd, 0, access=mmap.ACCESS_READ)
+	os.close(datafd)
+
+	## The markers are searched in slices of the mapping: str.find() is
+	## a lot faster than mmap.find() so searching the mapping directly is
+	## slower, even though no overlap between blocks would be needed. The
+	## slices also keep memory usage bounded for big files and copying them
+	## costs very little compared to searching them.
+	if length == 0:
+		databuffer = datamm[offset:offset+2000000]
+	else:
+		databuffer = datamm[offset:offset+length]
 	while databuffer != '':
-		for bkey in bufkeys:
-			(key, bufkey) = bkey
-			if not bufkey in databuffer:
-				continue
-			res = databuffer.find(bufkey)
-			while res != -1:
-				## hardcode a few checks to avoid possibly passing
-				## around many offsets to many methods
-				if key == 'jpeg':
-					datafile2.seek(offset+res+2)
-					checkkey = datafile2.read(1)
-					if len(checkkey) == 1:
-						if checkkey == '\xff':
-							offsets[key].add(offset + res)
-				elif key == 'compress':
-					datafile2.seek(offset+res+2)
-					compressdata = datafile2.read(1)
-					if len(compressdata) == 1:
-						compressbits = ord(compressdata) & 0x1f
-						if compressbits >= 9 and compressbits <= 16:
-							offsets[key].add(offset + res)
-				elif key == 'ttf':
-					datafile2.seek(offset+res+4)
-					fontbytes = datafile2.read(2)
-					if len(fontbytes) == 2:
-						numberoftables = struct.unpack('>H', fontbytes)[0]
-						if numberoftables != 0:
-							## followed by searchrange
-							fontbytes = datafile2.read(2)
-							if len(fontbytes) == 2:
-								searchrange = struct.unpack('>H', fontbytes)[0]
-								## sanity check, see specification
-								if pow(2, int(math.log(numberoftables, 2)+4)) == searchrange:
-									offsets[key].add(offset + res)
-				else:
-					offsets[key].add(offset + res)
-				res = databuffer.find(bufkey, res+1)
+		if ahocorasickscan:
+			## search all markers at once. The automaton knows about all
+			## markers, so only keep the ones that were asked for.
+			for (endoffset, (markerlen, keys)) in markerautomaton.iter(databuffer):
+				res = endoffset - markerlen + 1
+				for key in keys:
+					if not key in offsets:
+						continue
+					if not key in checkedmarkers or checkMarker(key, datamm, offset + res):
+						offsets[key].add(offset + res)
+		else:
+			for bkey in bufkeys:
+				(key, bufkey) = bkey
+				## no need to first check if bufkey is in databuffer: find()
+				## is just as fast if it is not, and does not search twice if it is
+				res = databuffer.find(bufkey)
+				while res != -1:
+					if not key in checkedmarkers or checkMarker(key, datamm, offset + res):
+						offsets[key].add(offset + res)
+					res = databuffer.find(bufkey, res+1)
 		if length != 0:
 			break
-		## move the offset 1999950
-		datafile.seek(offset + 1999950)
-		## read 2000000 bytes with a 50 bytes overlap with the previous
-		## read so we don't miss any pattern. This needs to be updated
-		## as soon as patterns >= 50 are used.
-		databuffer = datafile.read(2000000)
+		## move the offset 1999950 and take 2000000 bytes with a 50 bytes
+		## overlap with the previous block so we don't miss any pattern.
+		## This needs to be updated as soon as patterns >= 50 are used.
+		databuffer = datamm[offset+1999950:offset+1999950+2000000]
 		if len(databuffer) >= 50:
 			offset = offset + 1999950
 		else:
 			offset = offset + len(databuffer)
-	datafile2.close()
-	datafile.close()
-
-	## mapping of offset to keys
-	offsettokeys = {}
+	if filesize != 0:
+		datamm.close()
 
 	for key in marker_keys:
-		offsets[key] = list(offsets[key])
 		## offsets are expected to be sorted.
-		offsets[key].sort()
-		for offset in offsets[key]:
-			if offset in offsettokeys:
-				offsettokeys[offset].append(key)
-			else:
-				offsettokeys[offset] = [key]
+		offsets[key] = sorted(offsets[key])
 	return offsets
 
-## Verify a file is an XML file using xmllint.
+## Verify a file is an XML file using lxml if available, otherwise xmllint.
 ## Actually this *could* be done with xml.dom.minidom (although some parser settings should be set
 ## to deal with unresolved entities) to avoid launching another process
 def searchXML(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=False, unpacktempdir=None):
@@ -125,17 +177,24 @@ def searchXML(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fal
 
 	## first check if the file starts with a byte order mark for a UTF-8 file
 	## https://en.wikipedia.org/wiki/Byte_order_mark
-	offset = 0
-	bommarks = datafile.read(3)
-	if bommarks == '\xef\xbb\xbf':
-		offset = 3
-	datafile.seek(offset)
-	firstchar = datafile.read(1)
+	## Read the first character after the byte order mark in the same read.
+	databuffer = datafile.read(4)
 	datafile.close()
+	if databuffer[:3] == '\xef\xbb\xbf':
+		firstchar = databuffer[3:4]
+	else:
+		firstchar = databuffer[:1]
 	## xmllint expects a file to start either with whitespace,
 	## or a < character.
 	if firstchar not in ['\n', '\r', '\t', ' ', '\v', '<']:
 		return newtags
+	if lxmlscan:
+		try:
+			lxml.etree.parse(filename, xmlparser)
+			newtags.append("xml")
+		except Exception, e:
+			pass
+		return newtags
 	p = subprocess.Popen(['xmllint','--noout', "--nonet", filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
 	if p.returncode == 0:
@@ -152,46 +211,54 @@ def searchXML(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fal
 ## * http://fedoraproject.org/wiki/Features/PythonEncodingUsesSystemLocale
 def verifyText(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=False, unpacktempdir=None):
 	newtags = []
-	datafile = open(filename, 'rb')
-	databuffer = []
-	offset = 0
-	datafile.seek(offset)
-	databuffer = datafile.read(100000)
-	while databuffer != '':
-		if not extractor.isPrintables(databuffer):
-			datafile.close()
+	datafd = os.open(filename, os.O_RDONLY)
+	filesize = os.fstat(datafd).st_size
+	## an empty file cannot be mapped, but there is nothing to check either
+	if filesize == 0:
+		os.close(datafd)
+		newtags.append("text")
+		newtags.append("ascii")
+		return newtags
+	datamm = mmap.mmap(datafd, 0, access=mmap.ACCESS_READ)
+	os.close(datafd)
+	## check the file in blocks of 100000 bytes, so it is not needed
+	## to check the whole file if there is a non-printable character early on.
+	## Bigger blocks are not faster: the copies no longer fit in the CPU cache.
+	for offset in xrange(0, filesize, 100000):
+		if not extractor.isPrintables(datamm[offset:offset+100000]):
+			datamm.close()
 			newtags.append("binary")
 			return newtags
-		## move the offset 100000
-		datafile.seek(offset + 100000)
-		databuffer = datafile.read(100000)
-		offset = offset + len(databuffer)
 	newtags.append("text")
 	newtags.append("ascii")
-	datafile.close()
+	datamm.close()
 	return newtags
 
+## WAV chunks observed in the wild. 'LGWV' and 'bext' seem to be extensions.
+## Sets are used, as every chunk header in a file is looked up.
+wavchunks = set(['fmt ', 'fact', 'data', 'cue ', 'list', 'plst', 'labl', 'ltxt', 'note', 'smpl', 'inst', 'bext', 'LGWV'])
+
 ## verify WAV files
 ## http://www-mmsp.ece.mcgill.ca/Documents/AudioFormats/WAVE/WAVE.html
 ## https://sites.google.com/site/musicgapi/technical-documents/wav-file-format
 def verifyWav(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=False, unpacktempdir=None):
-	## some chunks observed in the wild. 'LGWV' and 'bext' seem to be extensions
-	validchunks = ['fmt ', 'fact', 'data', 'cue ', 'list', 'plst', 'labl', 'ltxt', 'note', 'smpl', 'inst', 'bext', 'LGWV']
 	## the next four characters should be 'WAVE'
 	fourcc = 'WAVE'
-	newtags = verifyRiff(filename, validchunks, fourcc, tempdir, tags, offsets, scanenv, debug, unpacktempdir)
+	newtags = verifyRiff(filename, wavchunks, fourcc, tempdir, tags, offsets, scanenv, debug, unpacktempdir)
 	if newtags != []:
 		newtags.append('wav')
 		newtags.append('audio')
 	return newtags
 
+## valid WebP chunks
+webpchunks = set(['VP8 ', 'VP8L', 'VP8X', 'ANIM', 'ANMF', 'ALPH', 'ICCP', 'EXIF', 'XMP '])
+
 ## verify WebP files
 ## https://developers.google.com/speed/webp/docs/riff_container
 def verifyWebP(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=False, unpacktempdir=None):
-	validchunks = ['VP8 ', 'VP8L', 'VP8X', 'ANIM', 'ANMF', 'ALPH', 'ICCP', 'EXIF', 'XMP ']
 	## the next four characters should be 'WEBP'
 	fourcc = 'WEBP'
-	newtags = verifyRiff(filename, validchunks, fourcc, tempdir, tags, offsets, scanenv, debug, unpacktempdir)
+	newtags = verifyRiff(filename, webpchunks, fourcc, tempdir, tags, offsets, scanenv, debug, unpacktempdir)
 	if newtags != []:
 		newtags.append('webp')
 		newtags.append('graphics')
@@ -204,7 +271,7 @@ def verifyRiff(filename, validchunks, fourcc, tempdir=None, tags=[], offsets={},
 		return newtags
 	if not 'riff' in offsets:
 		return newtags
-	if not 0 in offsets['riff']:
+	if offsets['riff'] == [] or offsets['riff'][0] != 0:
 		return newtags
 	filesize = os.stat(filename).st_size
 
@@ -302,6 +369,9 @@ def verifyAndroidResource(filename, tempdir=None, tags=[], offsets={}, scanenv={
 		return newtags
 	return newtags
 
+## Chrome pak entry: resource id (2 bytes) and offset (4 bytes), little endian
+pakentry = struct.Struct('<HI')
+
 ## Verify and tag Chrome/Chromium/WebView .pak files
 ## http://dev.chromium.org/developers/design-documents/linuxresourcesandlocalizedstrings
 def verifyChromePak(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=False, unpacktempdir=None):
@@ -330,33 +400,26 @@ def verifyChromePak(filename, tempdir=None, tags=[], offsets={}, scanenv={}, deb
 		pakfile.close()
 		return newtags
 
-	for i in range(0,numberofentries):
-		try:
-			resourceid = struct.unpack('<H', pakfile.read(2))[0]
-			resourceoffset = struct.unpack('<I', pakfile.read(4))[0]
-			if resourceoffset > filesize:
-				pakfile.close()
-				return newtags
-		except:
-			pakfile.close()
-			return newtags
-
-	## Then two zero bytes
-	try:
-		if struct.unpack('<H', pakfile.read(2))[0] != 0:
-			pakfile.close()
-			return newtags
-	except:
-		pakfile.close()
-		return newtags
-	## followed by the end of the last resource. This should be the same
-	## as the file size
-	try:
-		endoflastresource = struct.unpack('<I', pakfile.read(4))[0]
-	except:
+	## The entries (resource id and offset) are followed by two zero bytes
+	## and the end of the last resource, which have the same layout as an
+	## entry, so read them all at once. If there is not enough data left
+	## for all entries it is not a valid file.
+	if (numberofentries+1)*pakentry.size > filesize - 9:
 		pakfile.close()
 		return newtags
+	pakentries = pakfile.read((numberofentries+1)*pakentry.size)
 	pakfile.close()
+	unpack_from = pakentry.unpack_from
+	for i in xrange(0, numberofentries*pakentry.size, pakentry.size):
+		(resourceid, resourceoffset) = unpack_from(pakentries, i)
+		if resourceoffset > filesize:
+			return newtags
+
+	## Then two zero bytes, followed by the end of the last resource. This
+	## should be the same as the file size
+	(zerobytes, endoflastresource) = unpack_from(pakentries, numberofentries*pakentry.size)
+	if zerobytes != 0:
+		return newtags
 	if endoflastresource == filesize:
 		newtags.append("resource")
 		newtags.append("pak")
@@ -407,28 +470,32 @@ def verifyAndroidDex(filename, tempdir=None, tags=[], offsets={}, scanenv={}, de
 def verifyAndroidDexGeneric(filename, dexsize, offset, verifychecksum=True):
 	newtags = []
 	byteswapped = False
-	## Parse the Dalvik header.
+	## Parse the Dalvik header. The first 44 bytes are read at once and
+	## the same file object is used for computing the checksums.
 	androidfile = open(filename, 'rb')
 	androidfile.seek(offset)
+	androidbytes = androidfile.read(44)
+	if len(androidbytes) != 44:
+		androidfile.close()
+		return newtags
 
 	## magic header, already checked
-	magic_bytes = androidfile.read(8)
+	magic_bytes = androidbytes[:8]
 
 	## Adler32 checksum
-	checksum_bytes = androidfile.read(4)
+	checksum_bytes = androidbytes[8:12]
 
 	## SHA1 checksum
-	signature_bytes = androidfile.read(20)
+	signature_bytes = androidbytes[12:32]
 
 	## file size
-	filesize_bytes = androidfile.read(4)
+	filesize_bytes = androidbytes[32:36]
 
 	## header size (should be 112)
-	headersize_bytes = androidfile.read(4)
+	headersize_bytes = androidbytes[36:40]
 
 	## endianness (almost guaranteed to be little endian)
-	endian_bytes = androidfile.read(4)
-	androidfile.close()
+	endian_bytes = androidbytes[40:44]
 
 	## check if the file is big endian or little endian
 	if struct.unpack('<I', endian_bytes)[0] != 0x12345678:
@@ -445,31 +512,46 @@ def verifyAndroidDexGeneric(filename, dexsize, offset, verifychecksum=True):
 
 	## The size field in the header should be 0x70
 	if dexheadersize != 0x70:
+		androidfile.close()
 		return newtags
 	if declared_size != dexsize:
+		androidfile.close()
 		return newtags
 
 	if verifychecksum:
-		## now compute the Adler32 checksum for the file
-		androidfile = open(filename, 'rb')
-		androidfile.seek(12)
-
-		## TODO: not very efficient
-		checksumdata = androidfile.read(dexsize)
-		androidfile.close()
-		if zlib.adler32(checksumdata) & 0xffffffff != dexchecksum:
-			return newtags
-
-		## Then compute the SHA-1 checksum. Reuse the data from the previous check
-		h = hashlib.new('sha1')
+		## now compute the Adler32 checksum (everything after the checksum
+		## field) and the SHA-1 checksum (everything after the SHA-1 field)
+		## for the file in a single pass, in blocks of 1 MiB, instead of
+		## reading the whole file into memory.
+		androidfile.seek(offset+12)
+		adler = zlib.adler32('')
+		h = hashlib.sha1()
+		checksumdata = androidfile.read(min(1048576, dexsize-12))
+		adler = zlib.adler32(checksumdata, adler)
 		h.update(checksumdata[20:])
-		if h.hexdigest().decode('hex') != signature_bytes:
+		readsize = len(checksumdata)
+		while checksumdata != '' and readsize < dexsize-12:
+			checksumdata = androidfile.read(min(1048576, dexsize-12-readsize))
+			adler = zlib.adler32(checksumdata, adler)
+			h.update(checksumdata)
+			readsize += len(checksumdata)
+		if adler & 0xffffffff != dexchecksum:
+			androidfile.close()
+			return newtags
+		if h.digest() != signature_bytes:
+			androidfile.close()
 			return newtags
+	androidfile.close()
 
 	newtags.append('dalvik')
 	newtags.append('dex')
 	return newtags
 
+## Odex header, starting at byte 8, little endian: dex offset, dex length,
+## dependency table offset and length, data table offset and length,
+## flags and the Adler32 checksum of the dependency and data tables
+odexheader = struct.Struct('<8I')
+
 ## Verify if this is an optimised Android/Dalvik file. Check if the name of
 ## the file ends in '.odex', plus verify a length checksum in the header.
 ## The main reason for this check is to bring down false positives for lzma unpacking
@@ -493,71 +575,57 @@ def verifyAndroidOdex(filename, tempdir=None, tags=[], offsets={}, scanenv={}, d
 	if not os.path.basename(filename).endswith('.odex'):
 		return newtags
 
-	seekoffset = 8
-	## check the Odex files. First check the header.
+	## check the Odex files. First check the header, which is read and
+	## unpacked in one go. The same file object is used for the checksum.
 	androidfile = open(filename, 'rb')
-	androidfile.seek(seekoffset)
-	androidbytes = androidfile.read(4)
-
-	## the dex identifier should be defined at this location
-	dexoffset = struct.unpack('<I', androidbytes)[0]
-	if dexoffset != offsets['dex'][0]:
+	odexsize = os.fstat(androidfile.fileno()).st_size
+	androidfile.seek(8)
+	androidbytes = androidfile.read(odexheader.size)
+	if len(androidbytes) != odexheader.size:
 		androidfile.close()
 		return newtags
 
-	seekoffset += 4
-
-	## There are a few interesting values in the Odex header
-	androidfile.seek(seekoffset)
-
+	## The dex identifier should be defined at the first location. There
+	## are a few interesting values in the rest of the Odex header:
 	## 1. length of Dex file
-	androidbytes = androidfile.read(4)
-	dexlength = struct.unpack('<I', androidbytes)[0]
-
 	## 2. offset of optimised DEX dependency table
-	androidbytes = androidfile.read(4)
-	dependencytableoffset = struct.unpack('<I', androidbytes)[0]
-
 	## 3. length of optimised DEX dependency table
-	androidbytes = androidfile.read(4)
-	dependencytablesize = struct.unpack('<I', androidbytes)[0]
-
 	## 4. offset of optimised data table
-	androidbytes = androidfile.read(4)
-	datatableoffset = struct.unpack('<I', androidbytes)[0]
-
 	## 5. length of optimised data table
-	androidbytes = androidfile.read(4)
-	datatablesize = struct.unpack('<I', androidbytes)[0]
-
 	## 6. flags
-	androidbytes = androidfile.read(4)
-	flags = struct.unpack('<I', androidbytes)[0]
-
 	## 7. adler checksum of opt and deps
-	androidbytes = androidfile.read(4)
-	optdepschecksum = struct.unpack('<I', androidbytes)[0]
-	androidfile.close()
+	(dexoffset, dexlength, dependencytableoffset, dependencytablesize, datatableoffset, datatablesize, flags, optdepschecksum) = odexheader.unpack(androidbytes)
+	if dexoffset != offsets['dex'][0]:
+		androidfile.close()
+		return newtags
 
 	## sanity checks for the ODEX header
 	## 1. header offset + length of Dex should be < offset of dependency table
 	if (dexoffset + dexlength) > dependencytableoffset:
+		androidfile.close()
 		return newtags
 
 	## 2. offset of dependency table + size of dependency table should be < offset of optimised data table
 	if (dependencytableoffset + dependencytablesize) > datatableoffset:
+		androidfile.close()
 		return newtags
 	## 3. offset of data table + length of data table == length of ODEX file
-	if not (datatableoffset + datatablesize) == os.stat(filename).st_size:
+	if not (datatableoffset + datatablesize) == odexsize:
+		androidfile.close()
 		return newtags
 
-	## check the Adler32 checksum for opts + deps
-	androidfile = open(filename, 'rb')
+	## check the Adler32 checksum for opts + deps. These run until the end
+	## of the file, so compute it in blocks of 1 MiB instead of reading all
+	## of the data into memory.
 	androidfile.seek(dependencytableoffset)
-	checksumdata = androidfile.read()
+	adler = zlib.adler32('')
+	checksumdata = androidfile.read(1048576)
+	while checksumdata != '':
+		adler = zlib.adler32(checksumdata, adler)
+		checksumdata = androidfile.read(1048576)
 	androidfile.close()
 
-	if zlib.adler32(checksumdata) & 0xffffffff != optdepschecksum:
+	if adler & 0xffffffff != optdepschecksum:
 		return newtags
 
 	## Then perform a few checks on the Dex file included in the Odex file, but
@@ -603,7 +671,7 @@ def verifySqlite3(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug
 		return newtags
 	if not 'sqlite3' in offsets:
 		return newtags
-	if not 0 in offsets['sqlite3']:
+	if offsets['sqlite3'] == [] or offsets['sqlite3'][0] != 0:
 		return newtags
 	## check first if the file size is even
 	filesize = os.stat(filename).st_size
@@ -668,30 +736,29 @@ def verifyIco(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fal
 		return newtags
 	if 'compressed' in tags or 'graphics' in tags or 'xml' in tags:
 		return newtags
-	## check the first four bytes
+	## check the first four bytes and the amount of images in the file
+	## in one go, the headers of the images follow directly.
 	icofile = open(filename, 'rb')
-	icobytes = icofile.read(4)
-	icofile.close()
+	icobytes = icofile.read(6)
+	if len(icobytes) != 6:
+		icofile.close()
+		return newtags
 	## only allow icon files and cursor files
-	if icobytes == '\x00\x00\x01\x00':
+	if icobytes[:4] == '\x00\x00\x01\x00':
 		filetype = 'ico'
-	elif icobytes == '\x00\x00\x02\x00':
+	elif icobytes[:4] == '\x00\x00\x02\x00':
 		filetype = 'cur'
 	else:
+		icofile.close()
 		return newtags
 	## now check how many images there are in the file
-	icofile = open(filename, 'rb')
-	icofile.seek(4)
-	icobytes = icofile.read(2)
-	icocount = struct.unpack('<H', icobytes)[0]
-	icofile.close()
+	icocount = struct.unpack('<H', icobytes[4:])[0]
 
 	if icocount == 0:
+		icofile.close()
 		return newtags
 
-	icofilesize = os.stat(filename).st_size
-	icofile = open(filename, 'rb')
-	icofile.seek(6)
+	icofilesize = os.fstat(icofile.fileno()).st_size
 
 	oldoffset = 0
 	## the ICO format first has all the headers, then the image data
@@ -730,6 +797,7 @@ def verifyIco(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fal
 		## the icon cannot start before the end of the
 		## previous icon (if any)
 		if not icooffset >= oldoffset:
+			icofile.close()
 			return newtags
 		oldoffset = icooffset + icosize
 		## TODO: extra sanity check to see if each image
@@ -766,7 +834,7 @@ def verifyBFLT(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fa
 		return newtags
 	if not 'bflt' in offsets:
 		return newtags
-	if not 0 in offsets['bflt']:
+	if offsets['bflt'] == [] or offsets['bflt'][0] != 0:
 		return newtags
 	filesize = os.stat(filename).st_size
 	if filesize < 64:
@@ -834,11 +902,17 @@ def verifyELF(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fal
 		return newtags
 	if 'compressed' in tags or 'graphics' in tags or 'xml' in tags:
 		return newtags
-	elffile = open(filename, 'rb')
-	elfbytes = elffile.read(4)
-	elffile.close()
-	if elfbytes != '\x7f\x45\x4c\x46':
-		return newtags
+	## if the ELF marker was searched the offsets already tell if the
+	## file starts with it, so there is no need to read the file
+	if 'elf' in offsets:
+		if offsets['elf'] == [] or offsets['elf'][0] != 0:
+			return newtags
+	else:
+		elffile = open(filename, 'rb')
+		elfbytes = elffile.read(4)
+		elffile.close()
+		if elfbytes != '\x7f\x45\x4c\x46':
+			return newtags
 	newtags = elfcheck.verifyELF(filename, tempdir, tags, offsets, scanenv, debug, unpacktempdir)
 	return newtags
 
@@ -853,10 +927,23 @@ def verifyExe(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fal
 	if not filename.lower().endswith('.exe'):
 		return newtags
 	datafile = open(filename, 'rb')
-	databuffer = datafile.read(100000)
+	## the offset of the PE header is stored at 0x3c in the DOS header
+	datafile.seek(0x3c)
+	databuffer = datafile.read(4)
+	if len(databuffer) != 4:
+		datafile.close()
+		return newtags
+	peoffset = struct.unpack('<I', databuffer)[0]
+	## the PE header has to be after the DOS header and appear
+	## fairly early in the file
+	if peoffset < 0x40 or peoffset > 100000:
+		datafile.close()
+		return newtags
+	## only read the DOS stub (which sits between the DOS header and
+	## the PE header) and the identifier of the PE header
+	databuffer = datafile.read(peoffset - 0x40 + 4)
 	datafile.close()
-	## the string 'PE\0\0' has to appear fairly early in the file
-	if not 'PE\0\0' in databuffer:
+	if databuffer[-4:] != 'PE\0\0':
 		return newtags
 	## this is a dead giveaway. Ignore DOS executables for now
 	if not "This program cannot be run in DOS mode." in databuffer:
@@ -915,7 +1002,9 @@ def verifyIHex(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fa
 		if len(databytes) == 0:
 			validfile = False
 			break
-		if reduce(lambda x, y: x + y, map(lambda x: ord(x), databytes)) % 256 != 0:
+		## the sum of all bytes, including the checksum, should be 0 (modulo 256).
+		## bytearray gives the byte values directly, so sum() runs in C.
+		if sum(bytearray(databytes)) % 256 != 0:
 			validfile = False
 			break
 	datafile.close()
@@ -923,6 +1012,9 @@ def verifyIHex(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=Fa
 		newtags.append('ihex')
 	return newtags
 
+## AppleDouble entry: entry id, offset and length, big endian
+resourceforkentry = struct.Struct('>III')
+
 ## verify Apple's AppleDouble encoded files (resource forks)
 ## http://tools.ietf.org/html/rfc1740 -- Appendix A & B
 def verifyResourceFork(filename, tempdir=None, tags=[], offsets={}, scanenv={}, debug=False, unpacktempdir=None):
@@ -931,12 +1023,11 @@ def verifyResourceFork(filename, tempdir=None, tags=[], offsets={}, scanenv={},
 		return newtags
 	if not 'appledouble' in offsets:
 		return newtags
-	if not 0 in offsets['appledouble']:
+	if offsets['appledouble'] == [] or offsets['appledouble'][0] != 0:
 		return newtags
 
-	filesize = os.stat(filename).st_size
-
 	datafile = open(filename, 'rb')
+	filesize = os.fstat(datafile.fileno()).st_size
 	## 4 bytes magic, 4 bytes verson, 16 bytes filler
 	datafile.seek(24)
 	databuffer = datafile.read(2)
@@ -945,24 +1036,22 @@ def verifyResourceFork(filename, tempdir=None, tags=[], offsets={}, scanenv={},
 		datafile.close()
 		return newtags
 
-	## walk all the entries to see if they are valid
+	## walk all the entries to see if they are valid. The entries are
+	## read in one go.
+	databuffer = datafile.read(numberofentries*resourceforkentry.size)
+	datafile.close()
+	if len(databuffer) != numberofentries*resourceforkentry.size:
+		return newtags
 	validsize = False
-	for i in range(0, numberofentries):
-		databuffer = datafile.read(4)
-		entry = struct.unpack('>I', databuffer)[0]
+	unpack_from = resourceforkentry.unpack_from
+	for i in xrange(0, len(databuffer), resourceforkentry.size):
+		(entry, offset, length) = unpack_from(databuffer, i)
 		if entry == 0:
-			datafile.close()
 			return newtags
-		databuffer = datafile.read(4)
-		offset = struct.unpack('>I', databuffer)[0]
-		databuffer = datafile.read(4)
-		length = struct.unpack('>I', databuffer)[0]
 		if offset + length > filesize:
-			datafile.close()
 			return newtags
 		if offset + length == filesize:
 			validsize = True
-	datafile.close()
 
 	if not validsize:
 		return newtags
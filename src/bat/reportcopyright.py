@@ -44,5 +44,5 @@ def reportcopyright(unpackreports, scantempdir, topleveldir, processors, scanenv
 			leafreports['copyrights'] = copyrights
 
 			leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-			leafreports = cPickle.dump(leafreports, leaf_file)
+			cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 			leaf_file.close()
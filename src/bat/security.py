@@ -66,7 +66,7 @@ def scanEncryptedZip(unpackreports, scantempdir, topleveldir, processors, scanen
 			leafreports['tags'].append('encryptedzip-attack')
 			unpackreports[i]['tags'].append('encryptedzip-attack')
 			leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-			cPickle.dump(leafreports, leaf_file)
+			cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 			leaf_file.close()
 	return
 
@@ -136,7 +136,7 @@ def scanShellInvocations(unpackreports, scantempdir, topleveldir, processors, sc
 			leafreports['tags'].append('shellinvocations')
 			unpackreports[i]['tags'].append('shellinvocations')
 			leaf_file = open(os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash), 'wb')
-			cPickle.dump(leafreports, leaf_file)
+			cPickle.dump(leafreports, leaf_file, cPickle.HIGHEST_PROTOCOL)
 			leaf_file.close()
 
 ## method to check if a file is an OpenSSH public or private key
@@ -238,7 +238,7 @@ def crackPasswords(unpackreports, scantempdir, topleveldir, processors, scanenv,
 			## print the lines with passwords that need to be
 			## scanned with JTR to a separate file
 			tmppwdfile = tempfile.mkstemp()
-			os.fdopen(tmppwdfile[0]).close()
+			os.close(tmppwdfile[0])
 			newpwdfile = open(tmppwdfile[1], 'w')
 			for s in scanlines:
 				newpwdfile.write(s)
@@ -120,7 +120,7 @@ def searchUnpackRPM(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		## use rpm2cpio to unpack the RPM file.
 		tmpdir = fwunpack.dirsetup(tempdir, filename, "rpm", rpmcounter)
 		tmpfile = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(tmpfile[0]).close()
+		os.close(tmpfile[0])
 
 		fwunpack.unpackFile(filename, offset, tmpfile[1], tmpdir)
 